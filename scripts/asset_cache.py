@@ -0,0 +1,168 @@
+""" Local cache of the relief data used as the background of the maps.
+plot_maps_filtering.py and plot_rotated_vels.py used to request the
+@earth_relief_03m grid from the GMT data server for every figure, which fails on
+machines without network access and makes every figure depend on the state of
+the remote server.
+
+The assets of a map region are prefetched once and stored in their own folder
+(named after the relief grid, the region and the coastline options):
+    - relief.nc: relief grid cropped to the region
+    - shade.nc: hillshade of the relief (same illumination as shading=True)
+    - region.txt: the relief grid, region and coastline options of the folder
+    - manifest_assets.json: checksums of the files (see run_manifest.py)
+Water, coastlines and borders are drawn with coast as before (water filled in
+white over the relief), from the GSHHG database installed with GMT. The prefetch
+runs coast once for the region, so that GMT downloads the database if it is not
+installed yet. With offline=True, maps are only drawn if the GSHHG files of the
+coastline resolution are found in the folders where GMT looks for them
+(DIR_GSHHG, the share/coast folder and its coastline.conf, and the server folder
+of the GMT user directory), as coast would otherwise try to download them.
+
+Several workers (e.g. the plot jobs of job_queue.py) may prefetch the same region
+at the same time: the assets are prepared in a temporary folder of the process
+and renamed to the folder of the region once complete, and a lock file
+(.<folder>.lock) makes the other workers wait and reuse the assets instead of
+downloading them again. Once the assets exist, maps are rendered from these
+local files only:
+    python asset_cache.py ./results/map_assets [--region -20 125 5 60]
+
+Requires pygmt (only to prefetch and to render the maps)."""
+
+""" Import necessary modules """
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from run_manifest import atomic_open, RunManifest
+try:
+    import fcntl
+except ImportError:  # Windows: prefetch the assets before starting parallel workers
+    fcntl = None
+
+DEFAULT_REGION = [-20, 125, 5, 60]  # Entire Alpine-Himalayan belt
+ASSET_FILES = ['relief.nc', 'shade.nc', 'region.txt']
+GSHHG_FILES = ['binned_GSHHS_{}.nc', 'binned_border_{}.nc']  # Shorelines and borders of a resolution
+
+def asset_folder_for(asset_folder, region, relief='@earth_relief_03m', resolution='h', area_thresh=4000):
+    """ Folder of the assets of a map region."""
+    bounds = '_'.join(f'{bound:g}' for bound in region)
+    return os.path.join(asset_folder, f"{relief.lstrip('@')}_{bounds}_{resolution}{area_thresh}")
+
+def assets_available(folder):
+    """ Check whether every asset file of a region folder exists."""
+    return all(os.path.exists(os.path.join(folder, file_name)) for file_name in ASSET_FILES)
+
+def gshhg_folders():
+    """ Folders where GMT looks for the GSHHG coastline database."""
+    import pygmt
+    settings = {}
+    with pygmt.clib.Session() as lib:
+        for name in ('DIR_GSHHG', 'API_SHAREDIR', 'API_USERDIR'):
+            try:
+                settings[name] = lib.get_default(name)
+            except pygmt.exceptions.GMTCLibError:
+                settings[name] = ''
+    user_folder = settings['API_USERDIR'] or os.environ.get('GMT_USERDIR', os.path.join(os.path.expanduser('~'), '.gmt'))
+    folders = [settings['DIR_GSHHG'], os.path.join(settings['API_SHAREDIR'], 'coast'), os.path.join(user_folder, 'server', 'gshhg')]
+    # Packaged databases are listed in share/coast/coastline.conf (one folder per line)
+    config_file = os.path.join(settings['API_SHAREDIR'], 'coast', 'coastline.conf')
+    if settings['API_SHAREDIR'] and os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            folders += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return [folder for folder in folders if folder]
+
+def coastlines_available(resolution='h'):
+    """ Check whether the GSHHG shorelines and borders of a resolution are installed
+    locally, so that coast can draw them without network access."""
+    return any(all(os.path.exists(os.path.join(folder, file_name.format(resolution))) for file_name in GSHHG_FILES)
+               for folder in gshhg_folders())
+
+def prefetch_assets(asset_folder, region=DEFAULT_REGION, relief='@earth_relief_03m', resolution='h', area_thresh=4000):
+    """ Download (through GMT) and prepare the assets of a map region. This is the
+    only function that needs access to the GMT data server. Returns the folder
+    of the assets."""
+    folder = asset_folder_for(asset_folder, region, relief, resolution, area_thresh)
+    os.makedirs(asset_folder, exist_ok=True)
+    with open(os.path.join(asset_folder, f'.{os.path.basename(folder)}.lock'), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Another worker may have prepared the assets while this one was waiting
+        if not assets_available(folder):
+            temporary_folder = tempfile.mkdtemp(dir=asset_folder, prefix=f'.{os.path.basename(folder)}.partial-')
+            try:
+                write_assets(temporary_folder, region, relief, resolution, area_thresh)
+                shutil.rmtree(folder, ignore_errors=True)  # incomplete assets of an older version
+                os.replace(temporary_folder, folder)
+            finally:
+                shutil.rmtree(temporary_folder, ignore_errors=True)
+            print(f"Map assets for region {'/'.join(f'{bound:g}' for bound in region)}: {folder}")
+    return folder
+
+def write_assets(folder, region, relief, resolution, area_thresh):
+    """ Write the assets of a map region to a folder (see prefetch_assets)."""
+    import pygmt
+    region_arg = '/'.join(f'{bound:g}' for bound in region)
+    with pygmt.clib.Session() as lib:
+        # Crop the relief grid to the region
+        lib.call_module('grdcut', f'{relief} -R{region_arg} -G{os.path.join(folder, "relief.nc")}')
+        # Same illumination as shading=True in grdimage (+a-45+nt1+m0)
+        lib.call_module('grdgradient', f'{os.path.join(folder, "relief.nc")} -A-45 -Nt1+m0 -G{os.path.join(folder, "shade.nc")}')
+        # Make sure that the coastlines of the region are available locally
+        lib.call_module('coast', f'-R{region_arg} -D{resolution} -A{area_thresh} -W -M ->{os.devnull}')
+
+    manifest = RunManifest(folder, 'assets')
+    for file_name in ('relief.nc', 'shade.nc'):
+        manifest.record(os.path.join(folder, file_name))
+    with atomic_open(os.path.join(folder, 'region.txt'), 'w') as f:
+        f.write(f'{relief} {region_arg} -D{resolution} -A{area_thresh}\n')
+    manifest.record(os.path.join(folder, 'region.txt'))
+    manifest.save()
+
+def ensure_assets(asset_folder, region=DEFAULT_REGION, offline=False, **options):
+    """ Folder of the assets of a map region, prefetching them if they are missing.
+    With offline=True, missing assets or a missing local GSHHG database raise an
+    error instead of being downloaded."""
+    folder = asset_folder_for(asset_folder, region, **options)
+    if not assets_available(folder):
+        if offline:
+            raise FileNotFoundError(f"Map assets missing in {folder}. Run 'python asset_cache.py {asset_folder}' "
+                                    f"on a machine with network access and copy the folder.")
+        prefetch_assets(asset_folder, region, **options)
+    resolution = options.get('resolution', 'h')
+    if offline and not coastlines_available(resolution):
+        raise FileNotFoundError(f"GSHHG coastlines (resolution {resolution}) not installed locally (searched: "
+                                f"{', '.join(gshhg_folders())}). Install the GSHHG database for GMT (e.g. the "
+                                f"gshhg-gmt package) or run 'python asset_cache.py {asset_folder}' with network access.")
+    return folder
+
+def draw_base_map(fig, region=DEFAULT_REGION, asset_folder='./results/map_assets', offline=False, resolution='h', area_thresh=4000):
+    """ Draw the shaded relief, water, coastlines and borders of a region on a pygmt
+    figure (after the basemap), using only local data."""
+    import pygmt
+    folder = ensure_assets(asset_folder, region, offline, resolution=resolution, area_thresh=area_thresh)
+
+    # Create a custom color palette for the relief shading
+    pygmt.makecpt(cmap="gray95,gray90,gray85", series=[-10000, 10000, 100])
+
+    # Add shaded topography with transparency
+    fig.grdimage(grid=os.path.join(folder, 'relief.nc'), cmap=True, shading=os.path.join(folder, 'shade.nc'), transparency=20)
+
+    # Add coastlines (GSHHG database installed with GMT)
+    fig.coast(water='white', borders="1/0.1p,gray90", shorelines="0.1p,black", area_thresh=area_thresh, resolution=resolution)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prefetch the relief and coastline assets of the maps.')
+    parser.add_argument('asset_folder', help='Folder of the map assets cache')
+    parser.add_argument('--region', type=float, nargs=4, default=DEFAULT_REGION, metavar=('WEST', 'EAST', 'SOUTH', 'NORTH'))
+    parser.add_argument('--relief', default='@earth_relief_03m', help='GMT remote relief grid')
+    parser.add_argument('--resolution', default='h', help='Resolution of the coastlines (c, l, i, h, f)')
+    parser.add_argument('--area_thresh', type=int, default=4000, help='Minimum area (km2) of the features drawn')
+    args = parser.parse_args()
+
+    # Time the prefetch of the assets
+    start_time = time.time()
+    prefetch_assets(args.asset_folder, args.region, args.relief, args.resolution, args.area_thresh)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
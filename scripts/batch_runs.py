@@ -0,0 +1,233 @@
+""" This code runs several configurations (variants) of the coherence filter and of
+the harmonisation of uncertainties on the same input velocity fields in one
+batch. The inputs are read once, and the neighbourhoods of the stations (built
+with a KD-tree, see geodesy_kernels.py) are computed once for every distinct
+radius or number of nearest stations. Inputs and neighbourhoods are copied into
+shared memory blocks, and the variants are run in parallel by worker processes
+that attach to these blocks instead of reading and indexing the inputs again. The outputs of each variant
+are written to their own folder:
+    <output_folder>/<variant>/sites_excluded_coherence
+    <output_folder>/<variant>/output_coherence_analysis
+    <output_folder>/<variant>/scaled  (only if a reference solution is given)
+
+The configurations are given as a JSON list, for example:
+    [
+        {"name": "default"},
+        {"name": "geo_strict", "geo_strict": true, "regions_json": "./regions.json"},
+        {"name": "exempt_nocquet", "special_case_file": "nocquet_2012"},
+        {"name": "reference_kreemer", "reference": "kreemer_2014", "radius": 25},
+        {"name": "knn", "knn": 10, "max_distance": 150}
+    ]
+Options not given take the defaults of coherence_filter.py (radius 20 km, no
+geographic stringency, no special case file, no harmonisation). With knn, the
+neighbourhoods are the knn nearest stations (within max_distance km, if given)
+instead of the stations within the radius. The reference is either the name of
+a solution of the batch (its filtered velocities in the same variant are used)
+or the path of a file."""
+
+""" Import necessary modules """
+import os
+import json
+import time
+import argparse
+import contextlib
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from run_manifest import discover_inputs, RunManifest
+from geodesy_kernels import neighbour_lists, knn_neighbours
+from coherence_filter import region_sigma_levels, coherence_outliers, save_coherence_outputs, is_special_case
+
+COLUMNS = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+NUMERIC_COLUMNS = COLUMNS[:-1]
+
+def read_configurations(configurations_file):
+    """ Read the list of configurations, with defaults for the missing options and
+    the regions of each regions_json file loaded."""
+    with open(configurations_file, 'r') as f:
+        configurations = json.load(f)
+    names = [configuration.get('name') for configuration in configurations]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError("Every configuration needs a unique name")
+    for configuration in configurations:
+        configuration.setdefault('radius', 20)
+        configuration.setdefault('knn', None)
+        configuration.setdefault('max_distance', None)
+        configuration.setdefault('geo_strict', False)
+        configuration.setdefault('special_case_file', None)
+        configuration.setdefault('reference', None)
+        configuration['regions'] = []
+        if configuration['geo_strict'] and configuration.get('regions_json'):
+            with open(configuration['regions_json'], 'r') as f:
+                configuration['regions'] = json.load(f)
+    return configurations
+
+def load_inputs(folder_path):
+    """ Read every CSV file of the input folder (as coherence_filter.py does) into a
+    single numeric matrix. Returns the matrix and the metadata needed to rebuild
+    the DataFrame of each file: file names, first rows, column types and codes."""
+    file_names = discover_inputs(folder_path, '.csv')
+    tables, starts, dtypes, stations = [], [0], [], []
+    for file_name in file_names:
+        df = pd.read_csv(file_name, sep=' ', skiprows=1, header=None)
+        df.columns = COLUMNS
+        try:
+            tables.append(df[NUMERIC_COLUMNS].to_numpy(dtype=float))
+        except ValueError:
+            raise ValueError(f"Non-numeric values in {file_name}")
+        starts.append(starts[-1] + len(df))
+        dtypes.append({column: str(df[column].dtype) for column in NUMERIC_COLUMNS})
+        stations.append(df['Stat'].to_numpy(dtype=object))
+    values = np.concatenate(tables) if tables else np.zeros((0, len(NUMERIC_COLUMNS)))
+    return values, {'files': file_names, 'starts': starts, 'dtypes': dtypes, 'stations': stations}
+
+def batch_neighbourhoods(values, starts, radius):
+    """ Neighbourhoods of all the stations of the batch for a radius, as a single set
+    of compressed lists with global row numbers (stations of different files are
+    never neighbours)."""
+    offsets, neighbours = [np.zeros(1, dtype=np.int64)], []
+    for start, end in zip(starts[:-1], starts[1:]):
+        file_offsets, file_neighbours = neighbour_lists(values[start:end, 0], values[start:end, 1], radius)
+        offsets.append(file_offsets[1:] + offsets[-1][-1])
+        neighbours.append(file_neighbours + start)
+    return np.concatenate(offsets), np.concatenate(neighbours) if neighbours else np.zeros(0, dtype=np.int64)
+
+def batch_knn_neighbours(values, starts, knn, max_distance):
+    """ Fixed-width neighbourhoods (knn nearest stations) of all the stations of the
+    batch, with global row numbers (missing neighbours are -1)."""
+    index = [np.zeros((0, knn), dtype=np.int64)]
+    for start, end in zip(starts[:-1], starts[1:]):
+        file_index = knn_neighbours(values[start:end, 0], values[start:end, 1], knn, max_distance)
+        index.append(np.where(file_index >= 0, file_index + start, -1))
+    return np.concatenate(index)
+
+def neighbourhood_key(configuration):
+    """ Name of the shared neighbourhoods used by a configuration."""
+    if configuration['knn']:
+        return f"knn_{configuration['knn']}_{configuration['max_distance'] or 0:g}".replace('.', 'p')
+    return f"radius_{float(configuration['radius']):g}".replace('.', 'p')
+
+class SharedArrays:
+    """ NumPy arrays copied into shared memory blocks. `specs` describes the blocks
+    and is passed to the workers, which attach to them with attach_arrays."""
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def release(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+_blocks = []
+_arrays = {}
+_meta = {}
+
+def attach_arrays(specs, meta):
+    """ Worker initializer: attach to the shared blocks and keep the metadata."""
+    # Figures of the harmonisation are only saved to files
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _blocks.append(block)
+        _arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _meta.update(meta)
+
+def file_table(i):
+    """ DataFrame of input file i, rebuilt from the shared matrix with its column types."""
+    start, end = _meta['starts'][i], _meta['starts'][i + 1]
+    df = pd.DataFrame(np.array(_arrays['values'][start:end]), columns=NUMERIC_COLUMNS).astype(_meta['dtypes'][i])
+    df['Stat'] = _meta['stations'][i]
+    return df
+
+def run_variant(configuration, output_folder):
+    """ Run the coherence filter (and the harmonisation of uncertainties, if a
+    reference is given) for one configuration. Returns a summary of the variant."""
+    start_time = time.time()
+    values = _arrays['values']
+    key = neighbourhood_key(configuration)
+    neighbourhoods = _arrays[key] if configuration['knn'] else (_arrays[f'{key}_offsets'], _arrays[f'{key}_neighbours'])
+    sigma_level = region_sigma_levels(values[:, 0], values[:, 1], configuration['regions']) if configuration['geo_strict'] else 2.0
+    incoherent = coherence_outliers(values[:, 0], values[:, 1], values[:, 2:4], configuration['radius'], sigma_level, neighbourhoods)
+
+    variant_folder = os.path.join(output_folder, configuration['name'])
+    excluded_folder = os.path.join(variant_folder, 'sites_excluded_coherence')
+    filtered_folder = os.path.join(variant_folder, 'output_coherence_analysis')
+    manifest = RunManifest(filtered_folder, 'coherence')
+    manifest.add_inputs(_meta['files'])
+    removed = 0
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i, file_name in enumerate(_meta['files']):
+            start, end = _meta['starts'][i], _meta['starts'][i + 1]
+            filtered_stations = set() if is_special_case(file_name, configuration['special_case_file']) else \
+                set(np.flatnonzero(incoherent[start:end]).tolist())
+            removed += save_coherence_outputs(file_table(i), filtered_stations, file_name, excluded_folder, filtered_folder, manifest)[0]
+        manifest.save()
+
+        if configuration['reference']:
+            reference = configuration['reference']
+            if not os.path.exists(reference):
+                reference = os.path.join(filtered_folder, f'{reference}.csv')
+            # harmonise_uncertainties saves its figures to ./results/figures
+            from uncertainty_scaling_combined import harmonise_uncertainties
+            os.makedirs(os.path.join(variant_folder, 'results', 'figures'), exist_ok=True)
+            previous_folder = os.getcwd()
+            os.chdir(variant_folder)
+            try:
+                harmonise_uncertainties(os.path.abspath(filtered_folder), os.path.abspath(reference), os.path.abspath(os.path.join(variant_folder, 'scaled')))
+            finally:
+                os.chdir(previous_folder)
+
+    return {'Variant': configuration['name'], 'Files': len(_meta['files']), 'Stations': len(values),
+            'Removed': removed, 'Scaled': bool(configuration['reference']), 'Time': round(time.time() - start_time, 2)}
+
+def run_batch(folder_path, configurations, output_folder, workers=None):
+    """ Run every configuration on the input folder. Returns the summary of the
+    variants as a DataFrame."""
+    output_folder = os.path.abspath(output_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    values, meta = load_inputs(folder_path)
+
+    # Neighbourhoods for every distinct radius (or knn), computed once for all the variants
+    arrays = {'values': values}
+    for configuration in configurations:
+        key = neighbourhood_key(configuration)
+        if configuration['knn'] and key not in arrays:
+            arrays[key] = batch_knn_neighbours(values, meta['starts'], configuration['knn'], configuration['max_distance'])
+        elif not configuration['knn'] and f'{key}_offsets' not in arrays:
+            arrays[f'{key}_offsets'], arrays[f'{key}_neighbours'] = batch_neighbourhoods(values, meta['starts'], configuration['radius'])
+    print(f"Stations: {len(values)} in {len(meta['files'])} files, variants: {len(configurations)}")
+
+    shared = SharedArrays(arrays)
+    try:
+        workers = workers or min(len(configurations), os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=attach_arrays, initargs=(shared.specs, meta)) as executor:
+            futures = [executor.submit(run_variant, configuration, output_folder) for configuration in configurations]
+            summary = pd.DataFrame([future.result() for future in futures])
+    finally:
+        shared.release()
+    summary.to_csv(os.path.join(output_folder, 'batch_summary.csv'), sep=',', index=False)
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run several configurations of the coherence filter and the harmonisation of uncertainties in one batch.')
+    parser.add_argument('folder_path', help='Path to the input folder containing CSV files (output of lognorm_filter.py)')
+    parser.add_argument('configurations_json', help='JSON file with the list of configurations')
+    parser.add_argument('output_folder', help='Folder where the outputs of every variant are written')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: one per variant, up to the number of CPUs)')
+    args = parser.parse_args()
+
+    # Time the execution of the batch
+    start_time = time.time()
+    summary = run_batch(args.folder_path, read_configurations(args.configurations_json), args.output_folder, args.workers)
+    end_time = time.time()
+    print(summary.to_string(index=False))
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -0,0 +1,190 @@
+""" This code estimates empirical uncertainties for the combined velocity field.
+The median velocities computed by combine_vel.py come with median formal
+uncertainties only, so here the contributing solutions of each group of
+collocated stations (after IQR outlier removal) are resampled with a bootstrap
+(or left out one at a time with a jackknife) to obtain confidence intervals for
+the median East, North and Up velocities. Groups are processed in padded
+matrices (bucketed by group size) and the chunks are distributed across a
+process pool. Every chunk draws from its own child seed of a single
+SeedSequence, so results are reproducible regardless of the number of workers.
+The output is a CSV file in the statistics folder of the combined velocities."""
+
+""" Import necessary modules """
+import os
+import argparse
+import warnings
+import concurrent.futures
+import time
+import numpy as np
+import pandas as pd
+from station_index import (read_combination_table, group_close_stations, padded_group_indices,
+                           take_padded, padded_median, grouped_iqr_inliers, frame_name)
+from run_manifest import atomic_to_csv, RunManifest
+
+COMPONENTS = ['E', 'N', 'U']
+
+def compact_inliers(values, inliers):
+    """ Move the inlier solutions of each group to the front of the padded matrix,
+    so that resampling only needs the number of inliers per group. `values` has
+    shape (groups, width, components) and `inliers` shape (groups, width)."""
+    order = np.argsort(~inliers, axis=1, kind='stable')
+    compacted = np.take_along_axis(values, order[..., None], axis=1)
+    counts = inliers.sum(axis=1)
+    padding = np.arange(values.shape[1])[None, :] >= counts[:, None]
+    compacted[padding] = np.nan
+    return compacted, counts
+
+def bootstrap_chunk(values, counts, n_resamples, confidence, seed, max_cells=4_000_000):
+    """ Bootstrap the median of each group and component. `values` are compacted
+    inliers of shape (groups, width, components) with NaN padding and `counts` the
+    number of inliers per group. Resamples are drawn in batches to bound memory.
+    Returns the lower and upper confidence limits and the standard error, each of
+    shape (groups, components)."""
+    rng = np.random.default_rng(seed)
+    n_groups, width, n_comp = values.shape
+    batch = max(1, max_cells // max(1, n_groups * width * n_comp))
+    medians = np.empty((n_resamples, n_groups, n_comp))
+    group_rows = np.arange(n_groups)[None, :, None]
+    columns = np.arange(width)[None, None, :]
+
+    with warnings.catch_warnings():
+        # Groups without non-zero verticals give 'All-NaN slice' warnings
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for start in range(0, n_resamples, batch):
+            stop = min(start + batch, n_resamples)
+            draws = np.floor(rng.random((stop - start, n_groups, width)) * counts[None, :, None]).astype(np.int64)
+            samples = values[group_rows, draws]
+            # Only the first `count` draws of each group belong to the resample
+            samples[np.broadcast_to(columns >= counts[None, :, None], draws.shape)] = np.nan
+            medians[start:stop] = padded_median(samples, axis=2)
+
+        alpha = (1.0 - confidence) / 2.0
+        lower, upper = np.nanpercentile(medians, [100 * alpha, 100 * (1 - alpha)], axis=0)
+        std_error = np.nanstd(medians, axis=0, ddof=1)
+    return lower, upper, std_error
+
+def jackknife_chunk(values, counts, confidence):
+    """ Jackknife (leave-one-out) estimate of the standard error of the median of
+    each group and component, with a normal-theory confidence interval around the
+    full-sample median. Same input layout and return values as bootstrap_chunk."""
+    from scipy.stats import norm
+    n_groups, width, n_comp = values.shape
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        # Leave out one solution at a time to keep memory at (groups, width, components)
+        estimates = np.full((n_groups, width, n_comp), np.nan)
+        for i in range(width):
+            left_out = values.copy()
+            left_out[:, i, :] = np.nan
+            estimates[:, i, :] = padded_median(left_out, axis=1)
+        # Only the finite values of each component are left out: padding, and vertical
+        # velocities of solutions without verticals (NaN) give no estimate
+        finite = np.isfinite(values)
+        estimates[~finite] = np.nan
+
+        n = finite.sum(axis=1).astype(float)
+        mean_estimate = np.nanmean(estimates, axis=1)
+        std_error = np.sqrt((n - 1) / n * np.nansum((estimates - mean_estimate[:, None, :]) ** 2, axis=1))
+        std_error[n < 2] = np.nan
+
+        z_value = norm.ppf(1 - (1.0 - confidence) / 2.0)
+        median = padded_median(values, axis=1)
+    return median - z_value * std_error, median + z_value * std_error, std_error
+
+def process_chunk(task):
+    """ Worker entry point: run the selected resampling method on one chunk."""
+    values, counts, method, n_resamples, confidence, seed = task
+    if method == 'jackknife':
+        return jackknife_chunk(values, counts, confidence)
+    return bootstrap_chunk(values, counts, n_resamples, confidence, seed)
+
+def bootstrap_combined_uncertainties(input_folder, combined_folder, method='bootstrap', n_resamples=2000,
+                                     confidence=0.95, seed=42, workers=None, table=None):
+    """ The bootstrap_combined_uncertainties function reads the same input folder
+    used by combine_velocities, groups collocated stations, removes outliers with
+    the IQR method and estimates confidence intervals of the median velocities.
+    The resulting table (one row per combined station) is saved as
+    statistics/site_uncertainties_<frame>.csv inside the combined folder. A
+    StationTable already read from the input folder can be passed as `table`."""
+    if table is None:
+        table = read_combination_table(input_folder)
+    file_names = sorted(f for f in os.listdir(input_folder) if f.endswith('.vel'))
+    labels = group_close_stations(table['Lon'], table['Lat'])
+    n_groups = labels.max() + 1 if len(labels) else 0
+    print(f"Number of groups of close stations: {n_groups}")
+
+    # Vertical velocities equal to zero mean that no vertical was estimated
+    velocities = np.column_stack([table.column64(name) for name in ('E.vel', 'N.vel', 'U.vel')])
+    velocities[velocities[:, 2] == 0, 2] = np.nan
+
+    # Prepare one task per padded chunk of groups
+    chunk_ids, tasks = [], []
+    chunks = list(padded_group_indices(labels))
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    num_used = np.zeros(n_groups, dtype=np.int64)
+    for (ids, index), child_seed in zip(chunks, seeds):
+        padded = take_padded(velocities, index)
+        inliers = grouped_iqr_inliers(padded[..., 0], padded[..., 1])
+        values, counts = compact_inliers(padded, inliers)
+        num_used[ids] = counts
+        chunk_ids.append(ids)
+        tasks.append((values, counts, method, n_resamples, confidence, child_seed))
+
+    lower = np.full((n_groups, 3), np.nan)
+    upper = np.full((n_groups, 3), np.nan)
+    std_error = np.full((n_groups, 3), np.nan)
+    median = np.full((n_groups, 3), np.nan)
+    for ids, task in zip(chunk_ids, tasks):
+        median[ids] = padded_median(task[0], axis=1)
+
+    # Distribute the chunks across a process pool (results keep the task order)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for ids, (lo, hi, se) in zip(chunk_ids, executor.map(process_chunk, tasks)):
+            lower[ids], upper[ids], std_error[ids] = lo, hi, se
+
+    # The first row of each group is the station chosen by combine_vel.py
+    first_rows = np.unique(labels, return_index=True)[1]
+    chosen = table.take(first_rows)
+
+    results = pd.DataFrame({
+        'Lon': np.round(chosen['Lon'], 5),
+        'Lat': np.round(chosen['Lat'], 5),
+        'Stat': chosen['Stat'],
+        'Num': np.bincount(labels, minlength=n_groups),
+        'Num.used': num_used,
+    })
+    for k, component in enumerate(COMPONENTS):
+        results[f'{component}.vel'] = np.round(median[:, k], 2)
+        results[f'{component}.lo'] = np.round(lower[:, k], 2)
+        results[f'{component}.hi'] = np.round(upper[:, k], 2)
+        results[f'{component}.se'] = np.round(std_error[:, k], 3)
+
+    statistics_folder = os.path.join(combined_folder, "statistics")
+    os.makedirs(statistics_folder, exist_ok=True)
+    output_file = os.path.join(statistics_folder, f"site_uncertainties_{frame_name(input_folder, file_names)}.csv")
+    manifest = RunManifest(combined_folder, 'bootstrap')
+    manifest.add_inputs([os.path.join(input_folder, file_name) for file_name in file_names])
+    atomic_to_csv(results, output_file, manifest, sep=',', index=False)
+    manifest.save()
+    print(f"Empirical uncertainties ({method}): {output_file}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bootstrap or jackknife uncertainties of the combined GNSS velocities.')
+    parser.add_argument('input_folder', help='Path to the folder with the .vel files used by combine_vel.py')
+    parser.add_argument('combined_folder', help='Path to the combined velocities folder')
+    parser.add_argument('--method', choices=['bootstrap', 'jackknife'], default='bootstrap', help='Resampling method')
+    parser.add_argument('--n_resamples', type=int, default=2000, help='Number of bootstrap resamples')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the random number generator')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args()
+
+    # Time the execution of the bootstrap_combined_uncertainties function
+    start_time = time.time()
+    bootstrap_combined_uncertainties(args.input_folder, args.combined_folder, method=args.method,
+                                     n_resamples=args.n_resamples, confidence=args.confidence,
+                                     seed=args.seed, workers=args.workers)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -2,26 +2,15 @@ import argparse
 import json
 import os
 import sys
-import glob
 import pandas as pd
 import numpy as np
 from scipy.stats import lognorm
 import concurrent.futures
 import time
-
-print() # Print a newline for better readability
-print(f"################### Removing outliers using the Z-Score method ###################")
-
-def haversine_distance(lon1, lat1, lon2, lat2):
-    # Convert latitude and longitude from degrees to radians
-    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arcsin(np.sqrt(a))
-    radius = 6371  # Earth's radius in kilometers
-    return radius * c
+from run_manifest import discover_inputs, atomic_to_csv, RunManifest
+from output_writer import OutputWriter
+from geodesy_kernels import (neighbour_lists, neighbour_mean_std, incoherent_neighbours, knn_neighbours,
+                             padded_neighbour_mean_std, padded_incoherent_neighbours)
 
 def get_region_stringency(lon, lat, regions):
     default_sigma = 2  # Default sigma level
@@ -31,62 +20,67 @@ def get_region_stringency(lon, lat, regions):
             return region['sigma']
     return default_sigma
 
-def filter_gps_velocities(file_name, radius=20, geo_strict=False, regions=[], special_case_file=None):
-    # Read the CSV file as a data frame, skipping the header row
-    df = pd.read_csv(file_name, sep=' ', skiprows=1, header=None)
-    df.columns = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
-    
-    # Empty set to store filtered stations
-    filtered_stations = set()
-
-    # Iterate over each GPS site
-    for i, row in df.iterrows():
-        site_lon, site_lat = row['Lon'], row['Lat']
-        
-        # Apply variable stringency if enabled, otherwise use default sigma level (2)
-        sigma_level = get_region_stringency(site_lon, site_lat, regions) if geo_strict else 2
-
-        # Calculate the Haversine distance between the GPS site and all stations
-        distances = haversine_distance(site_lon, site_lat, df['Lon'].values, df['Lat'].values)
-        # Filter stations that fall within the specified radius (strict adherence)
-        nearby_stations = df[distances <= radius]
-
-        # Proceed if there are more than 5 nearby stations
-        if len(nearby_stations) >= 5:
-            # Calculate mean and standard deviation of nearby stations' E.vel and N.vel
-            e_vel_mean = nearby_stations['E.vel'].mean()
-            e_vel_std = nearby_stations['E.vel'].std()
-            n_vel_mean = nearby_stations['N.vel'].mean()
-            n_vel_std = nearby_stations['N.vel'].std()
-
-            e_vel_threshold = sigma_level * e_vel_std
-            n_vel_threshold = sigma_level * n_vel_std
-            # Filter stations with velocities outside the threshold
-            filtered_stations.update(nearby_stations[
-                (nearby_stations['E.vel'] < e_vel_mean - e_vel_threshold) |
-                (nearby_stations['E.vel'] > e_vel_mean + e_vel_threshold) |
-                (nearby_stations['N.vel'] < n_vel_mean - n_vel_threshold) |
-                (nearby_stations['N.vel'] > n_vel_mean + n_vel_threshold)
-            ].index)
-
-    # Output results
-    output_folder = './results/sites_excluded_coherence'
+def region_sigma_levels(lon, lat, regions):
+    """ Sigma level of every station: that of the first region containing it (as in
+    get_region_stringency), or the default sigma level (2) outside all regions."""
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    sigma_level = np.full(len(lon), 2.0)
+    assigned = np.zeros(len(lon), dtype=bool)
+    for region in regions:
+        inside = ((region['min_lon'] <= lon) & (lon <= region['max_lon']) &
+                  (region['min_lat'] <= lat) & (lat <= region['max_lat']) & ~assigned)
+        sigma_level[inside] = region['sigma']
+        assigned |= inside
+    return sigma_level
+
+def coherence_outliers(lon, lat, velocities, radius=20, sigma_level=2.0, neighbourhoods=None, knn=None, max_distance=None):
+    """ Flag the stations whose E.vel or N.vel fall outside mean +/- sigma_level * std
+    of the neighbourhood of any site with at least 5 nearby stations. By default,
+    the neighbourhood of a site holds the stations within `radius` km. With `knn`,
+    it holds the knn nearest stations (including the site), optionally only those
+    within `max_distance` km, so that sparse networks are filtered too and dense
+    clusters do not produce very large neighbourhoods. Precomputed neighbourhoods
+    (offsets and neighbours from geodesy_kernels.neighbour_lists, or an index
+    matrix from geodesy_kernels.knn_neighbours) can be passed to avoid rebuilding them."""
+    sigma_level = np.broadcast_to(np.asarray(sigma_level, dtype=float), (len(lon),))
+    if knn is not None or isinstance(neighbourhoods, np.ndarray):
+        # Fixed-width neighbourhoods, with statistics computed in blocks of rows
+        index = neighbourhoods if neighbourhoods is not None else knn_neighbours(lon, lat, knn, max_distance)
+        num_nearby, vel_mean, vel_std = padded_neighbour_mean_std(index, velocities)
+        flag = lambda lower, upper, active: padded_incoherent_neighbours(index, velocities, lower, upper, active)
+    else:
+        # Stations within the radius of every GPS site (strict adherence), including the site itself
+        offsets, neighbours = neighbourhoods if neighbourhoods is not None else neighbour_lists(lon, lat, radius)
+        num_nearby, vel_mean, vel_std = neighbour_mean_std(offsets, neighbours, velocities)
+        flag = lambda lower, upper, active: incoherent_neighbours(offsets, neighbours, velocities, lower, upper, active)
+
+    # Proceed only for sites with at least 5 nearby stations: filter the nearby stations
+    # with velocities outside the threshold of the site
+    vel_threshold = sigma_level[:, None] * vel_std
+    return flag(vel_mean - vel_threshold, vel_mean + vel_threshold, num_nearby >= 5)
+
+def save_coherence_outputs(df, filtered_stations, file_name, excluded_folder, output_folder, manifest=None, writer=None):
+    """ Write the excluded and the remaining stations of a solution, through the
+    background writer if there is one."""
+    os.makedirs(excluded_folder, exist_ok=True)
     os.makedirs(output_folder, exist_ok=True)
-    output_clean_coherence = './results/output_coherence_analysis'
-    os.makedirs(output_clean_coherence, exist_ok=True)
-
-    if special_case_file in file_name:
-        filtered_stations = set() # Do not remove any stations for special case files where we want to preserve all stations
 
     # Save excluded stations
     filtered_df = df.loc[list(filtered_stations)].drop_duplicates()
-    removed_lines_file = os.path.join(output_folder, f'{os.path.splitext(os.path.basename(file_name))[0]}.csv')
-    filtered_df.to_csv(removed_lines_file, sep=' ', index=False)
+    removed_lines_file = os.path.join(excluded_folder, f'{os.path.splitext(os.path.basename(file_name))[0]}.csv')
+    if writer is not None:
+        writer.write_table(filtered_df, removed_lines_file, sep=' ', index=False)
+    else:
+        atomic_to_csv(filtered_df, removed_lines_file, manifest, sep=' ', index=False)
 
     # Save included stations
     included_lines_df = df.drop(list(filtered_stations)).drop_duplicates()
-    included_lines_file = os.path.join(output_clean_coherence, f'{os.path.splitext(os.path.basename(file_name))[0]}.csv')
-    included_lines_df.to_csv(included_lines_file, sep=' ', index=False)
+    included_lines_file = os.path.join(output_folder, f'{os.path.splitext(os.path.basename(file_name))[0]}.csv')
+    if writer is not None:
+        writer.write_table(included_lines_df, included_lines_file, sep=' ', index=False)
+    else:
+        atomic_to_csv(included_lines_df, included_lines_file, manifest, sep=' ', index=False)
 
     # Printing results
     num_removed = len(filtered_df)
@@ -94,15 +88,51 @@ def filter_gps_velocities(file_name, radius=20, geo_strict=False, regions=[], sp
     percentage_removed = (num_removed / num_total) * 100
     text = f"\n----------------------------------------------------------------------------------\nNumber of stations removed for {os.path.basename(file_name)}: {num_removed} / {num_total} ({percentage_removed:.2f}%)\nSites excluded: {removed_lines_file}\nFiltered velocities: {included_lines_file}"
     print(text)
+    return num_removed, num_total
+
+def is_special_case(file_name, special_case_file):
+    """ Special case files keep all their stations (an empty name matches no file)."""
+    return bool(special_case_file) and special_case_file in file_name
+
+def filter_gps_velocities(file_name, radius=20, geo_strict=False, regions=[], special_case_file=None, manifest=None, writer=None,
+                          excluded_folder='./results/sites_excluded_coherence', output_folder='./results/output_coherence_analysis',
+                          knn=None, max_distance=None):
+    # Read the CSV file as a data frame, skipping the header row
+    df = pd.read_csv(file_name, sep=' ', skiprows=1, header=None)
+    df.columns = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+
+    # Apply variable stringency if enabled, otherwise use default sigma level (2)
+    sigma_level = region_sigma_levels(df['Lon'], df['Lat'], regions) if geo_strict else 2.0
+    incoherent = coherence_outliers(df['Lon'].values, df['Lat'].values, df[['E.vel', 'N.vel']].values, radius, sigma_level,
+                                    knn=knn, max_distance=max_distance)
+    filtered_stations = set(df.index[incoherent])
+
+    if is_special_case(file_name, special_case_file):
+        filtered_stations = set() # Do not remove any stations for special case files where we want to preserve all stations
 
-def parallel_filter_gps_velocities(folder_path, radius=20, geo_strict=False, regions=[], special_case_file=None):
-    # Find all CSV files in the folder
-    file_names = glob.glob(os.path.join(folder_path, '*.csv'))
+    # Output results (number of stations removed and number of stations)
+    return save_coherence_outputs(df, filtered_stations, file_name, excluded_folder, output_folder, manifest, writer)
+
+def parallel_filter_gps_velocities(folder_path, radius=20, geo_strict=False, regions=[], special_case_file=None, binary=False,
+                                   excluded_folder='./results/sites_excluded_coherence', output_folder='./results/output_coherence_analysis',
+                                   knn=None, max_distance=None):
+    print() # Print a newline for better readability
+    print(f"################### Removing outliers using the Z-Score method ###################")
+    # Find all CSV files in the folder (sorted, so that runs are reproducible)
+    file_names = discover_inputs(folder_path, '.csv')
+    # Record the checksums of the inputs and outputs next to the filtered velocities
+    manifest = RunManifest(output_folder, 'coherence')
+    manifest.add_inputs(file_names)
+    # The filtering threads hand their tables to a background writer (optionally also as pandas pickles)
+    writer = OutputWriter(manifest, binary=binary)
     # Create a ThreadPoolExecutor with the maximum number of worker threads
     with concurrent.futures.ThreadPoolExecutor() as executor:
         # Submit the filtering tasks for each file to the executor
-        results = [executor.submit(filter_gps_velocities, file_name, radius, geo_strict, regions, special_case_file) for file_name in file_names]
+        results = [executor.submit(filter_gps_velocities, file_name, radius, geo_strict, regions, special_case_file, manifest, writer,
+                                   excluded_folder, output_folder, knn, max_distance) for file_name in file_names]
         concurrent.futures.wait(results)
+    writer.close()
+    manifest.save()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process GNSS data with optional geographic stringency and special case handling.')
@@ -110,6 +140,11 @@ if __name__ == "__main__":
     parser.add_argument('--geo_strict', action='store_true', help='Enable geographic stringency levels based on regions defined in a JSON file')
     parser.add_argument('--regions_json', type=str, help='Path to the JSON file with region definitions', default='')
     parser.add_argument('--special_case_file', type=str, help='File name to handle specially (e.g., skip filtering)', default='')
+    parser.add_argument('--binary', action='store_true', help='Also write the output tables as pandas pickles (.pkl)')
+    parser.add_argument('--excluded_folder', type=str, help='Folder for the sites excluded', default='./results/sites_excluded_coherence')
+    parser.add_argument('--output_folder', type=str, help='Folder for the filtered velocities', default='./results/output_coherence_analysis')
+    parser.add_argument('--knn', type=int, help='Use the K nearest stations as neighbourhood instead of a 20 km radius', default=None)
+    parser.add_argument('--max_distance', type=float, help='Maximum distance (km) of the nearest stations used with --knn', default=None)
 
     args = parser.parse_args()
 
@@ -124,7 +159,8 @@ if __name__ == "__main__":
     
     # Time the execution of the parallel_filter_gps_velocities function
     start_time = time.time()
-    parallel_filter_gps_velocities(args.folder_path, geo_strict=args.geo_strict, regions=regions, special_case_file=args.special_case_file)
+    parallel_filter_gps_velocities(args.folder_path, geo_strict=args.geo_strict, regions=regions, special_case_file=args.special_case_file, binary=args.binary,
+                                   excluded_folder=args.excluded_folder, output_folder=args.output_folder, knn=args.knn, max_distance=args.max_distance)
     end_time = time.time()
     print(f"----------------------------------------------------------------------------------")
     print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -0,0 +1,254 @@
+""" This code detects duplicated and nested solutions across the input velocity
+fields before they are combined. Several compilations republish the stations of
+earlier solutions (e.g. euref_ch8 is part of euref_all, kadirov_rot_karakhanyan_2013
+is karakhanyan_2013 in another frame, and li_2024 contains most of wang_shen_2020),
+and combine_vel.py would then count the same estimate several times in the
+medians of a group and in site_statistics.csv.
+
+Two rows are duplicates if:
+    - Exact duplicates: their coordinates (rounded to coordinate_decimals) and their
+      velocities and uncertainties (rounded to velocity_decimals) are identical. The
+      rounded tuples are hashed, so exact duplicates are found in one pass.
+    - Near duplicates: they are closer than `distance` km, their horizontal
+      uncertainties are identical (within sigma_tolerance, i.e. equal at the two
+      decimals of the files) and their horizontal velocities differ by less than
+      velocity_tolerance (found with a KD-tree, see station_index.py). Each file is
+      aligned/rotated with its own Helmert parameters, which changes republished
+      velocities by ~0.1 mm/yr (for li_2024 and wang_shen_2020 in
+      igb14_no_comb/eura: median 0.09, 90th percentile 0.15 mm/yr), while their
+      uncertainties are unchanged. The default tolerance of 0.3 mm/yr covers these
+      changes, so the detection works on the aligned files used by combine_vel.py
+      as well as on the raw inputs. The identical uncertainties are the key that
+      separates republished rows from independent estimates of the same station.
+Duplicates are merged transitively into clusters. In each cluster, the row of the
+largest solution (most rows, then name) is kept and the other rows are redundant.
+
+Outputs (in the report folder):
+    - overlap_counts.csv: number of rows of each solution (rows) duplicated in each
+      other solution (columns). The diagonal counts duplicates within a file.
+    - overlap_fraction.csv: the same, as a fraction of the rows of each solution.
+    - nested_solutions.csv: pairs of solutions where at least nested_fraction of the
+      rows of one solution are duplicated in the other.
+    - duplicate_rows.csv: every row that belongs to a cluster of duplicates, with
+      the cluster number and whether the row is kept (flag mode).
+If a cleaned folder is given, a copy of every input file without its redundant
+rows is written there (drop mode). The lines kept are copied verbatim, headers
+included, so the cleaned folder can be used as the input of combine_vel.py."""
+
+""" Import necessary modules """
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+from station_index import VEL_COLUMNS, build_station_tree, km_to_chord
+from run_manifest import discover_inputs, atomic_open, atomic_to_csv, RunManifest
+
+KEY_VELOCITY_COLUMNS = ['E.vel', 'N.vel', 'E.sig', 'N.sig']
+
+def count_header_lines(file_path):
+    """ Number of lines at the beginning of a file that do not start with a number
+    (the 4-line header of the rotated files, the column names of the raw files, or
+    none for the igb14 files)."""
+    count = 0
+    with open(file_path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            try:
+                float(fields[0])
+                break
+            except (IndexError, ValueError):
+                count += 1
+    return count
+
+def read_solutions(input_folder):
+    """ Read every .vel file of a folder into one DataFrame with a 'Ref' column (the
+    file name without extension). Returns the DataFrame and the number of header
+    lines of each file."""
+    dfs, header_lines = [], {}
+    for file_path in discover_inputs(input_folder, '.vel'):
+        basename = os.path.splitext(os.path.basename(file_path))[0]
+        header_lines[basename] = count_header_lines(file_path)
+        df = pd.read_csv(file_path, sep=r'\s+', header=None, skiprows=header_lines[basename])
+        df = df.iloc[:, :len(VEL_COLUMNS)]
+        df.columns = VEL_COLUMNS
+        df['Ref'] = basename
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame(columns=VEL_COLUMNS + ['Ref']), header_lines
+    return pd.concat(dfs, ignore_index=True), header_lines
+
+def row_hashes(df, coordinate_decimals=3, velocity_decimals=2):
+    """ 64-bit hash of the rounded (Lon, Lat, E.vel, N.vel, E.sig, N.sig) tuple of
+    every row. Values are rounded to integers first, so that equal tuples always
+    have equal hashes."""
+    quantised = pd.DataFrame({
+        'Lon': np.rint(df['Lon'].to_numpy(dtype=float) * 10 ** coordinate_decimals),
+        'Lat': np.rint(df['Lat'].to_numpy(dtype=float) * 10 ** coordinate_decimals)})
+    for column in KEY_VELOCITY_COLUMNS:
+        quantised[column] = np.rint(df[column].to_numpy(dtype=float) * 10 ** velocity_decimals)
+    return pd.util.hash_pandas_object(quantised.astype(np.int64), index=False).to_numpy()
+
+def exact_duplicate_pairs(hashes):
+    """ Pairs of rows with the same hash, each row paired with the first row of its
+    hash (enough to build the clusters)."""
+    order = np.argsort(hashes, kind='stable')
+    sorted_hashes = hashes[order]
+    first = np.concatenate(([True], sorted_hashes[1:] != sorted_hashes[:-1]))
+    first_row = order[np.flatnonzero(first)[np.cumsum(first) - 1]]
+    duplicated = ~first
+    return np.column_stack((first_row[duplicated], order[duplicated]))
+
+def near_duplicate_pairs(df, distance=0.2, velocity_tolerance=0.3, sigma_tolerance=0.005):
+    """ Pairs of rows closer than `distance` km whose velocities (and uncertainties)
+    differ by less than velocity_tolerance (and sigma_tolerance) mm/yr."""
+    if len(df) < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+    tree = build_station_tree(df['Lon'].to_numpy(dtype=float), df['Lat'].to_numpy(dtype=float))
+    pairs = tree.query_pairs(km_to_chord(distance), output_type='ndarray')
+    keep = np.ones(len(pairs), dtype=bool)
+    for column, tolerance in zip(KEY_VELOCITY_COLUMNS, [velocity_tolerance] * 2 + [sigma_tolerance] * 2):
+        values = df[column].to_numpy(dtype=float)
+        keep &= np.abs(values[pairs[:, 0]] - values[pairs[:, 1]]) <= tolerance
+    return pairs[keep]
+
+def duplicate_clusters(n, pairs):
+    """ Merge duplicate pairs transitively. Returns the cluster label of every row
+    (-1 for rows without duplicates), numbered by their first row."""
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    sizes = np.bincount(labels)
+    duplicated = sizes[labels] > 1
+    clusters = np.full(n, -1, dtype=np.int64)
+    _, clusters[duplicated] = np.unique(labels[duplicated], return_inverse=True)
+    return clusters
+
+def overlap_matrices(refs, clusters, ref_names):
+    """ Number and fraction of the rows of each solution that are duplicated in each
+    other solution (the diagonal counts duplicates within the same solution)."""
+    ref_codes = pd.Categorical(refs, categories=ref_names).codes
+    rows = np.bincount(ref_codes, minlength=len(ref_names))
+    duplicated = clusters >= 0
+    n_clusters = clusters.max() + 1 if duplicated.any() else 0
+    # Number of rows of each solution in each cluster
+    incidence = csr_matrix((np.ones(duplicated.sum()), (clusters[duplicated], ref_codes[duplicated])),
+                           shape=(n_clusters, len(ref_names)))
+    incidence.sum_duplicates()
+    presence = incidence.copy()
+    presence.data = np.ones_like(presence.data)
+    counts = (incidence.T @ presence).toarray()
+    within = incidence.copy()
+    within.data = np.where(within.data > 1, within.data, 0)
+    np.fill_diagonal(counts, np.asarray(within.sum(axis=0)).ravel())
+
+    counts = pd.DataFrame(counts.astype(np.int64), index=ref_names, columns=ref_names)
+    fractions = counts.div(np.maximum(rows, 1), axis=0).round(4)
+    return counts, fractions, pd.Series(rows, index=ref_names)
+
+def nested_solutions(counts, fractions, rows, nested_fraction=0.9):
+    """ Pairs of solutions where at least nested_fraction of the rows of a solution
+    are duplicated in another one."""
+    values = fractions.to_numpy().copy()
+    np.fill_diagonal(values, 0)
+    nested, container = np.nonzero(values >= nested_fraction)
+    names = fractions.index.to_numpy()
+    return pd.DataFrame({'Solution': names[nested], 'Contained_in': names[container],
+                         'Rows': rows.to_numpy()[nested],
+                         'Duplicated_rows': counts.to_numpy()[nested, container],
+                         'Fraction': values[nested, container]})
+
+def kept_rows(refs, clusters, rows):
+    """ Rows to keep: rows without duplicates, and in each cluster the first row of
+    the largest solution (most rows, then name)."""
+    keep = clusters < 0
+    duplicated = np.flatnonzero(~keep)
+    if len(duplicated):
+        ranking = pd.DataFrame({'Cluster': clusters[duplicated], 'Rows': rows[refs[duplicated]].to_numpy(),
+                                'Ref': refs[duplicated], 'Row': duplicated})
+        ranking = ranking.sort_values(['Cluster', 'Rows', 'Ref', 'Row'], ascending=[True, False, True, True])
+        keep[ranking.drop_duplicates('Cluster')['Row'].to_numpy()] = True
+    return keep
+
+def write_cleaned_files(input_folder, cleaned_folder, df, keep, header_lines, manifest=None):
+    """ Copy every input file to the cleaned folder without its redundant rows.
+    Headers and kept lines are copied verbatim."""
+    os.makedirs(cleaned_folder, exist_ok=True)
+    for ref, n_header in header_lines.items():
+        file_keep = keep[(df['Ref'] == ref).to_numpy()]
+        output_path = os.path.join(cleaned_folder, f'{ref}.vel')
+        with open(os.path.join(input_folder, f'{ref}.vel'), 'r') as f_in, atomic_open(output_path, 'w') as f_out:
+            row = 0
+            for i, line in enumerate(f_in):
+                if i < n_header:
+                    f_out.write(line)
+                # Blank lines are skipped when the files are read, so they are not rows
+                elif line.strip():
+                    if file_keep[row]:
+                        f_out.write(line)
+                    row += 1
+        if manifest is not None:
+            manifest.record(output_path)
+
+def detect_duplicates(input_folder, report_folder, cleaned_folder=None, distance=0.2, velocity_tolerance=0.3,
+                      sigma_tolerance=0.005, coordinate_decimals=3, velocity_decimals=2, nested_fraction=0.9):
+    """ Detect the duplicated rows and nested solutions of the .vel files of the input
+    folder, write the reports to report_folder and, if cleaned_folder is given, copies
+    of the input files without their redundant rows. Returns the DataFrame of the
+    duplicated rows."""
+    os.makedirs(report_folder, exist_ok=True)
+    df, header_lines = read_solutions(input_folder)
+    ref_names = list(header_lines)
+
+    exact_pairs = exact_duplicate_pairs(row_hashes(df, coordinate_decimals, velocity_decimals))
+    near_pairs = near_duplicate_pairs(df, distance, velocity_tolerance, sigma_tolerance)
+    clusters = duplicate_clusters(len(df), np.concatenate((exact_pairs, near_pairs)))
+    exact = np.zeros(len(df), dtype=bool)
+    exact[exact_pairs.ravel()] = True
+
+    counts, fractions, rows = overlap_matrices(df['Ref'].to_numpy(), clusters, ref_names)
+    nested = nested_solutions(counts, fractions, rows, nested_fraction)
+    keep = kept_rows(df['Ref'].to_numpy(), clusters, rows)
+
+    duplicates = df[clusters >= 0].copy()
+    duplicates['Cluster'] = clusters[clusters >= 0]
+    duplicates['Exact'] = exact[clusters >= 0]
+    duplicates['Kept'] = keep[clusters >= 0]
+    duplicates = duplicates.sort_values(['Cluster', 'Kept', 'Ref'], ascending=[True, False, True], kind='stable')
+
+    manifest = RunManifest(report_folder, 'deduplicate')
+    manifest.add_inputs(discover_inputs(input_folder, '.vel'))
+    atomic_to_csv(counts, os.path.join(report_folder, 'overlap_counts.csv'), manifest)
+    atomic_to_csv(fractions, os.path.join(report_folder, 'overlap_fraction.csv'), manifest)
+    atomic_to_csv(nested, os.path.join(report_folder, 'nested_solutions.csv'), manifest, index=False)
+    atomic_to_csv(duplicates, os.path.join(report_folder, 'duplicate_rows.csv'), manifest, index=False)
+    if cleaned_folder:
+        write_cleaned_files(input_folder, cleaned_folder, df, keep, header_lines, manifest)
+    manifest.save()
+
+    print(f"Rows: {len(df)} in {len(ref_names)} files")
+    print(f"Duplicated rows: {len(duplicates)} in {clusters.max() + 1 if len(duplicates) else 0} clusters "
+          f"({int(exact.sum())} exact), redundant rows: {int((~keep).sum())}")
+    for row in nested.itertuples(index=False):
+        print(f"{row.Solution} is nested in {row.Contained_in} ({row.Duplicated_rows} of {row.Rows} rows)")
+    return duplicates
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detect duplicated rows and nested solutions across the input velocity fields.')
+    parser.add_argument('input_folder', help='Folder with the .vel files (raw, filtered or rotated/aligned)')
+    parser.add_argument('report_folder', help='Folder where the overlap matrices and the duplicated rows are written')
+    parser.add_argument('--cleaned_folder', default=None, help='Write copies of the input files without their redundant rows to this folder')
+    parser.add_argument('--distance', type=float, default=0.2, help='Maximum distance (km) between near duplicates')
+    parser.add_argument('--velocity_tolerance', type=float, default=0.3, help='Maximum velocity difference (mm/yr) between near duplicates')
+    parser.add_argument('--sigma_tolerance', type=float, default=0.005, help='Maximum uncertainty difference (mm/yr) between near duplicates')
+    parser.add_argument('--nested_fraction', type=float, default=0.9, help='Fraction of duplicated rows above which a solution is nested in another')
+    args = parser.parse_args()
+
+    # Time the execution of the detection
+    start_time = time.time()
+    detect_duplicates(args.input_folder, args.report_folder, args.cleaned_folder, args.distance,
+                      args.velocity_tolerance, args.sigma_tolerance, nested_fraction=args.nested_fraction)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
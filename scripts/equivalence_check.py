@@ -0,0 +1,361 @@
+""" This code checks that faster implementations of the pipeline stages produce the
+same results as the reference implementations. The references are the stages as
+they were before the performance work, frozen in reference_stages.py (the stage
+modules themselves are optimised in place). Test cases are built from fixed
+subsets of raw_input_column_formatted (the first rows of a few solutions with
+collocated stations) and from synthetic velocity fields generated with a fixed
+seed (collocated solutions, noise, outliers and large uncertainties). For each
+case and stage, the reference implementation is run once and its outputs are
+kept as golden outputs; the candidate implementation (by default, the current
+stage) is then run on the same inputs and its outputs are compared with the
+golden ones:
+- logs of excluded sites must contain exactly the same set of sites,
+- tables must have the same columns and the same rows in the same order,
+  numeric columns must agree within a tolerance and text columns exactly
+  (the rows of grouped_stations.csv are matched after sorting, as the rows
+  within a group are listed in input order since station_registry.py).
+Kernels used by the fast code paths (grouping of collocated stations and the
+IQR outlier test) are also checked against reference_stages.py on every case.
+The report lists the status of every check next to the run times and the speedup.
+
+Candidates are given as stage=module:function, e.g.
+    python equivalence_check.py ./results/equivalence --candidate combine=my_combine:combine_velocities
+Golden outputs are kept between runs, and are replaced when the reference of a
+stage changes or with --update_golden."""
+
+""" Import necessary modules """
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import importlib
+import contextlib
+import numpy as np
+import pandas as pd
+from velocity_rotation import VEL_COLUMNS, write_velocity_file
+from run_manifest import discover_inputs
+
+RAW_INPUT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'raw_input_column_formatted')
+DEFAULT_FILES = ['alchalbi_2013', 'gomez_2020', 'graham_2021', 'nocquet_2012']
+FRAME = 'eura'
+
+@contextlib.contextmanager
+def working_directory(path):
+    """ Run a block inside another working directory (for stages writing to
+    paths relative to the current directory)."""
+    previous = os.getcwd()
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def subset_case(files=DEFAULT_FILES, max_rows=300, folder=RAW_INPUT_FOLDER):
+    """ First `max_rows` rows of a fixed list of input solutions."""
+    solutions = {}
+    for name in sorted(files):
+        df = pd.read_csv(os.path.join(folder, f'{name}.vel'), sep=r'\s+', skiprows=1, header=None,
+                         usecols=range(len(VEL_COLUMNS)), names=VEL_COLUMNS)
+        solutions[name] = df.head(max_rows).reset_index(drop=True)
+    return solutions
+
+def synthetic_case(seed=0, n_sites=150, n_solutions=4):
+    """ Synthetic solutions of a smooth velocity field: each solution observes part
+    of the sites with small position and velocity noise, a few outliers, a few
+    large uncertainties and some sites without vertical velocity."""
+    rng = np.random.default_rng(seed)
+    site_lon = rng.uniform(20, 40, n_sites)
+    site_lat = rng.uniform(35, 42, n_sites)
+    solutions = {}
+    for s in range(n_solutions):
+        sites = np.sort(rng.choice(n_sites, size=int(0.6 * n_sites), replace=False))
+        n = len(sites)
+        lon = np.round(site_lon[sites] + rng.normal(0, 0.002, n), 5)
+        lat = np.round(site_lat[sites] + rng.normal(0, 0.002, n), 5)
+        e_sig = np.round(rng.lognormal(np.log(0.5), 0.4, n), 2)
+        n_sig = np.round(rng.lognormal(np.log(0.5), 0.4, n), 2)
+        e_vel = 10 + 0.2 * (site_lon[sites] - 30) + rng.normal(0, 0.3, n)
+        n_vel = 15 - 0.3 * (site_lat[sites] - 38) + rng.normal(0, 0.3, n)
+        outliers = rng.random(n) < 0.03
+        e_vel[outliers] += rng.choice([-5, 5], outliers.sum())
+        large = rng.random(n) < 0.02
+        e_sig[large] *= 10
+        u_vel = np.where(rng.random(n) < 0.3, 0.0, np.round(rng.normal(0, 1, n), 2))
+        solutions[f'synthetic{seed}_{s}'] = pd.DataFrame({
+            'Lon': lon, 'Lat': lat, 'E.vel': np.round(e_vel, 2), 'N.vel': np.round(n_vel, 2),
+            'E.adj': 0.0, 'N.adj': 0.0, 'E.sig': e_sig, 'N.sig': n_sig, 'Corr': 0.001,
+            'U.vel': u_vel, 'U.adj': u_vel, 'U.sig': np.round(rng.lognormal(np.log(1.0), 0.3, n), 2),
+            'Stat': [f'S{site:03d}_GPS' for site in sites],
+        })
+    return solutions
+
+def write_case_inputs(solutions, folder):
+    """ Write the solutions of a case in the input format of every stage."""
+    paths = {name: os.path.join(folder, name) for name in ('combine', 'lognorm', 'coherence', 'scale')}
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    os.makedirs(os.path.join(paths['combine'], FRAME), exist_ok=True)
+    header = ["* Equivalence check input", "* Rotation Pole 0 0 0 deg/Myr", "* columns", "* units"]
+    for name, df in solutions.items():
+        write_velocity_file(df, os.path.join(paths['combine'], FRAME, f'{name}_{FRAME}.vel'), header)
+        write_velocity_file(df, os.path.join(paths['lognorm'], f'{name}.vel'), [' '.join(VEL_COLUMNS)])
+        df.to_csv(os.path.join(paths['coherence'], f'{name}.csv'), sep=' ', index=False)
+        df.to_csv(os.path.join(paths['scale'], f'{name}.csv'), sep=' ', index=False)
+    paths['combine'] = os.path.join(paths['combine'], FRAME)
+    paths['scale_reference'] = os.path.join(paths['scale'], f'{sorted(solutions)[0]}.csv')
+    return paths
+
+""" Stage runners: call an implementation with the stage signature, writing into output_folder """
+
+def run_combine(function, inputs, output_folder):
+    function(inputs['combine'], output_folder)
+
+def run_lognorm(function, inputs, output_folder):
+    function(inputs['lognorm'], os.path.join(output_folder, 'sites_excluded_lognorm_99'),
+             os.path.join(output_folder, 'output_lognorm_99_filtered'), os.path.join(output_folder, 'figures'))
+
+def run_coherence(function, inputs, output_folder):
+    # coherence_filter.py writes to ./results/... relative to the working directory
+    with working_directory(output_folder):
+        function(inputs['coherence'], special_case_file='<no special case>')
+
+def run_scale(function, inputs, output_folder):
+    with working_directory(output_folder):
+        os.makedirs(os.path.join('results', 'figures'), exist_ok=True)
+        function(inputs['scale'], inputs['scale_reference'], os.path.join(output_folder, 'scaled'))
+
+def filter_files_directly(folder_path, log_output_folder, output_folder, figure_folder):
+    """ lognorm_filter.filter_file called on every file without a writer (the way
+    other scripts can call it), with the signature of filter_and_plot_data."""
+    from lognorm_filter import filter_file
+    for file_name in discover_inputs(folder_path, '.vel'):
+        filter_file(file_name, log_output_folder, output_folder, figure_folder)
+
+# Stage: (reference implementation, default candidate, runner)
+STAGES = {
+    'combine': ('reference_stages:combine_velocities', 'combine_vel:combine_velocities', run_combine),
+    'lognorm': ('reference_stages:filter_and_plot_data', 'lognorm_filter:filter_and_plot_data', run_lognorm),
+    'lognorm_file': ('reference_stages:filter_and_plot_data', 'equivalence_check:filter_files_directly', run_lognorm),
+    'coherence': ('reference_stages:parallel_filter_gps_velocities', 'coherence_filter:parallel_filter_gps_velocities', run_coherence),
+    'scale': ('reference_stages:harmonise_uncertainties', 'uncertainty_scaling_combined:harmonise_uncertainties', run_scale),
+}
+
+def load_function(spec):
+    """ Import a function given as module:function."""
+    module_name, function_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+def run_stage(stage, spec, inputs, output_folder):
+    """ Run one implementation of a stage into a clean output folder and return the
+    elapsed time in seconds (console output of the stage is discarded)."""
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    function = load_function(spec)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        STAGES[stage][2](function, inputs, os.path.abspath(output_folder))
+        elapsed = time.perf_counter() - start_time
+    return elapsed
+
+def output_files(folder):
+    """ Relative paths of the table and log files written by a stage (figures,
+    manifests and lock files skipped; glob skips hidden files)."""
+    files = []
+    for path in glob.glob(os.path.join(folder, '**', '*'), recursive=True):
+        if os.path.isfile(path) and not path.endswith(('.pdf', '.png', '.jpg', '.json', '.lock')):
+            files.append(os.path.relpath(path, folder))
+    return sorted(files)
+
+def read_output_table(path):
+    """ Read an output table, detecting the separator from the header line."""
+    with open(path, 'r') as f:
+        header = f.readline()
+    if not header.strip():
+        return pd.DataFrame()
+    sep = ',' if ',' in header else '\t' if '\t' in header else r'\s+'
+    return pd.read_csv(path, sep=sep)
+
+def is_exclusion_log(relative_path):
+    """ Logs of excluded or removed sites are compared as sets of sites."""
+    return 'excluded' in relative_path or relative_path.endswith('_removed.log')
+
+def is_ordered(relative_path):
+    """ Tables whose row order is checked (all but grouped_stations.csv, whose rows
+    within a group are listed in input order rather than in make_groups order)."""
+    return os.path.basename(relative_path) != 'grouped_stations.csv'
+
+def compare_tables(reference, candidate, atol, as_set, ordered=True):
+    """ Compare two tables. Returns (ok, message, max_abs_diff)."""
+    if list(reference.columns) != list(candidate.columns):
+        return False, f"columns differ: {list(reference.columns)} vs {list(candidate.columns)}", np.nan
+    if as_set:
+        keys = [c for c in ('Stat', 'Lon', 'Lat') if c in reference.columns] or list(reference.columns)
+        reference_set = set(map(tuple, reference[keys].astype(str).values))
+        candidate_set = set(map(tuple, candidate[keys].astype(str).values))
+        if reference_set != candidate_set:
+            return False, f"{len(reference_set - candidate_set)} missing, {len(candidate_set - reference_set)} extra sites", np.nan
+        return True, f"{len(reference_set)} sites", 0.0
+    if len(reference) != len(candidate):
+        return False, f"{len(reference)} vs {len(candidate)} rows", np.nan
+    columns = list(reference.columns)
+    if not ordered:
+        # Rows are matched after sorting on every column, so row order does not matter
+        reference = reference.sort_values(columns, kind='stable').reset_index(drop=True)
+        candidate = candidate.sort_values(columns, kind='stable').reset_index(drop=True)
+    max_diff = 0.0
+    for column in columns:
+        if pd.api.types.is_numeric_dtype(reference[column]) and pd.api.types.is_numeric_dtype(candidate[column]):
+            a, b = reference[column].to_numpy(dtype=float), candidate[column].to_numpy(dtype=float)
+            if not np.array_equal(np.isnan(a), np.isnan(b)):
+                return False, f"NaN pattern differs in {column}", np.nan
+            diff = np.nanmax(np.abs(a - b), initial=0.0)
+            max_diff = max(max_diff, diff)
+            if diff > atol:
+                return False, f"{column} differs by up to {diff:g}", diff
+        elif not reference[column].astype(str).equals(candidate[column].astype(str)):
+            return False, f"values differ in {column}", np.nan
+    return True, f"{len(reference)} rows", max_diff
+
+def compare_outputs(reference_folder, candidate_folder, atol):
+    """ Compare every output file of a stage. Returns a list of (file, ok, message, max_diff)."""
+    results = []
+    reference_files = output_files(reference_folder)
+    candidate_files = set(output_files(candidate_folder))
+    for relative_path in reference_files:
+        if relative_path not in candidate_files:
+            results.append((relative_path, False, "missing", np.nan))
+            continue
+        reference = read_output_table(os.path.join(reference_folder, relative_path))
+        candidate = read_output_table(os.path.join(candidate_folder, relative_path))
+        results.append((relative_path, *compare_tables(reference, candidate, atol, is_exclusion_log(relative_path),
+                                                       is_ordered(relative_path))))
+    for relative_path in sorted(candidate_files - set(reference_files)):
+        # Outputs added since the reference (e.g. statistics/site_registry.csv) have nothing to be compared with
+        results.append((relative_path, True, "new output, not written by the reference", np.nan))
+    return results
+
+def check_kernels(solutions):
+    """ Check the grouping and IQR kernels of the fast code paths against the
+    reference functions of reference_stages.py. Returns a list of (check, ok, message, time_ref, time_new)."""
+    import reference_stages
+    from station_registry import StationRegistry
+    from geodesy_kernels import group_iqr_inliers
+
+    merged = pd.concat(list(solutions.values()), ignore_index=True)
+    stations = merged[['Lon', 'Lat']].values
+    start_time = time.perf_counter()
+    distance_dict = reference_stages.create_distance_dict(stations)
+    reference_groups = reference_stages.make_groups([(i, j) for i, neighbours in distance_dict.items() for j in neighbours])
+    time_ref = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    registry = StationRegistry.from_dataframe(merged)
+    groups = registry.groups()
+    time_new = time.perf_counter() - start_time
+    same_groups = sorted(map(sorted, reference_groups)) == sorted(groups)
+    results = [('groups', same_groups, f"{len(groups)} groups", time_ref, time_new)]
+
+    start_time = time.perf_counter()
+    reference_inliers = set()
+    for group in reference_groups:
+        if len(group) > 1:
+            # If every station is an outlier, remove_outliers returns the medians and keeps the whole group
+            _, outliers = reference_stages.remove_outliers(merged.loc[group, ['E.vel', 'N.vel', 'U.vel']])
+            reference_inliers.update(set(group) - set(outliers.index))
+        else:
+            reference_inliers.update(group)
+    time_ref = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    inliers = set(np.flatnonzero(group_iqr_inliers(merged['E.vel'], merged['N.vel'], registry.site_labels)).tolist())
+    time_new = time.perf_counter() - start_time
+    results.append(('iqr', reference_inliers == inliers, f"{len(inliers)} inliers", time_ref, time_new))
+    return results
+
+def run_checks(output_folder, cases, stages, candidates, atol=1e-6, update_golden=False, kernels=True):
+    """ Run the reference (or reuse its golden outputs) and the candidates of every
+    stage on every case, and return the report as a DataFrame."""
+    rows = []
+    for case_name, solutions in cases.items():
+        case_folder = os.path.join(output_folder, case_name)
+        inputs = write_case_inputs(solutions, os.path.join(case_folder, 'inputs'))
+
+        # The reference kernels compare all pairs of stations, so they can be skipped for large cases
+        kernel_results = []
+        if kernels:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                kernel_results = check_kernels(solutions)
+        for check, ok, message, time_ref, time_new in kernel_results:
+            rows.append({'Case': case_name, 'Stage': f'kernel:{check}', 'File': '', 'Status': 'PASS' if ok else 'FAIL',
+                         'Details': message, 'Max.diff': 0.0 if ok else np.nan, 'Time.ref': time_ref, 'Time.new': time_new})
+
+        for stage in stages:
+            reference_spec, default_spec, _ = STAGES[stage]
+            candidate_spec = candidates.get(stage, default_spec)
+            golden_folder = os.path.join(case_folder, 'golden', stage)
+            timing_file = os.path.join(golden_folder, 'timing.json')
+            golden = {}
+            if not update_golden and os.path.exists(timing_file):
+                with open(timing_file, 'r') as f:
+                    golden = json.load(f)
+            if golden.get('reference') != reference_spec:
+                time_ref = run_stage(stage, reference_spec, inputs, golden_folder)
+                with open(timing_file, 'w') as f:
+                    json.dump({'reference': reference_spec, 'seconds': time_ref}, f)
+            else:
+                time_ref = golden['seconds']
+            candidate_folder = os.path.join(case_folder, 'candidate', stage)
+            time_new = run_stage(stage, candidate_spec, inputs, candidate_folder)
+            for relative_path, ok, message, max_diff in compare_outputs(golden_folder, candidate_folder, atol):
+                rows.append({'Case': case_name, 'Stage': stage, 'File': relative_path, 'Status': 'PASS' if ok else 'FAIL',
+                             'Details': message, 'Max.diff': max_diff, 'Time.ref': time_ref, 'Time.new': time_new})
+
+    report = pd.DataFrame(rows, columns=['Case', 'Stage', 'File', 'Status', 'Details', 'Max.diff', 'Time.ref', 'Time.new'])
+    report['Speedup'] = report['Time.ref'] / report['Time.new']
+    return report
+
+def print_report(report):
+    """ Print one line per stage and case, with the failures listed below."""
+    summary = report.groupby(['Case', 'Stage'], sort=False).agg(
+        Files=('Status', 'size'), Failed=('Status', lambda s: int((s == 'FAIL').sum())),
+        Time_ref=('Time.ref', 'first'), Time_new=('Time.new', 'first'), Speedup=('Speedup', 'first')).reset_index()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"{'Case':<14}{'Stage':<16}{'Status':<8}{'Checks':>7}{'Ref (s)':>10}{'New (s)':>10}{'Speedup':>9}")
+    for row in summary.itertuples(index=False):
+        status = 'PASS' if row.Failed == 0 else 'FAIL'
+        print(f"{row.Case:<14}{row.Stage:<16}{status:<8}{row.Files:>7}{row.Time_ref:>10.3f}{row.Time_new:>10.3f}{row.Speedup:>8.1f}x")
+    failures = report[report['Status'] == 'FAIL']
+    for row in failures.itertuples(index=False):
+        print(f"FAIL {row.Case} {row.Stage} {row.File}: {row.Details}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check faster implementations of the pipeline stages against the reference ones.')
+    parser.add_argument('output_folder', help='Folder for the test inputs, golden outputs, candidate outputs and report')
+    parser.add_argument('--stages', nargs='*', choices=list(STAGES), default=list(STAGES), help='Stages to check')
+    parser.add_argument('--candidate', action='append', default=[], metavar='STAGE=MODULE:FUNCTION',
+                        help='Candidate implementation of a stage (same signature as the reference; default: the current stage)')
+    parser.add_argument('--files', nargs='*', default=DEFAULT_FILES, help='Solutions of raw_input_column_formatted used in the subset case')
+    parser.add_argument('--max_rows', type=int, default=300, help='Rows taken from each solution in the subset case')
+    parser.add_argument('--seeds', type=int, nargs='*', default=[0, 1], help='Seeds of the synthetic cases')
+    parser.add_argument('--atol', type=float, default=1e-6, help='Absolute tolerance of numeric columns')
+    parser.add_argument('--skip_kernels', action='store_true', help='Do not check the grouping and IQR kernels (slow for large cases)')
+    parser.add_argument('--update_golden', action='store_true', help='Run the reference again and replace the golden outputs')
+    args = parser.parse_args()
+
+    candidates = dict(spec.split('=', 1) for spec in args.candidate)
+    cases = {'subset': subset_case(args.files, args.max_rows)}
+    cases.update({f'synthetic{seed}': synthetic_case(seed) for seed in args.seeds})
+
+    start_time = time.time()
+    report = run_checks(os.path.abspath(args.output_folder), cases, args.stages, candidates, args.atol, args.update_golden,
+                        not args.skip_kernels)
+    report_file = os.path.join(args.output_folder, 'equivalence_report.csv')
+    report.to_csv(report_file, sep=',', index=False)
+    print_report(report)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Report: {report_file}")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
+    sys.exit(0 if (report['Status'] == 'PASS').all() else 1)
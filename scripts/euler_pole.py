@@ -0,0 +1,231 @@
+""" This code estimates Euler poles of tectonic blocks from a combined velocity
+field (e.g. combined_vel_igb14.csv). Blocks are defined by polygons in a JSON
+file (a list of objects with 'name' and 'polygon' ([[lon, lat], ...]) keys).
+The stations of every block are selected at once: the bounding boxes of the
+polygons are indexed with the packed R-tree of postseismic_filter.py and the
+candidate stations are tested against each polygon. The horizontal velocities
+of each block are then fitted with a rigid rotation (3 Cartesian rotation rates)
+by weighted least squares. The normal equations of all blocks are accumulated
+and solved together as one stack of 3 x 3 systems, with stations whose
+normalised residuals exceed n_sigma removed iteratively. The uncertainties of
+the poles are given by the formal covariance (scaled by the reduced chi-square
+when it is larger than 1) and by a delete-one jackknife over the stations of
+each block, also solved as a stack of systems.
+
+The poles are written in the format read by velocity_rotation.py (name wx wy wz
+in deg/Myr), so that the velocities can be rotated to the estimated block-fixed
+frames directly, together with a summary table (geographic pole, rotation rate
+and uncertainties)."""
+
+""" Import necessary modules """
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from matplotlib.path import Path
+from postseismic_filter import BoxTree, normalise_longitude
+from velocity_rotation import helmert_design
+
+def read_block_polygons(blocks_file):
+    """ Read block polygons from a JSON file as a list of (name, vertices) tuples,
+    with longitudes wrapped to [-180, 180)."""
+    with open(blocks_file, 'r') as file:
+        blocks = json.load(file)
+    polygons = []
+    for block in blocks:
+        vertices = np.asarray(block['polygon'], dtype=float)
+        vertices[:, 0] = normalise_longitude(vertices[:, 0])
+        polygons.append((block['name'], vertices))
+    return polygons
+
+def select_block_stations(lon, lat, polygons):
+    """ Return the (station, block) pairs of the stations lying inside each block
+    polygon. Candidates come from the R-tree over the polygon bounding boxes."""
+    lon = normalise_longitude(lon)
+    boxes = np.array([[v[:, 0].min(), v[:, 1].min(), v[:, 0].max(), v[:, 1].max()] for _, v in polygons]).reshape(-1, 4)
+    stations, blocks = BoxTree(boxes).query_points(lon, lat)
+    inside = np.zeros(len(stations), dtype=bool)
+    for block in np.unique(blocks):
+        pairs = np.flatnonzero(blocks == block)
+        inside[pairs] = Path(polygons[block][1]).contains_points(np.column_stack((lon[stations[pairs]], lat[stations[pairs]])))
+    order = np.lexsort((stations[inside], blocks[inside]))
+    return stations[inside][order], blocks[inside][order]
+
+def rotation_design(lon, lat):
+    """ Design matrix of the E and N velocities (mm/yr) with respect to the rotation
+    rates (deg/Myr), with shape (n, 2, 3)."""
+    design_e, design_n = helmert_design(lon, lat)
+    return np.stack((design_e[:, 3:], design_n[:, 3:]), axis=1)
+
+def solve_stacked(normal, rhs):
+    """ Solve a stack of 3 x 3 normal equations; singular systems give NaN."""
+    solution = np.full(rhs.shape, np.nan)
+    solvable = np.abs(np.linalg.det(normal)) > 1e-12 * np.einsum('bii->b', normal) ** 3
+    if solvable.any():
+        solution[solvable] = np.linalg.solve(normal[solvable], rhs[solvable][..., None])[..., 0]
+    return solution
+
+def estimate_poles(lon, lat, velocities, sigmas, blocks, n_blocks, n_sigma=3.0, max_iterations=10, min_stations=3):
+    """ Estimate the rotation rates of all blocks. `velocities` and `sigmas` have
+    shape (n, 2) (E, N) and `blocks` gives the block of every observation.
+    Returns the rotation rates (n_blocks, 3), their covariances, the mask of the
+    observations kept, the weighted residuals, the reduced chi-square and the
+    contributions of each station to the normal equations (for the jackknife)."""
+    design = rotation_design(lon, lat)
+    weighted_design = design / sigmas[..., None]
+    weighted_obs = velocities / sigmas
+    # Contributions of each station to the normal equations
+    station_normal = np.einsum('nci,ncj->nij', weighted_design, weighted_design)
+    station_rhs = np.einsum('nci,nc->ni', weighted_design, weighted_obs)
+
+    keep = np.ones(len(lon), dtype=bool)
+    for _ in range(max_iterations):
+        normal = np.zeros((n_blocks, 3, 3))
+        rhs = np.zeros((n_blocks, 3))
+        np.add.at(normal, blocks[keep], station_normal[keep])
+        np.add.at(rhs, blocks[keep], station_rhs[keep])
+        omega = solve_stacked(normal, rhs)
+        omega[np.bincount(blocks[keep], minlength=n_blocks) < min_stations] = np.nan
+        residuals = weighted_obs - np.einsum('nci,ni->nc', weighted_design, omega[blocks])
+        new_keep = np.all(np.abs(residuals) <= n_sigma, axis=1) | np.isnan(residuals).any(axis=1)
+        # Never reject so many stations that a block can no longer be estimated
+        enough = np.bincount(blocks[new_keep], minlength=n_blocks) >= min_stations
+        new_keep |= ~enough[blocks]
+        if np.array_equal(new_keep, keep):
+            break
+        keep = new_keep
+
+    num = np.bincount(blocks[keep], minlength=n_blocks)
+    chi2 = np.bincount(blocks[keep], weights=np.sum(residuals[keep] ** 2, axis=1), minlength=n_blocks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        reduced_chi2 = chi2 / np.maximum(2 * num - 3, 1)
+        covariance = np.linalg.inv(np.where(np.isnan(omega)[..., None], np.eye(3), normal))
+    covariance[np.isnan(omega[:, 0])] = np.nan
+    return omega, covariance, keep, residuals, reduced_chi2, (station_normal, station_rhs)
+
+def jackknife_poles(blocks, keep, n_blocks, station_normal, station_rhs):
+    """ Delete-one jackknife covariance of the rotation rates of every block, using
+    the stations kept by estimate_poles. All leave-one-out systems are solved as
+    a single stack."""
+    normal = np.zeros((n_blocks, 3, 3))
+    rhs = np.zeros((n_blocks, 3))
+    np.add.at(normal, blocks[keep], station_normal[keep])
+    np.add.at(rhs, blocks[keep], station_rhs[keep])
+    kept = np.flatnonzero(keep)
+    partial = solve_stacked(normal[blocks[kept]] - station_normal[kept], rhs[blocks[kept]] - station_rhs[kept])
+
+    covariance = np.full((n_blocks, 3, 3), np.nan)
+    for block in range(n_blocks):
+        estimates = partial[blocks[kept] == block]
+        estimates = estimates[~np.isnan(estimates).any(axis=1)]
+        n = len(estimates)
+        if n > 3:
+            deviations = estimates - estimates.mean(axis=0)
+            covariance[block] = (n - 1) / n * deviations.T @ deviations
+    return covariance
+
+def cartesian_to_geographic(omega, covariance):
+    """ Latitude, longitude (degrees) and rate (deg/Myr) of Cartesian rotation
+    vectors, with the rate uncertainty and the mean angular uncertainty (degrees)
+    of the pole position, approximated from the Cartesian covariance."""
+    wx, wy, wz = omega.T
+    rate = np.sqrt(wx ** 2 + wy ** 2 + wz ** 2)
+    lat = np.degrees(np.arcsin(np.clip(wz / rate, -1, 1)))
+    lon = np.degrees(np.arctan2(wy, wx))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        unit = omega / rate[:, None]
+        rate_sig = np.sqrt(np.einsum('bi,bij,bj->b', unit, covariance, unit))
+        # Perpendicular uncertainty of the rotation vector, as an angle on the sphere
+        perpendicular = np.einsum('bii->b', covariance) - rate_sig ** 2
+        position_sig = np.degrees(np.sqrt(np.maximum(perpendicular, 0) / 2) / rate)
+    return lat, lon, rate, rate_sig, position_sig
+
+def write_pole_file(pole_file, names, omega, description=''):
+    """ Write poles in the format read by velocity_rotation.read_pole_file."""
+    os.makedirs(os.path.dirname(os.path.abspath(pole_file)), exist_ok=True)
+    with open(pole_file, 'w') as f:
+        f.write(f"# Euler poles estimated by euler_pole.py {description}\n")
+        f.write("# name        wx          wy          wz   (deg/Myr)\n")
+        for name, (wx, wy, wz) in zip(names, omega):
+            if np.isnan(wx):
+                f.write(f"# {name}: not estimated (too few stations)\n")
+            else:
+                f.write(f"{name} {wx:11.6f} {wy:11.6f} {wz:11.6f}\n")
+
+def estimate_block_poles(combined_file, blocks_file, output_folder, n_sigma=3.0, max_iterations=10, min_stations=3):
+    """ The estimate_block_poles function selects the stations of every block of the
+    blocks file in the combined velocity field, estimates the Euler poles of all
+    blocks, and writes the pole file (block_poles.txt), the summary table
+    (block_poles.csv) and the residuals of the stations used (block_residuals.csv)."""
+    os.makedirs(output_folder, exist_ok=True)
+    df = pd.read_csv(combined_file, sep=r'\s+')
+    polygons = read_block_polygons(blocks_file)
+    names = [name for name, _ in polygons]
+    stations, blocks = select_block_stations(df['Lon'].to_numpy(dtype=float), df['Lat'].to_numpy(dtype=float), polygons)
+
+    lon = df['Lon'].to_numpy(dtype=float)[stations]
+    lat = df['Lat'].to_numpy(dtype=float)[stations]
+    velocities = df[['E.vel', 'N.vel']].to_numpy(dtype=float)[stations]
+    sigmas = df[['E.sig', 'N.sig']].to_numpy(dtype=float)[stations]
+    sigmas = np.where(sigmas > 0, sigmas, np.nanmedian(sigmas[sigmas > 0]) if np.any(sigmas > 0) else 1.0)
+
+    omega, covariance, keep, residuals, reduced_chi2, (station_normal, station_rhs) = estimate_poles(
+        lon, lat, velocities, sigmas, blocks, len(polygons), n_sigma, max_iterations, min_stations)
+    scaled_covariance = covariance * np.maximum(reduced_chi2, 1)[:, None, None]
+    jackknife_covariance = jackknife_poles(blocks, keep, len(polygons), station_normal, station_rhs)
+
+    pole_lat, pole_lon, rate, rate_sig, position_sig = cartesian_to_geographic(omega, scaled_covariance)
+    _, _, _, rate_sig_jk, position_sig_jk = cartesian_to_geographic(omega, jackknife_covariance)
+    summary = pd.DataFrame({
+        'Block': names,
+        'Num': np.bincount(blocks, minlength=len(polygons)),
+        'Num.used': np.bincount(blocks[keep], minlength=len(polygons)),
+        'wx': omega[:, 0], 'wy': omega[:, 1], 'wz': omega[:, 2],
+        'wx.sig': np.sqrt(scaled_covariance[:, 0, 0]), 'wy.sig': np.sqrt(scaled_covariance[:, 1, 1]),
+        'wz.sig': np.sqrt(scaled_covariance[:, 2, 2]),
+        'Pole.lat': pole_lat, 'Pole.lon': pole_lon, 'Rate': rate, 'Rate.sig': rate_sig, 'Pole.sig': position_sig,
+        'Rate.sig.jk': rate_sig_jk, 'Pole.sig.jk': position_sig_jk, 'Chi2.red': reduced_chi2,
+    }).round(6)
+
+    residual_velocities = residuals * sigmas
+    residual_table = pd.DataFrame({
+        'Lon': lon, 'Lat': lat, 'Stat': df['Stat'].to_numpy()[stations], 'Block': np.asarray(names, dtype=object)[blocks],
+        'E.res': np.round(residual_velocities[:, 0], 2), 'N.res': np.round(residual_velocities[:, 1], 2),
+        'E.sig': sigmas[:, 0], 'N.sig': sigmas[:, 1], 'Used': keep.astype(int),
+    })
+
+    pole_file = os.path.join(output_folder, 'block_poles.txt')
+    summary_file = os.path.join(output_folder, 'block_poles.csv')
+    residual_file = os.path.join(output_folder, 'block_residuals.csv')
+    write_pole_file(pole_file, names, omega, f"from {os.path.basename(combined_file)}")
+    summary.to_csv(summary_file, sep=',', index=False)
+    residual_table.to_csv(residual_file, sep=' ', index=False)
+
+    for _, row in summary.iterrows():
+        print(f"----------------------------------------------------------------------------------")
+        print(f"{row['Block']}: {row['Num.used']} / {row['Num']} stations used, pole {row['Pole.lat']:.3f}N {row['Pole.lon']:.3f}E, "
+              f"rate {row['Rate']:.4f} +- {row['Rate.sig']:.4f} deg/Myr (jackknife +- {row['Rate.sig.jk']:.4f}), "
+              f"reduced chi2 {row['Chi2.red']:.2f}")
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Euler poles: {pole_file}")
+    print(f"Summary: {summary_file}")
+    print(f"Residuals: {residual_file}")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Estimate Euler poles of blocks from a combined velocity field.')
+    parser.add_argument('combined_file', help='Combined velocity field (e.g. combined_vel_igb14.csv)')
+    parser.add_argument('blocks_json', help='JSON file with the block polygons (name, polygon)')
+    parser.add_argument('output_folder', help='Folder for the pole file, summary and residuals')
+    parser.add_argument('--n_sigma', type=float, default=3.0, help='Rejection threshold for normalised residuals')
+    parser.add_argument('--max_iterations', type=int, default=10, help='Maximum number of rejection iterations')
+    parser.add_argument('--min_stations', type=int, default=3, help='Minimum number of stations per block')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    estimate_block_poles(args.combined_file, args.blocks_json, args.output_folder, args.n_sigma, args.max_iterations, args.min_stations)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
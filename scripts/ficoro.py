@@ -0,0 +1,325 @@
+""" Single command-line entry point for the FICORO pipeline. Every stage of the
+workflow is available as a subcommand, and the module implementing a stage is
+only imported when that stage runs, so heavy libraries (scipy, matplotlib,
+pygmt) are not loaded by stages that do not need them. Several stages can be
+chained in one process by separating them with '+', which shares the imported
+modules and the velocity tables already read between stages, e.g.:
+
+    python ficoro.py combine ./in ./out + bootstrap ./in ./out + manual-filter ./out ./criteria.csv ./clean
+
+Subcommands: filter-postseismic, filter-lognorm, filter-coherence, align, rotate,
+deduplicate, combine, combine-verticals, bootstrap, report, diff, tiles,
+parquet, catalogue, manual-filter, scale, filter-verticals and plot."""
+
+""" Import necessary modules """
+import os
+import sys
+import json
+import time
+import argparse
+
+STAGE_SEPARATOR = '+'
+
+class Session:
+    """ State shared by the stages run in the same process: velocity tables read
+    from the input folders, keyed by their absolute path."""
+
+    def __init__(self):
+        self.tables = {}
+
+    def combination_table(self, input_folder):
+        """ StationTable of a combination input folder, read once per session."""
+        key = os.path.abspath(input_folder)
+        if key not in self.tables:
+            from station_index import read_combination_table
+            self.tables[key] = read_combination_table(input_folder)
+        return self.tables[key]
+
+def read_regions(regions_json):
+    """ Read the region definitions used by the coherence filter."""
+    if not regions_json:
+        return []
+    with open(regions_json, 'r') as file:
+        return json.load(file)
+
+def run_filter_postseismic(args, session):
+    from postseismic_filter import filter_postseismic
+    filter_postseismic(args.folder_path, args.output_folder, args.log_output_folder, args.catalogue or None,
+                       args.zones_json or None, args.spans_json or None, args.radius_a, args.radius_b, args.window_years)
+
+def run_filter_lognorm(args, session):
+    from lognorm_filter import filter_and_plot_data
+    filter_and_plot_data(args.folder_path, args.log_output_folder, args.output_folder, args.figure_folder, args.binary,
+                         args.workers, not args.no_figures)
+
+def run_filter_coherence(args, session):
+    from coherence_filter import parallel_filter_gps_velocities
+    regions = read_regions(args.regions_json) if args.geo_strict else []
+    parallel_filter_gps_velocities(args.folder_path, geo_strict=args.geo_strict, regions=regions,
+                                   special_case_file=args.special_case_file, binary=args.binary,
+                                   excluded_folder=args.excluded_folder, output_folder=args.output_folder,
+                                   knn=args.knn, max_distance=args.max_distance)
+
+def run_align(args, session):
+    from velocity_rotation import align_folder
+    align_folder(args.folder_path, args.reference_file, args.output_folder, args.frame, args.eq_dist)
+
+def run_rotate(args, session):
+    from velocity_rotation import rotate_folder
+    rotate_folder(args.folder_path, args.pole_file, args.output_folder, args.frames)
+
+def run_deduplicate(args, session):
+    from duplicate_detection import detect_duplicates
+    detect_duplicates(args.input_folder, args.report_folder, args.cleaned_folder, args.distance,
+                      args.velocity_tolerance, args.sigma_tolerance, nested_fraction=args.nested_fraction)
+
+def run_combine(args, session):
+    from combine_vel import combine_velocities
+    combine_velocities(args.input_folder, args.combined_folder, args.levelling_folder, args.vertical_folder)
+
+def run_combine_verticals(args, session):
+    from station_index import read_combination_inputs, group_close_stations
+    from vertical_combination import combine_vertical_field
+    combined_df = read_combination_inputs(args.input_folder)
+    labels = group_close_stations(combined_df['Lon'].values, combined_df['Lat'].values)
+    combine_vertical_field(combined_df, labels, args.output_folder, args.levelling_folder)
+
+def run_bootstrap(args, session):
+    from bootstrap_uncertainty import bootstrap_combined_uncertainties
+    bootstrap_combined_uncertainties(args.input_folder, args.combined_folder, args.method, args.n_resamples,
+                                     args.confidence, args.seed, args.workers,
+                                     table=session.combination_table(args.input_folder))
+
+def run_report(args, session):
+    from publication_report import publication_report
+    publication_report(args.folder_path, args.report_folder, args.figures)
+
+def run_diff(args, session):
+    from field_diff import diff_combined_fields
+    diff_combined_fields(args.old_path, args.new_path, args.output_folder, args.tolerance, args.vertical_tolerance,
+                         args.max_distance, args.code_distance)
+
+def run_tiles(args, session):
+    from tile_export import export_tiles
+    export_tiles(args.combined_folder, args.output_folder, args.filtered_folder, args.min_zoom, args.max_zoom,
+                 args.cell_size, args.workers)
+
+def run_parquet(args, session):
+    from parquet_export import export_parquet
+    export_parquet(args.combined_folder, args.output_folder, args.scaled_folder, args.vertical_file, args.cell_size,
+                   args.row_group_size)
+
+def run_catalogue(args, session):
+    from station_catalogue import ingest_run
+    ingest_run(args.db, args.results_folder, args.run)
+
+def run_manual_filter(args, session):
+    from manual_filter import manual_filter_combined
+    manual_filter_combined(args.combined_folder, args.criteria_file, args.output_folder)
+
+def run_scale(args, session):
+    from uncertainty_scaling_combined import harmonise_uncertainties
+    harmonise_uncertainties(args.input_folder, args.reference_file, args.output_folder)
+
+def run_filter_verticals(args, session):
+    from uncertainty_filter_verticals import UncertaintyFilterVerticals
+    filter_verticals = UncertaintyFilterVerticals(args.input_file, args.output_folder, args.figure_folder)
+    filter_verticals.read_vertical_velocities()
+    filter_verticals.filter_uncertainties()
+
+def run_plot(args, session):
+    if args.kind == 'filtering':
+        from plot_maps_filtering import plot_gps_velocities
+        plot_gps_velocities(args.folder_path, args.excluded_lognorm, args.excluded_coherence, args.figure_folder,
+                            args.asset_folder, args.offline)
+    else:
+        from plot_rotated_vels import plot_gps_velocity_fields
+        plot_gps_velocity_fields(args.folder_path, args.figure_folder, args.asset_folder, args.offline)
+
+def build_parser():
+    """ Argument parser with one subcommand per pipeline stage."""
+    parser = argparse.ArgumentParser(prog='ficoro', description='FICORO GNSS velocity field pipeline. '
+                                     f"Chain several stages with '{STAGE_SEPARATOR}'.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stage = subparsers.add_parser('filter-postseismic', help='Remove stations affected by postseismic deformation')
+    stage.add_argument('folder_path')
+    stage.add_argument('output_folder')
+    stage.add_argument('log_output_folder')
+    stage.add_argument('--catalogue', default='')
+    stage.add_argument('--zones_json', default='')
+    stage.add_argument('--spans_json', default='')
+    stage.add_argument('--radius_a', type=float, default=0.5)
+    stage.add_argument('--radius_b', type=float, default=1.8)
+    stage.add_argument('--window_years', type=float, default=5.0)
+    stage.set_defaults(handler=run_filter_postseismic)
+
+    stage = subparsers.add_parser('filter-lognorm', help='Remove stations with large uncertainties (lognormal fit)')
+    stage.add_argument('folder_path')
+    stage.add_argument('output_folder')
+    stage.add_argument('log_output_folder')
+    stage.add_argument('figure_folder')
+    stage.add_argument('--binary', action='store_true', help='Also write the output tables as pandas pickles')
+    stage.add_argument('--workers', type=int, default=1, help='Files processed in parallel by a pool of processes')
+    stage.add_argument('--no_figures', action='store_true', help='Do not plot the lognormal fits')
+    stage.set_defaults(handler=run_filter_lognorm)
+
+    stage = subparsers.add_parser('filter-coherence', help='Remove stations incoherent with their neighbours')
+    stage.add_argument('folder_path')
+    stage.add_argument('--geo_strict', action='store_true')
+    stage.add_argument('--regions_json', default='')
+    stage.add_argument('--special_case_file', default='')
+    stage.add_argument('--excluded_folder', default='./results/sites_excluded_coherence')
+    stage.add_argument('--output_folder', default='./results/output_coherence_analysis')
+    stage.add_argument('--knn', type=int, default=None, help='Neighbourhood of the K nearest stations instead of a 20 km radius')
+    stage.add_argument('--max_distance', type=float, default=None, help='Maximum distance (km) of the nearest stations')
+    stage.add_argument('--binary', action='store_true', help='Also write the output tables as pandas pickles')
+    stage.set_defaults(handler=run_filter_coherence)
+
+    stage = subparsers.add_parser('align', help='Align velocity fields to a reference velocity field')
+    stage.add_argument('folder_path')
+    stage.add_argument('reference_file')
+    stage.add_argument('output_folder')
+    stage.add_argument('--frame', default='igb14')
+    stage.add_argument('--eq_dist', type=float, default=1.0)
+    stage.set_defaults(handler=run_align)
+
+    stage = subparsers.add_parser('rotate', help='Rotate velocity fields to plate-fixed reference frames')
+    stage.add_argument('folder_path')
+    stage.add_argument('pole_file')
+    stage.add_argument('output_folder')
+    stage.add_argument('--frames', nargs='*')
+    stage.set_defaults(handler=run_rotate)
+
+    stage = subparsers.add_parser('deduplicate', help='Detect duplicated rows and nested solutions before combining')
+    stage.add_argument('input_folder')
+    stage.add_argument('report_folder')
+    stage.add_argument('--cleaned_folder', default=None, help='Write the input files without their redundant rows')
+    stage.add_argument('--distance', type=float, default=0.2)
+    stage.add_argument('--velocity_tolerance', type=float, default=0.3)
+    stage.add_argument('--sigma_tolerance', type=float, default=0.005)
+    stage.add_argument('--nested_fraction', type=float, default=0.9)
+    stage.set_defaults(handler=run_deduplicate)
+
+    stage = subparsers.add_parser('combine', help='Combine the velocity fields of one reference frame')
+    stage.add_argument('input_folder')
+    stage.add_argument('combined_folder')
+    stage.add_argument('--levelling_folder', default=None)
+    stage.add_argument('--vertical_folder', default=None)
+    stage.set_defaults(handler=run_combine)
+
+    stage = subparsers.add_parser('combine-verticals', help='Combine GNSS and levelling vertical velocities')
+    stage.add_argument('input_folder')
+    stage.add_argument('output_folder')
+    stage.add_argument('--levelling_folder', default=None)
+    stage.set_defaults(handler=run_combine_verticals)
+
+    stage = subparsers.add_parser('bootstrap', help='Empirical uncertainties of the combined velocities')
+    stage.add_argument('input_folder')
+    stage.add_argument('combined_folder')
+    stage.add_argument('--method', choices=['bootstrap', 'jackknife'], default='bootstrap')
+    stage.add_argument('--n_resamples', type=int, default=2000)
+    stage.add_argument('--confidence', type=float, default=0.95)
+    stage.add_argument('--seed', type=int, default=42)
+    stage.add_argument('--workers', type=int, default=None)
+    stage.set_defaults(handler=run_bootstrap)
+
+    stage = subparsers.add_parser('report', help='Bias, RMS and chi2 of every solution against the combined field')
+    stage.add_argument('folder_path')
+    stage.add_argument('report_folder')
+    stage.add_argument('--figures', action='store_true')
+    stage.set_defaults(handler=run_report)
+
+    stage = subparsers.add_parser('diff', help='Stations added, removed or changed between two versions of the combined field')
+    stage.add_argument('old_path')
+    stage.add_argument('new_path')
+    stage.add_argument('output_folder')
+    stage.add_argument('--tolerance', type=float, default=0.2)
+    stage.add_argument('--vertical_tolerance', type=float, default=1.0)
+    stage.add_argument('--max_distance', type=float, default=1.11)
+    stage.add_argument('--code_distance', type=float, default=5.0)
+    stage.set_defaults(handler=run_diff)
+
+    stage = subparsers.add_parser('tiles', help='Export the combined field as a tile pyramid with a local web viewer')
+    stage.add_argument('combined_folder')
+    stage.add_argument('output_folder')
+    stage.add_argument('--filtered_folder', default=None)
+    stage.add_argument('--min_zoom', type=int, default=2)
+    stage.add_argument('--max_zoom', type=int, default=8)
+    stage.add_argument('--cell_size', type=int, default=16)
+    stage.add_argument('--workers', type=int, default=None)
+    stage.set_defaults(handler=run_tiles)
+
+    stage = subparsers.add_parser('parquet', help='Export the final products as a partitioned Parquet dataset (requires pyarrow)')
+    stage.add_argument('combined_folder')
+    stage.add_argument('output_folder')
+    stage.add_argument('--scaled_folder', default=None)
+    stage.add_argument('--vertical_file', default=None)
+    stage.add_argument('--cell_size', type=int, default=45)
+    stage.add_argument('--row_group_size', type=int, default=2048)
+    stage.set_defaults(handler=run_parquet)
+
+    stage = subparsers.add_parser('catalogue', help='Add the outputs of a results folder to the station catalogue')
+    stage.add_argument('db')
+    stage.add_argument('results_folder')
+    stage.add_argument('--run', default=None)
+    stage.set_defaults(handler=run_catalogue)
+
+    stage = subparsers.add_parser('manual-filter', help='Remove stations listed in the manual filter criteria')
+    stage.add_argument('combined_folder')
+    stage.add_argument('criteria_file')
+    stage.add_argument('output_folder')
+    stage.set_defaults(handler=run_manual_filter)
+
+    stage = subparsers.add_parser('scale', help='Harmonise uncertainties with a reference solution')
+    stage.add_argument('input_folder')
+    stage.add_argument('reference_file')
+    stage.add_argument('output_folder')
+    stage.set_defaults(handler=run_scale)
+
+    stage = subparsers.add_parser('filter-verticals', help='Remove vertical velocities with large uncertainties')
+    stage.add_argument('input_file')
+    stage.add_argument('output_folder')
+    stage.add_argument('figure_folder')
+    stage.set_defaults(handler=run_filter_verticals)
+
+    stage = subparsers.add_parser('plot', help='Plot filtered or rotated velocity fields (requires pygmt)')
+    stage.add_argument('kind', choices=['filtering', 'rotated'])
+    stage.add_argument('folder_path')
+    stage.add_argument('figure_folder')
+    stage.add_argument('--excluded_lognorm', default='./results/sites_excluded_lognorm_99')
+    stage.add_argument('--excluded_coherence', default='./results/sites_excluded_coherence')
+    stage.add_argument('--asset_folder', default='./results/map_assets', help='Local relief and coastline assets (see asset_cache.py)')
+    stage.add_argument('--offline', action='store_true', help='Fail instead of downloading missing map assets')
+    stage.set_defaults(handler=run_plot)
+    return parser
+
+def split_stages(argv):
+    """ Split the command-line arguments into the argument lists of each stage."""
+    stages = [[]]
+    for arg in argv:
+        if arg == STAGE_SEPARATOR:
+            stages.append([])
+        else:
+            stages[-1].append(arg)
+    return [stage for stage in stages if stage]
+
+def main(argv=None):
+    parser = build_parser()
+    stages = split_stages(sys.argv[1:] if argv is None else argv)
+    if not stages:
+        parser.print_help()
+        return 1
+    # Parse every stage before running any, so that typos fail early
+    parsed = [parser.parse_args(stage) for stage in stages]
+    session = Session()
+    for args in parsed:
+        start_time = time.time()
+        args.handler(args, session)
+        end_time = time.time()
+        print(f"----------------------------------------------------------------------------------")
+        print(f"Time taken by {args.command}: {end_time - start_time:.2f} seconds")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
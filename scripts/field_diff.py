@@ -0,0 +1,190 @@
+""" This code compares two versions of the combined velocity field (e.g. before and
+after adding input solutions or changing the filter thresholds) and lists the
+stations that were added, removed or whose velocity changed beyond a tolerance.
+
+Stations of the two versions are matched through a KD-tree of their positions
+(see station_index.py) and their station codes. The candidates of every station
+are the stations of the other version within code_distance km (default 5 km);
+a candidate with the same code is preferred, otherwise the nearest candidate
+within max_distance km (default 1.11 km, the collocation distance of
+combine_vel.py) is taken. Matches are one-to-one, so two collocated stations
+are never matched to the same station (codes are not unique in the combined
+files). The matching and the differences are computed with NumPy on whole
+columns, and the tree is queried in chunks to bound the memory used.
+
+The inputs are two combined_vel_<frame>.csv files, or two folders of such files
+(matched by file name). Outputs (in the output folder, for every frame):
+    - added_<frame>.csv, removed_<frame>.csv: rows only found in the new (old) version
+    - changed_<frame>.csv: matched stations whose horizontal velocity changed by
+      more than the tolerance (or vertical velocity by more than the vertical
+      tolerance), sorted by the size of the change, with:
+      Shift: distance between the two positions (km)
+      dE, dN, dH, dU: change of the velocities and of the horizontal velocity vector (mm/yr)
+      dE.sig, dN.sig, dU.sig: change of the uncertainties (mm/yr)
+    - diff_summary.csv: number of stations in each category for every frame"""
+
+""" Import necessary modules """
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from station_index import lonlat_to_xyz, build_station_tree, km_to_chord, chord_to_km
+from run_manifest import atomic_to_csv, RunManifest
+
+def read_combined_field(file_path):
+    """ Read a combined velocity field (space-separated, with a header line)."""
+    return pd.read_csv(file_path, sep=' ', dtype={'Stat': str})
+
+def candidate_pairs(old_lon, old_lat, new_lon, new_lat, code_distance=5.0, k=16, chunk_size=200_000):
+    """ Stations of the old version within code_distance km of every new station (at
+    most k per station). Returns the new rows, old rows and distances (km) of
+    the candidate pairs."""
+    if len(old_lon) == 0 or len(new_lon) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    tree = build_station_tree(old_lon, old_lat)
+    k = min(k, len(old_lon))
+    new_rows, old_rows, distances = [], [], []
+    for start in range(0, len(new_lon), chunk_size):
+        xyz = lonlat_to_xyz(new_lon[start:start + chunk_size], new_lat[start:start + chunk_size])
+        chord, index = tree.query(xyz, k=k, distance_upper_bound=km_to_chord(code_distance), workers=-1)
+        chord, index = chord.reshape(len(xyz), -1), index.reshape(len(xyz), -1)
+        # Missing neighbours are returned with the index len(old_lon)
+        rows, columns = np.nonzero(index < len(old_lon))
+        new_rows.append(rows + start)
+        old_rows.append(index[rows, columns])
+        distances.append(chord_to_km(chord[rows, columns]))
+    return np.concatenate(new_rows), np.concatenate(old_rows), np.concatenate(distances)
+
+def match_stations(old_df, new_df, max_distance=1.11, code_distance=5.0, k=16):
+    """ Match the stations of two versions of a field one-to-one. Pairs are ranked
+    by code (same code first) and distance, and matched in rounds: in every round
+    the pairs that are the best remaining pair of both of their stations are
+    accepted. Returns the matched old row of every new row (-1 if unmatched) and
+    the distance (km) of the match."""
+    new_rows, old_rows, distances = candidate_pairs(old_df['Lon'].to_numpy(dtype=float), old_df['Lat'].to_numpy(dtype=float),
+                                                    new_df['Lon'].to_numpy(dtype=float), new_df['Lat'].to_numpy(dtype=float),
+                                                    code_distance, k)
+    codes, _ = pd.factorize(pd.concat([old_df['Stat'], new_df['Stat']], ignore_index=True))
+    same_code = codes[:len(old_df)][old_rows] == codes[len(old_df):][new_rows]
+    # Stations with different codes only match if they are collocated
+    keep = same_code | (distances <= max_distance)
+    new_rows, old_rows, distances, same_code = new_rows[keep], old_rows[keep], distances[keep], same_code[keep]
+    order = np.lexsort((distances, ~same_code))
+    new_rows, old_rows = new_rows[order], old_rows[order]
+
+    matched = np.full(len(new_df), -1, dtype=np.int64)
+    taken = np.zeros(len(old_df), dtype=bool)
+    active = np.arange(len(new_rows))
+    while len(active):
+        # Active pairs are in rank order, so the first pair of a station is its best one
+        best_new = active[np.unique(new_rows[active], return_index=True)[1]]
+        best_old = active[np.unique(old_rows[active], return_index=True)[1]]
+        accepted = np.intersect1d(best_new, best_old, assume_unique=True)
+        matched[new_rows[accepted]] = old_rows[accepted]
+        taken[old_rows[accepted]] = True
+        active = active[(matched[new_rows[active]] < 0) & ~taken[old_rows[active]]]
+
+    shift = np.full(len(new_df), np.nan)
+    found = matched >= 0
+    if found.any():
+        shift[found] = chord_to_km(np.linalg.norm(
+            lonlat_to_xyz(new_df['Lon'].to_numpy(dtype=float)[found], new_df['Lat'].to_numpy(dtype=float)[found]) -
+            lonlat_to_xyz(old_df['Lon'].to_numpy(dtype=float)[matched[found]], old_df['Lat'].to_numpy(dtype=float)[matched[found]]), axis=1))
+    return matched, shift
+
+def field_changes(old_df, new_df, matched, shift):
+    """ Differences (new - old) of the velocities and uncertainties of the matched
+    stations. Returns a DataFrame indexed by the new rows."""
+    new_rows = np.flatnonzero(matched >= 0)
+    old_rows = matched[new_rows]
+    changes = pd.DataFrame({'Lon': new_df['Lon'].to_numpy()[new_rows], 'Lat': new_df['Lat'].to_numpy()[new_rows],
+                            'Stat': new_df['Stat'].to_numpy()[new_rows], 'Old.Stat': old_df['Stat'].to_numpy()[old_rows],
+                            'Shift': np.round(shift[new_rows], 4)}, index=new_rows)
+    for column in ['E.vel', 'N.vel', 'U.vel']:
+        if column in new_df and column in old_df:
+            changes[column] = new_df[column].to_numpy()[new_rows]
+            changes['d' + column[0]] = np.round(changes[column] - old_df[column].to_numpy(dtype=float)[old_rows], 2)
+    changes.insert(changes.columns.get_loc('dN') + 1, 'dH', np.round(np.hypot(changes['dE'], changes['dN']), 2))
+    for column in ['E.sig', 'N.sig', 'U.sig']:
+        if column in new_df and column in old_df:
+            changes['d' + column] = np.round(new_df[column].to_numpy(dtype=float)[new_rows] -
+                                             old_df[column].to_numpy(dtype=float)[old_rows], 2)
+    return changes
+
+def diff_fields(old_file, new_file, output_folder, frame, tolerance=0.2, vertical_tolerance=1.0, max_distance=1.11,
+                code_distance=5.0, manifest=None):
+    """ Compare two versions of the combined field of a frame and write the added,
+    removed and changed stations. Returns the summary of the frame."""
+    old_df = read_combined_field(old_file)
+    new_df = read_combined_field(new_file)
+    matched, shift = match_stations(old_df, new_df, max_distance, code_distance)
+    changes = field_changes(old_df, new_df, matched, shift)
+
+    changed = changes['dH'] > tolerance
+    if 'dU' in changes:
+        changed |= changes['dU'].abs() > vertical_tolerance
+    taken = np.zeros(len(old_df), dtype=bool)
+    taken[matched[matched >= 0]] = True
+    added = new_df[matched < 0]
+    removed = old_df[~taken]
+
+    atomic_to_csv(added, os.path.join(output_folder, f'added_{frame}.csv'), manifest, sep=' ', index=False)
+    atomic_to_csv(removed, os.path.join(output_folder, f'removed_{frame}.csv'), manifest, sep=' ', index=False)
+    atomic_to_csv(changes[changed].sort_values('dH', ascending=False, kind='stable'),
+                  os.path.join(output_folder, f'changed_{frame}.csv'), manifest, sep=' ', index=False)
+    return {'Frame': frame, 'Old': len(old_df), 'New': len(new_df), 'Matched': len(changes),
+            'Renamed': int((changes['Stat'] != changes['Old.Stat']).sum()), 'Added': len(added), 'Removed': len(removed),
+            'Changed': int(changed.sum()),
+            'Median.dH': round(float(changes['dH'].median()), 3) if len(changes) else np.nan,
+            'Max.dH': round(float(changes['dH'].max()), 3) if len(changes) else np.nan}
+
+def frame_pairs(old_path, new_path):
+    """ Pairs of files to compare: the two files, or the combined_vel_<frame>.csv
+    files found in both folders (matched by name). Returns (frame, old, new) tuples."""
+    if not os.path.isdir(old_path):
+        frame = os.path.splitext(os.path.basename(new_path))[0].replace('combined_vel_', '')
+        return [(frame, old_path, new_path)]
+    old_files = {name for name in os.listdir(old_path) if name.startswith('combined_vel_') and name.endswith('.csv')}
+    new_files = {name for name in os.listdir(new_path) if name.startswith('combined_vel_') and name.endswith('.csv')}
+    for name in sorted(old_files ^ new_files):
+        print(f"Skipping {name}: only found in {old_path if name in old_files else new_path}")
+    return [(name[len('combined_vel_'):-len('.csv')], os.path.join(old_path, name), os.path.join(new_path, name))
+            for name in sorted(old_files & new_files)]
+
+def diff_combined_fields(old_path, new_path, output_folder, tolerance=0.2, vertical_tolerance=1.0, max_distance=1.11,
+                         code_distance=5.0):
+    """ Compare two versions of the combined field (files or folders) and write the
+    differences and the summary to output_folder. Returns the summary."""
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = RunManifest(output_folder, 'diff')
+    summaries = []
+    for frame, old_file, new_file in frame_pairs(old_path, new_path):
+        manifest.add_inputs([old_file, new_file])
+        summaries.append(diff_fields(old_file, new_file, output_folder, frame, tolerance, vertical_tolerance, max_distance,
+                                     code_distance, manifest))
+    summary = pd.DataFrame(summaries, columns=['Frame', 'Old', 'New', 'Matched', 'Renamed', 'Added', 'Removed', 'Changed',
+                                               'Median.dH', 'Max.dH'])
+    atomic_to_csv(summary, os.path.join(output_folder, 'diff_summary.csv'), manifest, sep=' ', index=False)
+    manifest.save()
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stations added, removed or changed between two versions of the combined field.')
+    parser.add_argument('old_path', help='Old combined_vel_<frame>.csv file, or folder of such files')
+    parser.add_argument('new_path', help='New combined_vel_<frame>.csv file, or folder of such files')
+    parser.add_argument('output_folder', help='Folder where the differences are written')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Change of the horizontal velocity reported (mm/yr)')
+    parser.add_argument('--vertical_tolerance', type=float, default=1.0, help='Change of the vertical velocity reported (mm/yr)')
+    parser.add_argument('--max_distance', type=float, default=1.11, help='Distance (km) to match stations with different codes')
+    parser.add_argument('--code_distance', type=float, default=5.0, help='Distance (km) to match stations with the same code')
+    args = parser.parse_args()
+
+    # Time the execution of the comparison
+    start_time = time.time()
+    summary = diff_combined_fields(args.old_path, args.new_path, args.output_folder, args.tolerance, args.vertical_tolerance,
+                                   args.max_distance, args.code_distance)
+    end_time = time.time()
+    print(summary.to_string(index=False))
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
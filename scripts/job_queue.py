@@ -0,0 +1,463 @@
+""" Distributed execution of the pipeline stages through a job queue stored in a
+SQLite database. A stage (given with the arguments of ficoro.py) is split into
+independent jobs, e.g. one job per input file for the filters, the alignment,
+the rotation and the maps, one job per frame for the combination and the
+bootstrap, and one job per layer for the tile export. Workers started on one or
+several machines take jobs from the queue until it is empty:
+
+    python job_queue.py submit ./queue.db filter-lognorm ./in ./out ./log ./figures
+    python job_queue.py worker ./queue.db --exit_when_idle      (on every node)
+    python job_queue.py collect ./queue.db filter-lognorm-1
+    python job_queue.py status ./queue.db
+
+or, on the local machine only (e.g. for testing):
+
+    python job_queue.py local --workers 4 ./queue.db filter-lognorm ./in ./out ./log ./figures
+
+The queue database and the data folders must be on a file system shared by all
+the nodes, mounted at the same path (SQLite locks the database with POSIX locks,
+so use a file system that supports them, e.g. NFSv4 or Lustre). Jobs run in the
+working directory from which the batch was submitted, so relative paths and the
+default folders of the stages work as in a local run.
+
+A worker holds a lease on the job it runs and renews it with a heartbeat (every
+third of the lease). If a worker dies, its lease expires and the job is given to
+another worker. Failed jobs are retried up to max_attempts times. The results of
+the jobs are collected in submission order, and the jobs record their outputs in
+the manifest of their stage (see run_manifest.py, manifests are merged under a
+file lock), so a batch gives the same outputs whatever the number of workers and
+the order in which the jobs ran."""
+
+""" Import necessary modules """
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+import contextlib
+import collections
+import multiprocessing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    batch TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    cwd TEXT NOT NULL,
+    finaliser TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    batch TEXT NOT NULL REFERENCES batches (batch),
+    seq INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    UNIQUE (batch, seq)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+Job = collections.namedtuple('Job', ['id', 'batch', 'seq', 'kind', 'payload', 'attempt', 'cwd'])
+
+class JobQueue:
+    """ Jobs, leases and results stored in a SQLite database. Every change of the
+    state of a job is a single transaction, so several workers (on several
+    machines) can use the same database."""
+
+    def __init__(self, db_path, timeout=60):
+        self.db_path = os.path.abspath(db_path)
+        self.connection = sqlite3.connect(self.db_path, timeout=timeout, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Write transaction (the database is locked until the block finishes)."""
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def submit(self, command, jobs, finaliser=None, batch=None, max_attempts=3, cwd=None):
+        """ Add a batch of jobs, given as (kind, payload) tuples. The finaliser (if
+        any) is run when the batch is collected. Returns the name of the batch."""
+        with self.transaction() as db:
+            if batch is None:
+                number = db.execute('SELECT COUNT(*) FROM batches WHERE command = ?', (command,)).fetchone()[0] + 1
+                batch = f'{command}-{number}'
+            db.execute('INSERT INTO batches (batch, command, cwd, finaliser) VALUES (?, ?, ?, ?)',
+                       (batch, command, cwd or os.getcwd(), json.dumps(finaliser)))
+            db.executemany('INSERT INTO jobs (batch, seq, kind, payload, max_attempts) VALUES (?, ?, ?, ?, ?)',
+                           [(batch, seq, kind, json.dumps(payload), max_attempts) for seq, (kind, payload) in enumerate(jobs)])
+        return batch
+
+    def claim(self, worker, lease):
+        """ Take the next pending job (or a job whose lease has expired) and lease it
+        to the worker. Returns None if there is no job to run."""
+        now = time.time()
+        with self.transaction() as db:
+            # Jobs whose worker stopped renewing the lease are failed once they used all their attempts
+            db.execute("UPDATE jobs SET status = 'failed', error = 'Lease expired', worker = NULL, lease_expires = NULL "
+                       "WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts", (now,))
+            row = db.execute("SELECT jobs.id, jobs.batch, seq, kind, payload, attempts, cwd FROM jobs "
+                             "JOIN batches ON batches.batch = jobs.batch "
+                             "WHERE status = 'pending' OR (status = 'running' AND lease_expires < ?) "
+                             "ORDER BY jobs.id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                       "WHERE id = ?", (worker, now + lease, row[0]))
+        job_id, batch, seq, kind, payload, attempts, cwd = row
+        return Job(job_id, batch, seq, kind, json.loads(payload), attempts + 1, cwd)
+
+    def heartbeat(self, job_id, worker, lease):
+        """ Renew the lease of a running job. Returns False if the worker lost it."""
+        cursor = self.connection.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                                         (time.time() + lease, job_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        """ Store the result of a job (ignored if the worker lost the lease)."""
+        self.connection.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_expires = NULL "
+                                "WHERE id = ? AND worker = ? AND status = 'running'", (json.dumps(result), job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        """ Record the error of a job, which is retried if it has attempts left."""
+        self.connection.execute("UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, "
+                                "error = ?, worker = NULL, lease_expires = NULL "
+                                "WHERE id = ? AND worker = ? AND status = 'running'", (error, job_id, worker))
+
+    def retry_failed(self, batch):
+        """ Give the failed jobs of a batch a new set of attempts."""
+        self.connection.execute("UPDATE jobs SET status = 'pending', attempts = 0 WHERE batch = ? AND status = 'failed'", (batch,))
+
+    def unfinished(self, batch=None):
+        """ Number of pending or running jobs (of a batch, or of all batches)."""
+        query = "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')"
+        if batch is None:
+            return self.connection.execute(query).fetchone()[0]
+        return self.connection.execute(query + ' AND batch = ?', (batch,)).fetchone()[0]
+
+    def status(self):
+        """ Number of jobs of every batch in each state."""
+        rows = self.connection.execute("SELECT batch, status, COUNT(*) FROM jobs GROUP BY batch, status ORDER BY batch").fetchall()
+        status = collections.defaultdict(dict)
+        for batch, state, count in rows:
+            status[batch][state] = count
+        return dict(status)
+
+    def batch_info(self, batch):
+        """ Command, working directory and finaliser of a batch."""
+        row = self.connection.execute("SELECT command, cwd, finaliser FROM batches WHERE batch = ?", (batch,)).fetchone()
+        if row is None:
+            raise ValueError(f"Unknown batch {batch}")
+        return row[0], row[1], json.loads(row[2])
+
+    def results(self, batch):
+        """ Jobs of a batch in submission order, as (seq, kind, status, result, error)."""
+        rows = self.connection.execute("SELECT seq, kind, status, result, error FROM jobs WHERE batch = ? ORDER BY seq", (batch,)).fetchall()
+        return [(seq, kind, status, json.loads(result) if result else None, error) for seq, kind, status, result, error in rows]
+
+""" Tasks: the function run by a worker for each kind of job. Modules are imported
+when a task runs, as in ficoro.py. Every task returns a JSON-serialisable result
+and records its outputs in the manifest of its stage."""
+
+def task_lognorm(file_name, log_output_folder, output_folder, figure_folder, plot, binary):
+    from lognorm_filter import filter_file
+    from output_writer import OutputWriter
+    from run_manifest import RunManifest
+    manifest = RunManifest(output_folder, 'lognorm')
+    manifest.add_inputs([file_name])
+    with OutputWriter(manifest, binary=binary) as writer:
+        summary = filter_file(file_name, log_output_folder, output_folder, figure_folder, plot, writer)
+    manifest.save()
+    return summary
+
+def task_coherence(file_name, radius, geo_strict, regions, special_case_file, binary, excluded_folder, output_folder, knn, max_distance):
+    from coherence_filter import filter_gps_velocities
+    from output_writer import OutputWriter
+    from run_manifest import RunManifest
+    manifest = RunManifest(output_folder, 'coherence')
+    manifest.add_inputs([file_name])
+    with OutputWriter(manifest, binary=binary) as writer:
+        num_removed, num_total = filter_gps_velocities(file_name, radius, geo_strict, regions, special_case_file, manifest, writer,
+                                                       excluded_folder, output_folder, knn, max_distance)
+    manifest.save()
+    return {'file_name': os.path.basename(file_name), 'num_removed': int(num_removed), 'num_total': int(num_total)}
+
+def task_align(file_name, reference_file, output_folder, frame, eq_dist):
+    from velocity_rotation import read_velocity_file, align_file
+    return {'file_name': os.path.basename(file_name),
+            'output_file': align_file(file_name, read_velocity_file(reference_file), output_folder, frame, eq_dist)}
+
+def task_rotate(file_name, pole_file, output_folder, frames):
+    from velocity_rotation import read_pole_file, rotate_file
+    poles = read_pole_file(pole_file)
+    return {'file_name': os.path.basename(file_name),
+            'output_files': rotate_file(file_name, poles, output_folder, frames or list(poles))}
+
+def task_combine(input_folder, combined_folder, levelling_folder, vertical_folder):
+    from combine_vel import combine_velocities
+    combine_velocities(input_folder, combined_folder, levelling_folder, vertical_folder)
+    return {'input_folder': input_folder}
+
+def task_bootstrap(input_folder, combined_folder, method, n_resamples, confidence, seed, workers):
+    from bootstrap_uncertainty import bootstrap_combined_uncertainties
+    results = bootstrap_combined_uncertainties(input_folder, combined_folder, method, n_resamples, confidence, seed, workers)
+    return {'input_folder': input_folder, 'sites': len(results)}
+
+def task_tiles(layer, file_path, output_folder, min_zoom, max_zoom, cell_size):
+    from tile_export import export_layer
+    metadata, n_tiles = export_layer(layer, file_path, output_folder, min_zoom, max_zoom, cell_size)
+    return {'layer': metadata, 'tiles': n_tiles}
+
+def task_plot(kind, file_name, folder_path, figure_folder, excluded_lognorm, excluded_coherence, asset_folder, offline):
+    if kind == 'filtering':
+        from plot_maps_filtering import plot_gps_velocities
+        plot_gps_velocities(folder_path, excluded_lognorm, excluded_coherence, figure_folder, asset_folder, offline, [file_name])
+    else:
+        from plot_rotated_vels import plot_gps_velocity_fields
+        plot_gps_velocity_fields(folder_path, figure_folder, asset_folder, offline, [file_name])
+    return {'file_name': os.path.basename(file_name)}
+
+def task_ficoro(argv):
+    """ Stages that are not split into jobs run as a single job."""
+    from ficoro import main
+    return {'exit_code': main(argv)}
+
+TASKS = {'lognorm': task_lognorm, 'coherence': task_coherence, 'align': task_align, 'rotate': task_rotate,
+         'combine': task_combine, 'bootstrap': task_bootstrap, 'tiles': task_tiles, 'plot': task_plot,
+         'ficoro': task_ficoro}
+
+def stage_jobs(argv):
+    """ Split a stage, given with the arguments of ficoro.py, into jobs. Returns the
+    command, the jobs as (kind, payload) tuples and the finaliser of the batch."""
+    from ficoro import build_parser, read_regions
+    args = build_parser().parse_args(argv)
+    command = args.command
+    if command == 'filter-lognorm':
+        os.makedirs(args.log_output_folder, exist_ok=True)
+        os.makedirs(args.output_folder, exist_ok=True)
+        from run_manifest import discover_inputs
+        return command, [('lognorm', {'file_name': file_name, 'log_output_folder': args.log_output_folder,
+                                      'output_folder': args.output_folder, 'figure_folder': args.figure_folder,
+                                      'plot': not args.no_figures, 'binary': args.binary})
+                         for file_name in discover_inputs(args.folder_path, '.vel')], None
+    if command == 'filter-coherence':
+        from run_manifest import discover_inputs
+        regions = read_regions(args.regions_json) if args.geo_strict else []
+        return command, [('coherence', {'file_name': file_name, 'radius': 20, 'geo_strict': args.geo_strict, 'regions': regions,
+                                        'special_case_file': args.special_case_file, 'binary': args.binary,
+                                        'excluded_folder': args.excluded_folder, 'output_folder': args.output_folder,
+                                        'knn': args.knn, 'max_distance': args.max_distance})
+                         for file_name in discover_inputs(args.folder_path, '.csv')], None
+    if command == 'align':
+        file_names = sorted(glob.glob(os.path.join(args.folder_path, '*.csv')) + glob.glob(os.path.join(args.folder_path, '*.vel')))
+        return command, [('align', {'file_name': file_name, 'reference_file': args.reference_file, 'output_folder': args.output_folder,
+                                    'frame': args.frame, 'eq_dist': args.eq_dist}) for file_name in file_names], None
+    if command == 'rotate':
+        file_names = sorted(glob.glob(os.path.join(args.folder_path, '*.vel')))
+        return command, [('rotate', {'file_name': file_name, 'pole_file': args.pole_file, 'output_folder': args.output_folder,
+                                     'frames': args.frames}) for file_name in file_names], None
+    if command in ('combine', 'bootstrap'):
+        # One job per frame (the input folder is a frame, or contains one subfolder per frame)
+        from publication_report import frame_folders
+        if command == 'combine':
+            return command, [('combine', {'input_folder': folder, 'combined_folder': args.combined_folder,
+                                          'levelling_folder': args.levelling_folder, 'vertical_folder': args.vertical_folder})
+                             for folder in frame_folders(args.input_folder)], None
+        return command, [('bootstrap', {'input_folder': folder, 'combined_folder': args.combined_folder, 'method': args.method,
+                                        'n_resamples': args.n_resamples, 'confidence': args.confidence, 'seed': args.seed,
+                                        'workers': args.workers})
+                         for folder in frame_folders(args.input_folder)], None
+    if command == 'tiles':
+        from tile_export import layer_sources
+        options = {'output_folder': args.output_folder, 'min_zoom': args.min_zoom, 'max_zoom': args.max_zoom, 'cell_size': args.cell_size}
+        sources = layer_sources(args.combined_folder, args.filtered_folder)
+        return command, [('tiles', {'layer': layer, 'file_path': file_path, **options}) for layer, file_path in sources], \
+            {'kind': 'tiles', 'inputs': [file_path for _, file_path in sources], **options}
+    if command == 'plot':
+        # Prefetch the map assets once, so that the jobs only read them
+        from asset_cache import ensure_assets
+        ensure_assets(args.asset_folder, offline=args.offline)
+        return command, [('plot', {'kind': args.kind, 'file_name': file_name, 'folder_path': args.folder_path,
+                                   'figure_folder': args.figure_folder, 'excluded_lognorm': args.excluded_lognorm,
+                                   'excluded_coherence': args.excluded_coherence, 'asset_folder': args.asset_folder,
+                                   'offline': args.offline})
+                         for file_name in sorted(glob.glob(os.path.join(args.folder_path, '*.csv')))], None
+    return command, [('ficoro', {'argv': list(argv)})], None
+
+def finalise_batch(queue, batch):
+    """ Merge the results of a finished batch (in submission order). Returns the
+    number of failed jobs."""
+    command, cwd, finaliser = queue.batch_info(batch)
+    results = queue.results(batch)
+    failed = [(seq, error) for seq, _, status, _, error in results if status != 'done']
+    for seq, error in failed:
+        print(f"Job {seq} of {batch} failed:\n{error}")
+    if failed:
+        return len(failed)
+
+    previous_folder = os.getcwd()
+    os.chdir(cwd)
+    try:
+        for seq, kind, status, result, error in results:
+            if kind == 'lognorm':
+                from lognorm_filter import print_file_summary
+                print_file_summary(result)
+            elif kind == 'coherence':
+                print(f"Number of stations removed for {result['file_name']}: {result['num_removed']} / {result['num_total']}")
+        if finaliser and finaliser['kind'] == 'tiles':
+            from tile_export import write_viewer
+            from run_manifest import RunManifest
+            manifest = RunManifest(finaliser['output_folder'], 'tiles')
+            manifest.add_inputs(finaliser['inputs'])
+            metadata = write_viewer(finaliser['output_folder'], [result['layer'] for _, _, _, result, _ in results],
+                                    finaliser['min_zoom'], finaliser['max_zoom'], finaliser['cell_size'], manifest)
+            manifest.save()
+            print(f"Layers: {len(metadata['layers'])}, tiles: {sum(result['tiles'] for _, _, _, result, _ in results)}")
+    finally:
+        os.chdir(previous_folder)
+    print(f"Batch {batch} ({command}): {len(results)} jobs done")
+    return 0
+
+def collect(db_path, batch, poll=2.0):
+    """ Wait until every job of the batch has finished, then merge its results.
+    Returns the number of failed jobs."""
+    queue = JobQueue(db_path)
+    try:
+        while queue.unfinished(batch):
+            time.sleep(poll)
+        return finalise_batch(queue, batch)
+    finally:
+        queue.close()
+
+def send_heartbeats(db_path, job_id, worker, lease, stop):
+    """ Renew the lease of a job until `stop` is set (runs in its own thread, with
+    its own connection)."""
+    queue = JobQueue(db_path)
+    try:
+        while not stop.wait(lease / 3):
+            if not queue.heartbeat(job_id, worker, lease):
+                print(f"Worker {worker} lost the lease of job {job_id}")
+                return
+    finally:
+        queue.close()
+
+def run_worker(db_path, worker=None, lease=120, poll=2.0, exit_when_idle=False):
+    """ Run jobs from the queue until it is stopped (or, with exit_when_idle=True,
+    until no job is pending or running). Returns the number of jobs run."""
+    # Figures are only saved to files
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    queue = JobQueue(db_path)
+    initial_folder = os.getcwd()
+    jobs_run = 0
+    try:
+        while True:
+            job = queue.claim(worker, lease)
+            if job is None:
+                if exit_when_idle and not queue.unfinished():
+                    return jobs_run
+                time.sleep(poll)
+                continue
+            print(f"Worker {worker}: job {job.seq} of {job.batch} ({job.kind}, attempt {job.attempt})")
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=send_heartbeats, args=(queue.db_path, job.id, worker, lease, stop), daemon=True)
+            heartbeat.start()
+            try:
+                os.chdir(job.cwd)
+                result = TASKS[job.kind](**job.payload)
+            except (Exception, SystemExit):
+                queue.fail(job.id, worker, traceback.format_exc())
+                print(f"Worker {worker}: job {job.seq} of {job.batch} failed")
+            else:
+                queue.complete(job.id, worker, result)
+            finally:
+                stop.set()
+                heartbeat.join()
+                os.chdir(initial_folder)
+            jobs_run += 1
+    finally:
+        queue.close()
+
+def run_local(db_path, workers=None, lease=120, poll=0.5):
+    """ Run worker processes on this machine until the queue is empty."""
+    workers = workers or os.cpu_count() or 1
+    processes = [multiprocessing.Process(target=run_worker, args=(db_path, f'{socket.gethostname()}:local{i}', lease, poll, True))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run pipeline stages through a job queue shared by several workers.')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    submit_parser = subparsers.add_parser('submit', help='Split a stage into jobs and add them to the queue')
+    local_parser = subparsers.add_parser('local', help='Submit a stage and run it with workers on this machine')
+    for stage_parser in (submit_parser, local_parser):
+        stage_parser.add_argument('queue', help='SQLite database of the queue')
+        stage_parser.add_argument('--batch', default=None, help='Name of the batch (default: <stage>-<number>)')
+        stage_parser.add_argument('--max_attempts', type=int, default=3, help='Attempts of every job before it fails')
+        stage_parser.add_argument('stage', nargs=argparse.REMAINDER, help='Stage and its arguments, as for ficoro.py')
+    local_parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    worker_parser = subparsers.add_parser('worker', help='Run jobs from the queue')
+    worker_parser.add_argument('queue', help='SQLite database of the queue')
+    worker_parser.add_argument('--lease', type=float, default=120, help='Lease of a job (seconds), renewed by a heartbeat')
+    worker_parser.add_argument('--exit_when_idle', action='store_true', help='Stop when no job is pending or running')
+    collect_parser = subparsers.add_parser('collect', help='Wait for a batch and merge its results')
+    collect_parser.add_argument('queue', help='SQLite database of the queue')
+    collect_parser.add_argument('batch', help='Name of the batch')
+    retry_parser = subparsers.add_parser('retry', help='Retry the failed jobs of a batch')
+    retry_parser.add_argument('queue', help='SQLite database of the queue')
+    retry_parser.add_argument('batch', help='Name of the batch')
+    status_parser = subparsers.add_parser('status', help='Number of jobs of every batch in each state')
+    status_parser.add_argument('queue', help='SQLite database of the queue')
+    args = parser.parse_args()
+
+    # Time the execution of the action
+    start_time = time.time()
+    exit_code = 0
+    if args.action in ('submit', 'local'):
+        command, jobs, finaliser = stage_jobs(args.stage)
+        queue = JobQueue(args.queue)
+        batch = queue.submit(command, jobs, finaliser, args.batch, args.max_attempts)
+        queue.close()
+        print(f"Submitted {len(jobs)} jobs as batch {batch}")
+        if args.action == 'local':
+            run_local(args.queue, args.workers)
+            exit_code = 1 if collect(args.queue, batch) else 0
+    elif args.action == 'worker':
+        print(f"Jobs run: {run_worker(args.queue, lease=args.lease, exit_when_idle=args.exit_when_idle)}")
+    elif args.action == 'collect':
+        exit_code = 1 if collect(args.queue, args.batch) else 0
+    elif args.action == 'retry':
+        queue = JobQueue(args.queue)
+        queue.retry_failed(args.batch)
+        queue.close()
+    else:
+        queue = JobQueue(args.queue)
+        for batch, counts in queue.status().items():
+            print(f"{batch}: " + ", ".join(f"{state} {count}" for state, count in sorted(counts.items())))
+        queue.close()
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
+    sys.exit(exit_code)
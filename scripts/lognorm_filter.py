@@ -1,47 +1,95 @@
 import os
 import sys
-import glob
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy.stats import lognorm, normaltest
-import re
 import time
+import concurrent.futures
 import warnings
+from run_manifest import discover_inputs, atomic_to_csv, RunManifest
+from output_writer import OutputWriter
 
 # Suppress RuntimeWarnings
 warnings.simplefilter("ignore", category=RuntimeWarning)
-plt.rcParams['figure.max_open_warning'] = 50  # Avoid warnings
-
-print(f"########## Removing outliers based on fitted lognorm distribution ###########")
-
-def filter_and_plot_data(folder_path, log_output_folder, output_folder, figure_folder):
-    # Find all .vel files in the folder
-    file_names = glob.glob(os.path.join(folder_path, '*.vel'))
-
-    # Empty list to store data frames
-    dfs = []
-
-    # Load each .vel file as a data frame
-    for file_name in file_names:
-        with open(file_name, 'r') as f:
-            lines = f.readlines()
-
-        data = []
-        for line in lines:
-            line_data = re.split(r'\s+', line.strip())
-            data.append(line_data)
-
-        # Assign column names and remove first row (text) from each data frame
-        df = pd.DataFrame(data)
-        df.columns = df.iloc[0]
-        df = df.iloc[1:]
+def read_vel_file(file_name):
+    """ Read a .vel file with a header line. E.sig and N.sig are parsed as numbers
+    (non-numeric values become NaN) and the other columns are kept as text, so
+    the output files keep the values exactly as written in the input."""
+    df = pd.read_csv(file_name, sep=r'\s+', dtype=str, keep_default_na=False, na_filter=False)
+    df['E.sig'] = pd.to_numeric(df['E.sig'], errors='coerce')
+    df['N.sig'] = pd.to_numeric(df['N.sig'], errors='coerce')
+    return df
+
+def filter_file(file_name, log_output_folder, output_folder, figure_folder, plot=True, writer=None):
+    """ Fit lognormal distributions to the uncertainties of one .vel file, write the
+    stations above the 99th percentiles and the remaining ones, and plot the fit.
+    Without a writer, the tables and the figure are written directly (and are not
+    recorded in a manifest). Returns a small summary of the file."""
+    df = read_vel_file(file_name)
+
+    # Make sure to take only positive values from E.sig and N.sig columns
+    # So here I'm getting the indices of positive values in E.sig and N.sig columns
+    positive_e_sig = df['E.sig'] > 0
+    positive_n_sig = df['N.sig'] > 0
+
+    # Fit a lognormal distribution to the positive E.sig and N.sig columns
+    e_sig_params = lognorm.fit(df['E.sig'][positive_e_sig].dropna())
+    n_sig_params = lognorm.fit(df['N.sig'][positive_n_sig].dropna())
+
+    # Calculate the 99th percentile of the fitted lognormal distributions
+    e_sig_99th = lognorm.ppf(0.99, *e_sig_params)
+    n_sig_99th = lognorm.ppf(0.99, *n_sig_params)
+
+    # Identify stations with uncertainties larger than the 99th percentile
+    e_sig_higher_than_99 = df[df['E.sig'] > e_sig_99th]
+    n_sig_higher_than_99 = df[df['N.sig'] > n_sig_99th]
+    combined_stations_higher_than_99 = pd.concat([e_sig_higher_than_99, n_sig_higher_than_99]).drop_duplicates()
+
+    # Filter out data points that exceed the 99th percentile in the fitted lognormal distribution
+    filtered_df = df[(df['E.sig'] < e_sig_99th) & (df['N.sig'] < n_sig_99th)]
+
+    # Save the stations with uncertainties larger than the 99th percentile and the filtered data to CSV files
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    log_output_file = os.path.join(log_output_folder, f'{name}.csv')
+    output_file = os.path.join(output_folder, f'{name}.csv')
+    if writer is not None:
+        writer.write_table(combined_stations_higher_than_99, log_output_file, sep=' ', index=False)
+        writer.write_table(filtered_df, output_file, sep=' ', index=False)
+    else:
+        atomic_to_csv(combined_stations_higher_than_99, log_output_file, None, sep=' ', index=False)
+        atomic_to_csv(filtered_df, output_file, None, sep=' ', index=False)
+
+    # Plot individual subfigures for each dataset
+    if plot:
+        plot_subfigures(df, name, figure_folder, e_sig_99th, n_sig_99th, writer)
+
+    return {'file_name': name, 'num_removed': len(combined_stations_higher_than_99), 'num_total': len(df),
+            'log_output_file': log_output_file, 'output_file': output_file}
+
+def filter_file_task(file_name, log_output_folder, output_folder, figure_folder, plot, binary):
+    """ filter_file as an independent task of a process pool: the outputs are written
+    by a writer of the task, which is closed before the summary is returned."""
+    with OutputWriter(binary=binary) as writer:
+        summary = filter_file(file_name, log_output_folder, output_folder, figure_folder, plot, writer)
+    return summary
+
+def print_file_summary(summary):
+    """ Print the number of removed stations for a dataset and its output files."""
+    percentage_removed = (summary['num_removed'] / summary['num_total']) * 100
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Number of stations removed for {summary['file_name']}: {summary['num_removed']} / {summary['num_total']} ({percentage_removed:.2f}%)")
+    print(f"Sites excluded: {summary['log_output_file']}")
+    print(f"Filtered velocities: {summary['output_file']}")
 
-        # Convert non-numeric values to NaN
-        df['E.sig'] = pd.to_numeric(df['E.sig'], errors='coerce')
-        df['N.sig'] = pd.to_numeric(df['N.sig'], errors='coerce')
+def filter_and_plot_data(folder_path, log_output_folder, output_folder, figure_folder, binary=False, workers=1, plot=True):
+    """ Filter every .vel file of the input folder. Files are streamed: each one is
+    read, fitted, written and plotted independently, so only the files being
+    processed are held in memory. With workers > 1, the files are processed in
+    parallel by a pool of processes, which return small summaries."""
+    print(f"########## Removing outliers based on fitted lognorm distribution ###########")
 
-        dfs.append(df)
+    # Find all .vel files in the folder (sorted, so that runs are reproducible)
+    file_names = discover_inputs(folder_path, '.vel')
 
     # Create a directory to store the CSV files listing excluded sites
     os.makedirs(log_output_folder, exist_ok=True)
@@ -49,55 +97,37 @@ def filter_and_plot_data(folder_path, log_output_folder, output_folder, figure_f
     # Create a directory to store the CSV files listing filtered output
     os.makedirs(output_folder, exist_ok=True)
 
-    # Iterate over each data frame
-    for i, df in enumerate(dfs):
-        # Make sure to take only positive values from E.sig and N.sig columns
-        # So here I'm getting the indices of positive values in E.sig and N.sig columns
-        positive_e_sig = df['E.sig'] > 0
-        positive_n_sig = df['N.sig'] > 0
-
-        # Fit a lognormal distribution to the positive E.sig and N.sig columns
-        e_sig_params = lognorm.fit(df['E.sig'][positive_e_sig].dropna())
-        n_sig_params = lognorm.fit(df['N.sig'][positive_n_sig].dropna())
-
-        # Fit a lognormal distribution to E.sig and N.sig columns
-        #e_sig_params = lognorm.fit(df['E.sig'].dropna())
-        #n_sig_params = lognorm.fit(df['N.sig'].dropna())
-
-        # Calculate the 99th percentile of the fitted lognormal distributions
-        e_sig_99th = lognorm.ppf(0.99, *e_sig_params)
-        n_sig_99th = lognorm.ppf(0.99, *n_sig_params)
-
-        # Identify stations with uncertainties larger than the 99th percentile
-        e_sig_higher_than_99 = df[df['E.sig'] > e_sig_99th]
-        n_sig_higher_than_99 = df[df['N.sig'] > n_sig_99th]
-        combined_stations_higher_than_99 = pd.concat([e_sig_higher_than_99, n_sig_higher_than_99]).drop_duplicates()
-
-        # Filter out data points that exceed the 99th percentile in the fitted lognormal distribution
-        filtered_df = df[(df['E.sig'] < e_sig_99th) & (df['N.sig'] < n_sig_99th)]
-
-        # Print the number of removed stations for the current dataset
-        file_name = os.path.splitext(os.path.basename(file_names[i]))[0]
-        num_removed = len(combined_stations_higher_than_99)
-        num_total = len(df)
-        percentage_removed = (num_removed / num_total) * 100
-        print(f"----------------------------------------------------------------------------------")
-        print(f"Number of stations removed for {file_name}: {num_removed} / {num_total} ({percentage_removed:.2f}%)")
-
-        # Save the stations with uncertainties larger than the 99th percentile to a CSV file
-        log_output_file = os.path.join(log_output_folder, f'{file_name}.csv')
-        combined_stations_higher_than_99.to_csv(log_output_file, sep=' ', index=False)
-        print(f"Sites excluded: {log_output_file}")
-
-        # Save the filtered data to a CSV file
-        output_file = os.path.join(output_folder, f'{file_name}.csv')
-        filtered_df.to_csv(output_file, sep=' ', index=False)
-        print(f"Filtered velocities: {output_file}")
-
-        # Plot individual subfigures for each dataset
-        plot_subfigures(df, file_name, figure_folder, e_sig_99th, n_sig_99th)
-
-def plot_subfigures(df, file_name, figure_folder, e_sig_99th, n_sig_99th):
+    # Record the checksums of the inputs and outputs in the output folder
+    manifest = RunManifest(output_folder, 'lognorm')
+    manifest.add_inputs(file_names)
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(filter_file_task, file_name, log_output_folder, output_folder, figure_folder, plot, binary)
+                       for file_name in file_names]
+            # Summaries are printed in input order as the files are completed
+            for future in futures:
+                summary = future.result()
+                print_file_summary(summary)
+                for file_path in (summary['log_output_file'], summary['output_file']):
+                    manifest.record(file_path)
+                    if binary:
+                        manifest.record(os.path.splitext(file_path)[0] + '.pkl')
+    else:
+        # Tables and figures are written in the background, off the fitting loop
+        # (with binary=True, tables are also written as pandas pickles)
+        writer = OutputWriter(manifest, binary=binary)
+        for file_name in file_names:
+            print_file_summary(filter_file(file_name, log_output_folder, output_folder, figure_folder, plot, writer))
+        writer.close()
+
+    manifest.save()
+
+def plot_subfigures(df, file_name, figure_folder, e_sig_99th, n_sig_99th, writer=None):
+    # Import matplotlib only when figures are produced, as it is slow to import
+    import matplotlib.pyplot as plt
+    plt.rcParams['figure.max_open_warning'] = 50  # Avoid warnings
+
     # Remove NaN values
     e_sig_values = df['E.sig'].dropna()
     n_sig_values = df['N.sig'].dropna()
@@ -162,22 +192,28 @@ def plot_subfigures(df, file_name, figure_folder, e_sig_99th, n_sig_99th):
     # Save the figure in high definition as PDF, JPG, and PNG files
     figure_file_pdf = os.path.join(figure_folder, f'{file_name}_lognorm_filter.pdf')
 
-    plt.savefig(figure_file_pdf, dpi=300, format='pdf')
+    # The figure is saved by the background writer if there is one
+    if writer is not None:
+        writer.write_figure(fig, figure_file_pdf, dpi=300, format='pdf')
+    else:
+        plt.savefig(figure_file_pdf, dpi=300, format='pdf')
+        plt.close(fig)
 
 if __name__ == "__main__":
     # Check if the correct number of command-line arguments is provided
-    if len(sys.argv) != 5:
-        print("Usage: python lognorm_filter.py ./path2/input_folder ./path2/output_folder ./path2/log_output_folder ./path2/figure_folder")
+    if len(sys.argv) not in (5, 6):
+        print("Usage: python lognorm_filter.py ./path2/input_folder ./path2/output_folder ./path2/log_output_folder ./path2/figure_folder [workers]")
         sys.exit(1)
 
     folder_path = sys.argv[1]
     output_folder = sys.argv[2]
     log_output_folder = sys.argv[3]
     figure_folder = sys.argv[4]
+    workers = int(sys.argv[5]) if len(sys.argv) == 6 else 1
 
     # Time the execution of the function
     start_time = time.time()
-    filter_and_plot_data(folder_path, log_output_folder, output_folder, figure_folder)
+    filter_and_plot_data(folder_path, log_output_folder, output_folder, figure_folder, workers=workers)
     end_time = time.time()
 
     # Calculate and print the elapsed time
@@ -0,0 +1,109 @@
+""" This code removes outliers from the combined velocity fields based on a list
+of geographic coordinates and radii (manual_filter/filter_criteria.csv). A
+KD-tree is built once over the stations of all the combined_vel_<frame>.csv
+files and the criteria are answered as a single batch of radius queries. The
+resulting mask is applied to every reference frame in one pass, producing
+cleaned velocity fields (_clean.csv) and logs of the removed stations
+(_removed.log)."""
+
+""" Import necessary modules """
+import os
+import sys
+import glob
+import time
+import numpy as np
+import pandas as pd
+from station_index import build_station_tree, lonlat_to_xyz, km_to_chord
+
+def read_filter_criteria(criteria_file):
+    """ Read the filter criteria file (center_lon center_lat radius notes). The
+    notes column may contain spaces, so everything after the third column is kept
+    as a single string."""
+    rows = []
+    with open(criteria_file, 'r') as f:
+        next(f)  # Skip the header line
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+            rows.append((float(fields[0]), float(fields[1]), float(fields[2]), ' '.join(fields[3:])))
+    return pd.DataFrame(rows, columns=['center_lon', 'center_lat', 'radius', 'notes'])
+
+def stations_within_criteria(lon, lat, criteria, tree=None):
+    """ Return, for every station, the index of the first criterion whose radius
+    (km) contains it (-1 if none), together with the number of stations matched
+    by each criterion. All the radius queries are answered in one batch against a
+    KD-tree, which can be passed in to reuse it across calls."""
+    if tree is None:
+        tree = build_station_tree(lon, lat)
+    centres = lonlat_to_xyz(criteria['center_lon'].values, criteria['center_lat'].values)
+    matches = tree.query_ball_point(centres, km_to_chord(criteria['radius'].values), return_sorted=False)
+
+    counts = np.array([len(m) for m in matches], dtype=np.int64)
+    first_criterion = np.full(len(lon), len(criteria), dtype=np.int64)
+    if counts.sum():
+        stations = np.concatenate([np.asarray(m, dtype=np.int64) for m in matches])
+        np.minimum.at(first_criterion, stations, np.repeat(np.arange(len(criteria)), counts))
+    first_criterion[first_criterion == len(criteria)] = -1
+    return first_criterion, counts
+
+def read_combined_field(file_name):
+    """ Read a combined velocity field written by combine_vel.py."""
+    return pd.read_csv(file_name, sep=r'\s+')
+
+def manual_filter_combined(combined_folder, criteria_file, output_folder):
+    """ The manual_filter_combined function applies the manual filter criteria to
+    every combined_vel_<frame>.csv file in the combined folder. The frames hold the
+    same stations (possibly in a different order and with slightly different
+    coordinates), so a single KD-tree is built over the unique coordinates of all
+    frames, the criteria are queried once, and the resulting mask is mapped back
+    to the rows of each frame."""
+    os.makedirs(output_folder, exist_ok=True)
+    criteria = read_filter_criteria(criteria_file)
+    file_names = sorted(glob.glob(os.path.join(combined_folder, 'combined_vel_*.csv')))
+    print(f"Number of filter criteria: {len(criteria)}")
+    if not file_names:
+        print(f"No combined velocity fields found in {combined_folder}")
+        return
+
+    dfs = [read_combined_field(file_name) for file_name in file_names]
+    coords = np.concatenate([df[['Lon', 'Lat']].to_numpy(dtype=float) for df in dfs])
+    unique_coords, inverse = np.unique(coords, axis=0, return_inverse=True)
+    unique_criterion, counts = stations_within_criteria(unique_coords[:, 0], unique_coords[:, 1], criteria)
+    frame_criteria = np.split(unique_criterion[inverse.ravel()], np.cumsum([len(df) for df in dfs])[:-1])
+
+    unused = criteria['notes'][counts == 0]
+    if len(unused):
+        print(f"Criteria without matching stations: {', '.join(unused)}")
+
+    for file_name, df, criterion in zip(file_names, dfs, frame_criteria):
+        remove_mask = criterion >= 0
+        base_name = os.path.splitext(os.path.basename(file_name))[0]
+        clean_file = os.path.join(output_folder, f'{base_name}_clean.csv')
+        removed_file = os.path.join(output_folder, f'{base_name}_removed.log')
+        df[~remove_mask].to_csv(clean_file, sep=' ', index=False)
+        # List the removed stations criterion by criterion
+        removed_order = np.flatnonzero(remove_mask)[np.argsort(criterion[remove_mask], kind='stable')]
+        df.iloc[removed_order].to_csv(removed_file, sep=' ', index=False)
+
+        print(f"----------------------------------------------------------------------------------")
+        print(f"Number of stations removed for {base_name}: {remove_mask.sum()} / {len(df)}")
+        print(f"Cleaned velocities: {clean_file}")
+        print(f"Removed stations: {removed_file}")
+
+if __name__ == "__main__":
+    # Check if the correct number of command-line arguments is provided
+    if len(sys.argv) != 4:
+        print("Usage: python manual_filter.py ./path2/combined_folder ./path2/filter_criteria.csv ./path2/output_folder")
+        sys.exit(1)
+
+    combined_folder = sys.argv[1]
+    criteria_file = sys.argv[2]
+    output_folder = sys.argv[3]
+
+    # Time the execution of the manual_filter_combined function
+    start_time = time.time()
+    manual_filter_combined(combined_folder, criteria_file, output_folder)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -0,0 +1,95 @@
+""" Background writer for the tables and figures produced by the filtering stages.
+The filters produce several small outputs per input file (sites excluded,
+filtered velocities, figures). Writing them synchronously interleaves text
+formatting and disk access with the computations. The OutputWriter takes the
+finished tables and figures from the compute loop and writes them from a
+background thread, through the atomic writes and manifests of run_manifest.py.
+
+The queue of pending outputs is bounded (max_pending), so memory stays bounded
+when the disk is slower than the computations: the compute loop then waits for
+a free slot instead of accumulating tables. Tables must not be modified after
+they are submitted, as they are not copied. Figures are closed in pyplot when
+submitted and are only used by the writer afterwards.
+
+With binary=True every table is also written as a pandas pickle (same name,
+.pkl extension), which is considerably faster to read back than the text
+files (pd.read_pickle)."""
+
+""" Import necessary modules """
+import os
+import queue
+import threading
+from run_manifest import atomic_open, atomic_to_csv
+
+class OutputWriter:
+    """ Write tables and figures from background threads. Use as a context manager,
+    or call close() to wait for all pending outputs. Errors raised while writing
+    are re-raised by close()."""
+
+    def __init__(self, manifest=None, binary=False, max_pending=32, workers=1):
+        self.manifest = manifest
+        self.binary = binary
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Do not hide an exception raised by the compute loop behind a write error
+        self.close(raise_errors=exc_type is None)
+
+    def write_table(self, df, file_path, **kwargs):
+        """ Queue a DataFrame to be written with DataFrame.to_csv(**kwargs)."""
+        self._put(('table', df, file_path, kwargs))
+
+    def write_figure(self, fig, file_path, **kwargs):
+        """ Queue a matplotlib figure to be saved with Figure.savefig(**kwargs)."""
+        import matplotlib.pyplot as plt
+        plt.close(fig)
+        self._put(('figure', fig, file_path, kwargs))
+
+    def _put(self, task):
+        if self._errors:
+            self.close()
+        self._queue.put(task)
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                kind, item, file_path, kwargs = task
+                if kind == 'table':
+                    self._write_table(item, file_path, kwargs)
+                else:
+                    with atomic_open(file_path, 'wb') as f:
+                        item.savefig(f, **kwargs)
+            except Exception as error:
+                self._errors.append((task[2], error))
+            finally:
+                self._queue.task_done()
+
+    def _write_table(self, df, file_path, kwargs):
+        atomic_to_csv(df, file_path, self.manifest, **kwargs)
+        if self.binary:
+            binary_path = os.path.splitext(file_path)[0] + '.pkl'
+            with atomic_open(binary_path, 'wb') as f:
+                df.to_pickle(f)
+            if self.manifest is not None:
+                self.manifest.record(binary_path)
+
+    def close(self, raise_errors=True):
+        """ Wait until every queued output is written and stop the threads."""
+        if any(thread.is_alive() for thread in self._threads):
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+        if raise_errors and self._errors:
+            file_path, error = self._errors[0]
+            raise RuntimeError(f"Error writing {file_path} ({len(self._errors)} failed outputs)") from error
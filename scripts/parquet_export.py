@@ -0,0 +1,223 @@
+""" Export of the final products (combined velocity fields, fields with scaled
+uncertainties and the filtered vertical velocity field) as a Parquet dataset
+partitioned by product, frame and spatial cell. The text outputs are written
+as before; the Parquet copy lets a consumer read only the columns, frames and
+region it needs instead of parsing whole files.
+
+Layout of the dataset (hive partitioning, so pyarrow, pandas, DuckDB or Spark
+read the partition values from the paths):
+    <output>/<product>/frame=<frame>/lon_cell=<west>/lat_cell=<south>/part-0.parquet
+where lon_cell and lat_cell are the south-west corner of cells of cell_size
+degrees (default 45, the fields are global but most stations are in a few
+cells, and small files make Parquet slow). Longitudes are stored in [-180, 180). Within a file, rows
+are sorted by the Hilbert index of their position (column Hilbert), so that
+row groups (row_group_size rows) cover small areas and the min/max statistics
+of Lon and Lat written for every row group skip most of them in a bbox query.
+
+The partitions of a product and frame are written to a hidden temporary folder
+and swapped in place of the previous ones once they are complete, so partitions
+of a previous export (e.g. with another cell_size) never remain next to the new
+ones, and readers never see a half-written frame. read_products only reads the
+files listed in dataset.json.
+
+Every file carries key-value metadata ('ficoro' key, JSON) with the product,
+frame, source file and its checksum, the input solutions recorded in the
+manifest of the combination and the export parameters. dataset.json lists the
+files with their number of rows and bounds, and manifest_parquet.json the
+checksums of the files (see run_manifest.py).
+
+Reading a region (see read_products):
+    read_products('./results/parquet', 'combined', frame='eura', bbox=(20, 35, 30, 45), columns=['Lon', 'Lat', 'E.vel'])
+
+Requires pyarrow."""
+
+""" Import necessary modules """
+import os
+import glob
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from run_manifest import atomic_open, file_checksum, RunManifest
+from vertical_combination import VERTICAL_COLUMNS
+
+def normalise_longitudes(lon):
+    """ Longitudes in [-180, 180). Only the longitudes outside the range are shifted
+    (and rounded to 1e-6 degrees, so that the shift does not add rounding noise)."""
+    lon = np.asarray(lon, dtype=float)
+    return np.where(lon >= 180.0, np.round(lon - 360.0, 6), np.where(lon < -180.0, np.round(lon + 360.0, 6), lon))
+
+def hilbert_index(lon, lat, order=16):
+    """ Index of every position along a Hilbert curve covering the globe with a grid
+    of 2**order x 2**order cells (vectorised version of the usual xy2d loop)."""
+    n = 1 << order
+    x = np.clip(((np.asarray(lon, dtype=float) + 180.0) / 360.0 * n).astype(np.int64), 0, n - 1)
+    y = np.clip(((np.asarray(lat, dtype=float) + 90.0) / 180.0 * n).astype(np.int64), 0, n - 1)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # Rotate the quadrant so that the curve is continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return d
+
+def product_files(combined_folder, scaled_folder=None, vertical_file=None):
+    """ Final products to export, as (product, frame, file_path) tuples."""
+    products = []
+    for file_path in sorted(glob.glob(os.path.join(combined_folder, 'combined_vel_*.csv'))):
+        products.append(('combined', os.path.basename(file_path)[len('combined_vel_'):-len('.csv')], file_path))
+    if scaled_folder:
+        for file_path in sorted(glob.glob(os.path.join(scaled_folder, 'combined_vel_*_scaled.csv'))):
+            # e.g. combined_vel_eura_clean_scaled.csv
+            products.append(('scaled', os.path.basename(file_path)[len('combined_vel_'):].split('_')[0], file_path))
+    if vertical_file:
+        # Vertical velocities do not depend on the reference frame of the horizontals
+        products.append(('vertical', 'all', vertical_file))
+    return products
+
+def read_product(file_path):
+    """ Read a product file (space or tab separated). Files without a header line are
+    vertical velocity fields (VERTICAL_COLUMNS)."""
+    with open(file_path, 'r') as f:
+        header = f.readline()
+    sep = '\t' if '\t' in header else ' '
+    if header.split()[0] == 'Lon':
+        return pd.read_csv(file_path, sep=sep, dtype={'Stat': str})
+    return pd.read_csv(file_path, sep=sep, header=None, names=VERTICAL_COLUMNS, dtype={'Stat': str})
+
+def partition_product(df, cell_size=45, order=16):
+    """ Normalise the longitudes, sort the rows by Hilbert index and split them into
+    spatial cells. Yields (lon_cell, lat_cell, DataFrame) tuples in cell order."""
+    df = df.copy()
+    df['Lon'] = normalise_longitudes(df['Lon'])
+    df['Hilbert'] = hilbert_index(df['Lon'], df['Lat'], order)
+    df = df.sort_values('Hilbert', kind='stable')
+    lon_cell = (np.floor(df['Lon'].to_numpy() / cell_size) * cell_size).astype(int)
+    lat_cell = (np.floor(df['Lat'].to_numpy(dtype=float) / cell_size) * cell_size).astype(int)
+    for (west, south), cell in df.groupby([lon_cell, lat_cell], sort=True):
+        yield west, south, cell.reset_index(drop=True)
+
+def write_partition(df, file_path, metadata, row_group_size=2048):
+    """ Write a partition as a Parquet file (zstd compression, statistics of every
+    column), with the export metadata in the schema."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'ficoro': json.dumps(metadata).encode()})
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with atomic_open(file_path, 'wb') as f:
+        pq.write_table(table, f, row_group_size=row_group_size, compression='zstd', write_statistics=True)
+
+def replace_folder(temporary_folder, folder):
+    """ Move a complete temporary folder to `folder`, replacing the previous
+    version (which is first moved aside, so `folder` is never half-written)."""
+    previous = None
+    if os.path.exists(folder):
+        previous = os.path.join(os.path.dirname(folder), f'.{os.path.basename(folder)}.old-{os.getpid()}')
+        os.replace(folder, previous)
+    os.replace(temporary_folder, folder)
+    if previous is not None:
+        shutil.rmtree(previous)
+
+def combination_sources(combined_folder):
+    """ Input solutions recorded in the manifest of the combination (if any)."""
+    manifest_file = os.path.join(combined_folder, 'manifest_combine.json')
+    if not os.path.exists(manifest_file):
+        return []
+    with open(manifest_file, 'r') as f:
+        return sorted(os.path.basename(file_path) for file_path in json.load(f).get('inputs', {}))
+
+def export_parquet(combined_folder, output_folder, scaled_folder=None, vertical_file=None, cell_size=45, row_group_size=2048,
+                   order=16):
+    """ Export the final products to a partitioned Parquet dataset in output_folder.
+    Returns the list of files written (as listed in dataset.json)."""
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = RunManifest(output_folder, 'parquet')
+    parameters = {'cell_size': cell_size, 'row_group_size': row_group_size, 'hilbert_order': order}
+    sources = combination_sources(combined_folder)
+    files = []
+    for product, frame, file_path in product_files(combined_folder, scaled_folder, vertical_file):
+        manifest.add_inputs([file_path])
+        df = read_product(file_path)
+        metadata = {'product': product, 'frame': frame, 'source_file': os.path.basename(file_path),
+                    'source_sha256': file_checksum(file_path), 'sources': sources, 'parameters': parameters}
+        frame_folder = os.path.join(output_folder, product, f'frame={frame}')
+        temporary_folder = os.path.join(output_folder, product, f'.frame={frame}.partial-{os.getpid()}')
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        frame_files = []
+        try:
+            for west, south, cell in partition_product(df, cell_size, order):
+                partition = os.path.join(f'lon_cell={west}', f'lat_cell={south}', 'part-0.parquet')
+                write_partition(cell, os.path.join(temporary_folder, partition), metadata, row_group_size)
+                frame_files.append({'path': os.path.relpath(os.path.join(frame_folder, partition), output_folder).replace(os.sep, '/'),
+                                    'product': product, 'frame': frame, 'rows': len(cell),
+                                    'bounds': [round(float(cell['Lon'].min()), 5), round(float(cell['Lat'].min()), 5),
+                                               round(float(cell['Lon'].max()), 5), round(float(cell['Lat'].max()), 5)]})
+            replace_folder(temporary_folder, frame_folder)
+        except BaseException:
+            shutil.rmtree(temporary_folder, ignore_errors=True)
+            raise
+        manifest.forget(frame_folder)
+        for entry in frame_files:
+            manifest.record(os.path.join(output_folder, entry['path']))
+        files.extend(frame_files)
+        print(f"{product} {frame}: {len(df)} rows")
+
+    dataset_file = os.path.join(output_folder, 'dataset.json')
+    with atomic_open(dataset_file, 'w') as f:
+        json.dump({'partitioning': ['frame', 'lon_cell', 'lat_cell'], 'sort_key': 'Hilbert', 'sources': sources,
+                   'parameters': parameters, 'files': files}, f, indent=1)
+        f.write('\n')
+    manifest.record(dataset_file)
+    manifest.save()
+    return files
+
+def read_products(output_folder, product, frame=None, bbox=None, columns=None):
+    """ Read a product of the dataset, keeping only a frame, a bounding box
+    (west, south, east, north, longitudes in [-180, 180)) and some columns. The
+    filters are pushed down: partitions outside the box are not opened, and row
+    groups are skipped with their Lon and Lat statistics. Only the files listed in
+    dataset.json are read."""
+    import pyarrow.dataset as ds
+    with open(os.path.join(output_folder, 'dataset.json'), 'r') as f:
+        description = json.load(f)
+    file_paths = [os.path.join(output_folder, entry['path']) for entry in description['files']
+                  if entry['product'] == product and (frame is None or entry['frame'] == frame)]
+    dataset = ds.dataset(file_paths, format='parquet', partitioning='hive',
+                         partition_base_dir=os.path.join(output_folder, product))
+    condition = None
+    if bbox is not None:
+        west, south, east, north = bbox
+        cell_size = description['parameters']['cell_size']
+        condition = ((ds.field('lon_cell') > west - cell_size) & (ds.field('lon_cell') <= east) &
+                     (ds.field('lat_cell') > south - cell_size) & (ds.field('lat_cell') <= north) &
+                     (ds.field('Lon') >= west) & (ds.field('Lon') <= east) & (ds.field('Lat') >= south) &
+                     (ds.field('Lat') <= north))
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the final products as a Parquet dataset partitioned by frame and spatial cell.')
+    parser.add_argument('combined_folder', help='Folder of the combined_vel_<frame>.csv files')
+    parser.add_argument('output_folder', help='Folder of the Parquet dataset')
+    parser.add_argument('--scaled_folder', default=None, help='Folder of the fields with scaled uncertainties (*_scaled.csv)')
+    parser.add_argument('--vertical_file', default=None, help='Filtered vertical velocity field (.vel)')
+    parser.add_argument('--cell_size', type=int, default=45, help='Size of the spatial cells (degrees)')
+    parser.add_argument('--row_group_size', type=int, default=2048, help='Rows per row group')
+    args = parser.parse_args()
+
+    # Time the execution of the export
+    start_time = time.time()
+    files = export_parquet(args.combined_folder, args.output_folder, args.scaled_folder, args.vertical_file, args.cell_size,
+                           args.row_group_size)
+    end_time = time.time()
+    print(f"Files written: {len(files)}")
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -3,11 +3,14 @@ import glob
 import pandas as pd
 import numpy as np
 import pygmt
-from geopy.distance import geodesic
+from asset_cache import draw_base_map
 
-def plot_gps_velocities(folder_path, excluded_lognorm, excluded_coherence, figure_folder):
-    # Find all CSV files in the output_coherence_analysis folder
-    file_names = glob.glob(os.path.join(folder_path, '*.csv'))
+MAP_REGION = [-20, 125, 5, 60]
+
+def plot_gps_velocities(folder_path, excluded_lognorm, excluded_coherence, figure_folder, asset_folder='./results/map_assets', offline=False,
+                        file_names=None):
+    # Find all CSV files in the output_coherence_analysis folder (unless the files to plot are given)
+    file_names = file_names or glob.glob(os.path.join(folder_path, '*.csv'))
 
     # Create a new figure for each file
     for file_name in file_names:
@@ -16,16 +19,10 @@ def plot_gps_velocities(folder_path, excluded_lognorm, excluded_coherence, figur
 
         # Set the region and projection of the map
         #fig.basemap(region=[-15, 70, 5, 60], projection='M10c', frame='afg')
-        fig.basemap(region=[-20, 125, 5, 60], projection='M20c', frame='af') # All Alpine-Himalayan belt
-
-        # Create a custom color palette for the relief shading
-        pygmt.makecpt(cmap="gray95,gray90,gray85", series=[-10000, 10000, 100])
-        
-        # Add shaded topography with transparency
-        fig.grdimage(grid="@earth_relief_03m", cmap=True, shading=True, transparency=20) # nan_transparent=True results in error in the latest GMT version
+        fig.basemap(region=MAP_REGION, projection='M20c', frame='af') # All Alpine-Himalayan belt
 
-        # Add coastlines
-        fig.coast(water='white', borders="1/0.1p,gray90", shorelines="0.1p,black", area_thresh=4000, resolution='h')
+        # Add shaded topography, coastlines and borders from the local map assets (see asset_cache.py)
+        draw_base_map(fig, MAP_REGION, asset_folder, offline)
 
         # Read the CSV file from output_coherence_analysis folder
         df = pd.read_csv(file_name, sep=' ', skiprows=1, header=None)
@@ -171,10 +168,11 @@ def plot_gps_velocities(folder_path, excluded_lognorm, excluded_coherence, figur
         #fig.savefig(figure_file_jpg, dpi=300)
         #fig.savefig(figure_file_png, dpi=300)
 
-# Folder paths containing space-separated CSV files
-figures_path = './results/figures'
-folder_path = './results/output_coherence_analysis'
-excluded_lognorm = './results/sites_excluded_lognorm_99'
-excluded_coherence = './results/sites_excluded_coherence'
+if __name__ == "__main__":
+    # Folder paths containing space-separated CSV files
+    figures_path = './results/figures'
+    folder_path = './results/output_coherence_analysis'
+    excluded_lognorm = './results/sites_excluded_lognorm_99'
+    excluded_coherence = './results/sites_excluded_coherence'
 
-plot_gps_velocities(folder_path, excluded_lognorm, excluded_coherence, figures_path)
+    plot_gps_velocities(folder_path, excluded_lognorm, excluded_coherence, figures_path)
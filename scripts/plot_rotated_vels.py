@@ -4,11 +4,13 @@ import glob
 import pandas as pd
 import numpy as np
 import pygmt
-from geopy.distance import geodesic
+from asset_cache import draw_base_map
 
-def plot_gps_velocity_fields(folder_path, figure_folder):
-    # Find all CSV files in the output_coherence_analysis folder
-    file_names = glob.glob(os.path.join(folder_path, '*.csv'))
+MAP_REGION = [-20, 125, 5, 60]
+
+def plot_gps_velocity_fields(folder_path, figure_folder, asset_folder='./results/map_assets', offline=False, file_names=None):
+    # Find all CSV files in the output_coherence_analysis folder (unless the files to plot are given)
+    file_names = file_names or glob.glob(os.path.join(folder_path, '*.csv'))
 
     # Create a new figure for each file
     for file_name in file_names:
@@ -17,16 +19,10 @@ def plot_gps_velocity_fields(folder_path, figure_folder):
 
         # Set the region and projection of the map
         #fig.basemap(region=[-15, 70, 5, 60], projection='M10c', frame='afg') # Only Euromediterranean and Middle East regions
-        fig.basemap(region=[-20, 125, 5, 60], projection='M20c', frame='af') # Entire Alpine-Himalayan belt
-
-        # Create a custom color palette for the relief shading
-        pygmt.makecpt(cmap="gray95,gray90,gray85", series=[-10000, 10000, 100])
-
-        # Add shaded topography with transparency
-        fig.grdimage(grid="@earth_relief_03m", cmap=True, shading=True, transparency=20) # nan_transparent=True results in error in the latest GMT version
+        fig.basemap(region=MAP_REGION, projection='M20c', frame='af') # Entire Alpine-Himalayan belt
 
-        # Add coastlines
-        fig.coast(water='white', borders="1/0.1p,gray90", shorelines="0.1p,black", area_thresh=4000, resolution='h')
+        # Add shaded topography, coastlines and borders from the local map assets (see asset_cache.py)
+        draw_base_map(fig, MAP_REGION, asset_folder, offline)
 
         # Read the CSV file from output_coherence_analysis folder
         #df = pd.read_csv(file_name, sep='\s+', skiprows=1, header=None)
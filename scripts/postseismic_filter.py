@@ -0,0 +1,295 @@
+""" This code removes stations affected by postseismic transient motions from the
+input velocity fields (Key step 1 in the README), before lognorm_filter.py runs.
+Exclusion zones are defined in two ways:
+- Earthquake catalogues (CSV with lon, lat, magnitude and date columns), where
+  each event excludes stations within a magnitude-scaled radius
+  (radius_km = 10 ** (a * magnitude - b)) for a number of years after the event.
+- Polygons in a JSON file, each with an optional start epoch and window length.
+A zone only applies to a velocity solution if its time window overlaps the
+observation span of the solution (given in an optional JSON file, otherwise
+every zone applies). The bounding boxes of all zones are indexed with a packed
+R-tree (STR bulk loading) and the stations of all input files are tested against
+it in a single vectorised pass. Excluded sites are written to one CSV file per
+solution, in the same format as sites_excluded_lognorm_99."""
+
+""" Import necessary modules """
+import os
+import glob
+import json
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from matplotlib.path import Path
+
+KM_PER_DEGREE = 111.19  # Length of one degree of latitude (km) on a sphere of radius 6371 km
+
+class BoxTree:
+    """ Static R-tree over axis-aligned bounding boxes, bulk loaded with the
+    Sort-Tile-Recursive (STR) algorithm. Each level stores the bounds of its nodes
+    and the range of children they cover in the level below, so point queries can
+    descend the tree for all points at once using array operations."""
+
+    def __init__(self, boxes, node_size=16):
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.node_size = node_size
+        self.order = self._str_order(boxes)
+        self.boxes = boxes
+        self.levels = []
+
+        # Build the levels bottom-up: leaves group the sorted boxes, upper levels group nodes
+        bounds = boxes[self.order]
+        while True:
+            n = len(bounds)
+            starts = np.arange(0, n, node_size)
+            counts = np.minimum(node_size, n - starts)
+            node_bounds = np.column_stack((
+                np.minimum.reduceat(bounds[:, 0], starts) if n else np.zeros(0),
+                np.minimum.reduceat(bounds[:, 1], starts) if n else np.zeros(0),
+                np.maximum.reduceat(bounds[:, 2], starts) if n else np.zeros(0),
+                np.maximum.reduceat(bounds[:, 3], starts) if n else np.zeros(0),
+            ))
+            self.levels.append((node_bounds, starts, counts))
+            if len(node_bounds) <= 1:
+                break
+            # Sort the nodes of this level with STR before grouping them into parents
+            node_order = self._str_order(node_bounds)
+            node_bounds = node_bounds[node_order]
+            self.levels[-1] = (node_bounds, starts[node_order], counts[node_order])
+            bounds = node_bounds
+        self.levels.reverse()
+
+    def _str_order(self, boxes):
+        """ Sort-Tile-Recursive order: sort by x centre, cut into vertical slices of
+        about sqrt(n / node_size) leaves, then sort each slice by y centre."""
+        n = len(boxes)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        centres_x = (boxes[:, 0] + boxes[:, 2]) / 2.0
+        centres_y = (boxes[:, 1] + boxes[:, 3]) / 2.0
+        n_leaves = int(np.ceil(n / self.node_size))
+        slice_size = int(np.ceil(np.sqrt(n_leaves))) * self.node_size
+        by_x = np.argsort(centres_x, kind='stable')
+        slice_id = np.empty(n, dtype=np.int64)
+        slice_id[by_x] = np.arange(n) // slice_size
+        return np.lexsort((centres_y, slice_id))
+
+    def query_points(self, x, y):
+        """ Return the (point index, box index) pairs for which the point lies inside
+        the bounding box, descending all levels of the tree in a vectorised way."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if len(self.boxes) == 0 or len(x) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        points = np.arange(len(x))
+        nodes = np.zeros(len(x), dtype=np.int64)
+        for bounds, starts, counts in self.levels:
+            inside = ((bounds[nodes, 0] <= x[points]) & (x[points] <= bounds[nodes, 2]) &
+                      (bounds[nodes, 1] <= y[points]) & (y[points] <= bounds[nodes, 3]))
+            points, nodes = points[inside], nodes[inside]
+            # Expand every surviving node into its children in the level below
+            child_counts = counts[nodes]
+            offsets = np.arange(child_counts.sum()) - np.repeat(np.cumsum(child_counts) - child_counts, child_counts)
+            points = np.repeat(points, child_counts)
+            nodes = np.repeat(starts[nodes], child_counts) + offsets
+
+        # The last expansion points into the STR-ordered boxes
+        box_ids = self.order[nodes]
+        boxes = self.boxes[box_ids]
+        inside = ((boxes[:, 0] <= x[points]) & (x[points] <= boxes[:, 2]) &
+                  (boxes[:, 1] <= y[points]) & (y[points] <= boxes[:, 3]))
+        return points[inside], box_ids[inside]
+
+def decimal_year(values):
+    """ Convert dates (decimal years or date strings such as 2023-02-06) to decimal years."""
+    values = pd.Series(values).reset_index(drop=True)
+    years = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float, copy=True)
+    is_date = np.isnan(years)
+    if is_date.any():
+        dates = pd.DatetimeIndex(pd.to_datetime(values[is_date].astype(str)))
+        start = pd.to_datetime(dates.year.astype(str) + '-01-01')
+        end = pd.to_datetime((dates.year + 1).astype(str) + '-01-01')
+        years[is_date] = np.asarray(dates.year + (dates - start) / (end - start), dtype=float)
+    return years
+
+def normalise_longitude(lon):
+    """ Wrap longitudes to the interval [-180, 180)."""
+    return (np.asarray(lon, dtype=float) + 180.0) % 360.0 - 180.0
+
+def read_catalogue_zones(catalogue_file, radius_a=0.5, radius_b=1.8, window_years=5.0):
+    """ Read an earthquake catalogue (CSV with lon, lat, magnitude and date columns,
+    and optional name and window_years columns) and return one circular exclusion
+    zone per event, with a magnitude-scaled radius."""
+    catalogue = pd.read_csv(catalogue_file)
+    catalogue.columns = [c.strip().lower() for c in catalogue.columns]
+    radius = 10.0 ** (radius_a * catalogue['magnitude'].to_numpy(dtype=float) - radius_b)
+    names = catalogue['name'].astype(str) if 'name' in catalogue else 'M' + catalogue['magnitude'].astype(str) + '_' + catalogue['date'].astype(str)
+    windows = catalogue['window_years'].to_numpy(dtype=float) if 'window_years' in catalogue else np.full(len(catalogue), window_years)
+    return pd.DataFrame({
+        'name': np.asarray(names),
+        'kind': 'circle',
+        'lon': normalise_longitude(catalogue['lon']),
+        'lat': catalogue['lat'].to_numpy(dtype=float),
+        'radius': radius,
+        'start': decimal_year(catalogue['date']),
+        'window': windows,
+        'polygon': None,
+    })
+
+def read_polygon_zones(zones_file, window_years=5.0):
+    """ Read polygon exclusion zones from a JSON file containing a list of objects
+    with 'name', 'polygon' ([[lon, lat], ...]) and optional 'start' (date or
+    decimal year) and 'window_years' keys. Zones without a start epoch always apply."""
+    with open(zones_file, 'r') as file:
+        zones = json.load(file)
+    rows = []
+    for zone in zones:
+        vertices = np.asarray(zone['polygon'], dtype=float)
+        vertices[:, 0] = normalise_longitude(vertices[:, 0])
+        start = decimal_year(pd.Series([zone['start']]))[0] if 'start' in zone else -np.inf
+        window = float(zone.get('window_years', window_years)) if 'start' in zone else np.inf
+        rows.append({'name': zone['name'], 'kind': 'polygon', 'lon': np.nan, 'lat': np.nan, 'radius': np.nan,
+                     'start': start, 'window': window, 'polygon': vertices})
+    return pd.DataFrame(rows, columns=['name', 'kind', 'lon', 'lat', 'radius', 'start', 'window', 'polygon'])
+
+def empty_zone_table():
+    """ Empty zone table, used when neither a catalogue nor a zones file is given."""
+    return pd.DataFrame(columns=['name', 'kind', 'lon', 'lat', 'radius', 'start', 'window', 'polygon'])
+
+def zone_bounding_boxes(zones):
+    """ Bounding boxes (min_lon, min_lat, max_lon, max_lat) of the exclusion zones.
+    Circle boxes are widened in longitude by 1 / cos(latitude)."""
+    boxes = np.zeros((len(zones), 4))
+    for i, zone in enumerate(zones.itertuples(index=False)):
+        if zone.kind == 'polygon':
+            boxes[i] = [zone.polygon[:, 0].min(), zone.polygon[:, 1].min(), zone.polygon[:, 0].max(), zone.polygon[:, 1].max()]
+        else:
+            dlat = zone.radius / KM_PER_DEGREE
+            dlon = zone.radius / (KM_PER_DEGREE * max(np.cos(np.radians(zone.lat)), 1e-6))
+            boxes[i] = [zone.lon - dlon, zone.lat - dlat, zone.lon + dlon, zone.lat + dlat]
+    return boxes
+
+def haversine_distance(lon1, lat1, lon2, lat2):
+    """ Haversine distance in kilometers (same formula as coherence_filter.py)."""
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * np.arcsin(np.sqrt(a))
+
+def active_zones(zones, solution_names, spans):
+    """ Boolean matrix (solutions x zones) telling whether the time window of each
+    zone [start, start + window] overlaps the observation span of each solution.
+    Solutions without a known span are tested against every zone."""
+    span_start = np.array([spans.get(name, [-np.inf, np.inf])[0] for name in solution_names], dtype=float)
+    span_end = np.array([spans.get(name, [-np.inf, np.inf])[1] for name in solution_names], dtype=float)
+    zone_start = zones['start'].to_numpy(dtype=float)
+    zone_end = zone_start + zones['window'].to_numpy(dtype=float)
+    return (zone_start[None, :] <= span_end[:, None]) & (zone_end[None, :] >= span_start[:, None])
+
+def postseismic_mask(lon, lat, file_index, zones, active):
+    """ Flag the stations falling inside an active exclusion zone. Candidate
+    (station, zone) pairs come from the R-tree, then circles are tested with the
+    haversine distance and polygons with a point-in-polygon test. Returns the
+    boolean mask of excluded stations and the name of the zone that excluded them."""
+    lon = normalise_longitude(lon)
+    tree = BoxTree(zone_bounding_boxes(zones))
+    points, zone_ids = tree.query_points(lon, lat)
+
+    # Keep only the pairs where the zone is active for the solution of the station
+    keep = active[file_index[points], zone_ids]
+    points, zone_ids = points[keep], zone_ids[keep]
+
+    is_circle = (zones['kind'].to_numpy() == 'circle')[zone_ids]
+    hit = np.zeros(len(points), dtype=bool)
+    hit[is_circle] = haversine_distance(lon[points[is_circle]], lat[points[is_circle]],
+                                        zones['lon'].to_numpy()[zone_ids[is_circle]],
+                                        zones['lat'].to_numpy()[zone_ids[is_circle]]) <= zones['radius'].to_numpy()[zone_ids[is_circle]]
+    for zone_id in np.unique(zone_ids[~is_circle]):
+        pairs = np.flatnonzero(zone_ids == zone_id)
+        path = Path(zones['polygon'].iloc[zone_id])
+        hit[pairs] = path.contains_points(np.column_stack((lon[points[pairs]], lat[points[pairs]])))
+
+    excluded = np.zeros(len(lon), dtype=bool)
+    excluded[points[hit]] = True
+    zone_names = np.full(len(lon), '', dtype=object)
+    # Report the first zone (in input order) that excluded each station
+    hit_points, hit_zones = points[hit], zone_ids[hit]
+    order = np.lexsort((hit_zones, hit_points))
+    first_points, first = np.unique(hit_points[order], return_index=True)
+    zone_names[first_points] = zones['name'].to_numpy()[hit_zones[order][first]]
+    return excluded, zone_names
+
+def filter_postseismic(folder_path, output_folder, log_output_folder, catalogue_file=None, zones_file=None,
+                       spans_file=None, radius_a=0.5, radius_b=1.8, window_years=5.0):
+    """ The filter_postseismic function reads every .vel file in the input folder,
+    masks the stations located in active exclusion zones and writes the filtered
+    velocities and the excluded sites for each file."""
+    zones = []
+    if catalogue_file:
+        zones.append(read_catalogue_zones(catalogue_file, radius_a, radius_b, window_years))
+    if zones_file:
+        zones.append(read_polygon_zones(zones_file, window_years))
+    zones = pd.concat(zones, ignore_index=True) if zones else empty_zone_table()
+    print(f"Number of exclusion zones: {len(zones)}")
+
+    spans = {}
+    if spans_file:
+        with open(spans_file, 'r') as file:
+            spans = json.load(file)
+
+    # Read all the input files into one table, keeping the file index of each station
+    file_names = sorted(glob.glob(os.path.join(folder_path, '*.vel')))
+    solution_names = [os.path.splitext(os.path.basename(f))[0] for f in file_names]
+    dfs = [pd.read_csv(f, sep=r'\s+') for f in file_names]
+    if not dfs:
+        print(f"No .vel files found in {folder_path}")
+        return
+    lengths = [len(df) for df in dfs]
+    file_index = np.repeat(np.arange(len(dfs)), lengths)
+    lon = np.concatenate([df['Lon'].to_numpy(dtype=float) for df in dfs])
+    lat = np.concatenate([df['Lat'].to_numpy(dtype=float) for df in dfs])
+
+    missing = [name for name in solution_names if name not in spans]
+    if spans_file and missing:
+        print(f"No observation span for {', '.join(missing)}: all zones applied")
+
+    excluded, zone_names = postseismic_mask(lon, lat, file_index, zones, active_zones(zones, solution_names, spans))
+
+    os.makedirs(output_folder, exist_ok=True)
+    os.makedirs(log_output_folder, exist_ok=True)
+    for df, name, mask, names in zip(dfs, solution_names, np.split(excluded, np.cumsum(lengths)[:-1]),
+                                     np.split(zone_names, np.cumsum(lengths)[:-1])):
+        log_output_file = os.path.join(log_output_folder, f'{name}.csv')
+        df[mask].to_csv(log_output_file, sep=' ', index=False)
+        output_file = os.path.join(output_folder, f'{name}.vel')
+        df[~mask].to_csv(output_file, sep=' ', index=False)
+
+        num_removed = int(mask.sum())
+        percentage_removed = (num_removed / len(df)) * 100 if len(df) else 0.0
+        print(f"----------------------------------------------------------------------------------")
+        print(f"Number of stations removed for {name}: {num_removed} / {len(df)} ({percentage_removed:.2f}%)")
+        if num_removed:
+            print(f"Exclusion zones: {', '.join(sorted(set(names[mask])))}")
+        print(f"Sites excluded: {log_output_file}")
+        print(f"Filtered velocities: {output_file}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remove GNSS stations affected by postseismic transient motions.')
+    parser.add_argument('folder_path', help='Path to the input folder containing .vel files')
+    parser.add_argument('output_folder', help='Path to the folder for the filtered .vel files')
+    parser.add_argument('log_output_folder', help='Path to the folder for the excluded sites')
+    parser.add_argument('--catalogue', type=str, default='', help='CSV earthquake catalogue (lon, lat, magnitude, date)')
+    parser.add_argument('--zones_json', type=str, default='', help='JSON file with polygon exclusion zones')
+    parser.add_argument('--spans_json', type=str, default='', help='JSON file with the observation span [start, end] of each solution')
+    parser.add_argument('--radius_a', type=float, default=0.5, help='Radius scaling: radius_km = 10 ** (a * M - b)')
+    parser.add_argument('--radius_b', type=float, default=1.8, help='Radius scaling: radius_km = 10 ** (a * M - b)')
+    parser.add_argument('--window_years', type=float, default=5.0, help='Default duration of the postseismic window (years)')
+    args = parser.parse_args()
+
+    # Time the execution of the filter_postseismic function
+    start_time = time.time()
+    filter_postseismic(args.folder_path, args.output_folder, args.log_output_folder, args.catalogue, args.zones_json,
+                       args.spans_json, args.radius_a, args.radius_b, args.window_years)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -0,0 +1,171 @@
+""" This code reports the consistency of every input solution (publication) with
+the combined velocity field. combine_vel.py replaces the velocities of each group
+of collocated stations by their median after removing outliers, but it drops the
+source of each row, so it is not possible to see afterwards which solution is
+systematically biased or noisy with respect to the consensus.
+
+Here the groups and combined velocities of combine_vel.py are computed again for
+the same input folder (groups of stations closer than 1.11 km, IQR outlier removal
+and median, see station_index.py), keeping the group of every row. The residuals
+of every row with respect to the combined velocity of its group are then
+aggregated per solution, for all the frames at once:
+    - Rows, Compared: number of rows, and rows in groups with other solutions
+      (stations without other solutions are their own combined velocity)
+    - E.bias, N.bias: mean residuals (mm/yr)
+    - E.rms, N.rms, H.rms: root mean square of the residuals (mm/yr)
+    - Chi2: mean of the squared residuals normalised by the formal uncertainties
+      (per component, so ~1 if the uncertainties describe the scatter)
+    - Outlier.rate: fraction of the compared rows removed as outliers
+Residuals include the row itself in the median, as in the combination.
+
+The input is either a folder of .vel files of one frame, or a folder with one
+subfolder per frame (e.g. ./results/igb14_no_comb). Outputs (in the report folder):
+    - publication_report.csv: one row per solution and frame
+    - residuals_<frame>.csv: the residuals of every row, with its group number
+    - figures/publication_report_<frame>.pdf: bias and RMS per solution (optional)"""
+
+""" Import necessary modules """
+import os
+import time
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from station_index import (read_combination_inputs, group_close_stations, padded_group_indices, take_padded,
+                           padded_median, grouped_iqr_inliers, frame_name)
+from run_manifest import discover_inputs, RunManifest
+from output_writer import OutputWriter
+
+def frame_folders(folder_path):
+    """ The folder itself if it contains .vel files, otherwise its subfolders that
+    contain .vel files (sorted)."""
+    if discover_inputs(folder_path, '.vel'):
+        return [folder_path]
+    subfolders = sorted(os.path.join(folder_path, name) for name in os.listdir(folder_path))
+    return [subfolder for subfolder in subfolders if os.path.isdir(subfolder) and discover_inputs(subfolder, '.vel')]
+
+def consensus_velocities(df, labels):
+    """ Combined East and North velocity of every group (median of the inliers,
+    rounded as in combine_vel.py) and the inlier flag of every row."""
+    velocities = df[['E.vel', 'N.vel']].to_numpy(dtype=float)
+    n_groups = labels.max() + 1 if len(labels) else 0
+    combined = np.full((n_groups, 2), np.nan)
+    inlier_rows = np.zeros(len(df), dtype=bool)
+    for ids, index in padded_group_indices(labels):
+        padded = take_padded(velocities, index)
+        inliers = grouped_iqr_inliers(padded[..., 0], padded[..., 1])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            combined[ids] = np.round(padded_median(np.where(inliers[..., None], padded, np.nan), axis=1), 2)
+        valid = index >= 0
+        inlier_rows[index[valid]] = inliers[valid]
+    return combined, inlier_rows
+
+def frame_residuals(input_folder):
+    """ Residuals of every row of a frame with respect to the combined velocity of
+    its group. Returns a DataFrame with the input columns, the group number, the
+    size of the group, the residuals and the inlier flag."""
+    df = read_combination_inputs(input_folder)
+    file_names = [os.path.basename(file_path) for file_path in discover_inputs(input_folder, '.vel')]
+    frame = frame_name(input_folder, file_names)
+    labels = group_close_stations(df['Lon'].to_numpy(dtype=float), df['Lat'].to_numpy(dtype=float))
+    combined, inliers = consensus_velocities(df, labels)
+
+    residuals = df.copy()
+    residuals['Frame'] = frame
+    # Solution name without the frame suffix, so that solutions can be compared across frames
+    residuals['Solution'] = residuals['Ref'].str.replace(f'_{frame}$', '', regex=True)
+    residuals['Group'] = labels
+    residuals['Num'] = np.bincount(labels, minlength=len(combined))[labels] if len(labels) else 0
+    residuals['E.res'] = residuals['E.vel'] - combined[labels, 0] if len(labels) else np.nan
+    residuals['N.res'] = residuals['N.vel'] - combined[labels, 1] if len(labels) else np.nan
+    residuals['Inlier'] = inliers
+    return residuals
+
+def publication_statistics(residuals):
+    """ Bias, RMS, chi2 and outlier rate of every solution and frame, computed in a
+    single group-by over the residuals of all the frames."""
+    compared = residuals['Num'] > 1
+    e_res = residuals['E.res'].where(compared)
+    n_res = residuals['N.res'].where(compared)
+    # Rows without formal uncertainties do not contribute to the chi2
+    e_sig = residuals['E.sig'].where(residuals['E.sig'] > 0)
+    n_sig = residuals['N.sig'].where(residuals['N.sig'] > 0)
+    terms = pd.DataFrame({
+        'Frame': residuals['Frame'], 'Solution': residuals['Solution'],
+        'Rows': 1, 'Compared': compared.astype(int),
+        'E.bias': e_res, 'N.bias': n_res,
+        'E.sq': e_res ** 2, 'N.sq': n_res ** 2, 'H.sq': e_res ** 2 + n_res ** 2,
+        'Chi2': ((e_res / e_sig) ** 2 + (n_res / n_sig) ** 2) / 2,
+        'Outlier.rate': (~residuals['Inlier']).astype(float).where(compared)})
+    statistics = terms.groupby(['Frame', 'Solution'], sort=True).agg({
+        'Rows': 'sum', 'Compared': 'sum', 'E.bias': 'mean', 'N.bias': 'mean', 'E.sq': 'mean', 'N.sq': 'mean',
+        'H.sq': 'mean', 'Chi2': 'mean', 'Outlier.rate': 'mean'}).reset_index()
+    statistics[['E.sq', 'N.sq', 'H.sq']] = np.sqrt(statistics[['E.sq', 'N.sq', 'H.sq']])
+    statistics = statistics.rename(columns={'E.sq': 'E.rms', 'N.sq': 'N.rms', 'H.sq': 'H.rms'})
+    return statistics.round({'E.bias': 3, 'N.bias': 3, 'E.rms': 3, 'N.rms': 3, 'H.rms': 3, 'Chi2': 3,
+                             'Outlier.rate': 4})
+
+def plot_frame_report(statistics, frame):
+    """ Figure with the bias and RMS of every solution of a frame."""
+    import matplotlib.pyplot as plt
+    frame_statistics = statistics[(statistics['Frame'] == frame) & (statistics['Compared'] > 0)]
+    positions = np.arange(len(frame_statistics))
+    fig, (ax_bias, ax_rms) = plt.subplots(1, 2, figsize=(12, max(4, 0.25 * len(frame_statistics))), sharey=True)
+    ax_bias.barh(positions - 0.2, frame_statistics['E.bias'], height=0.4, label='East')
+    ax_bias.barh(positions + 0.2, frame_statistics['N.bias'], height=0.4, label='North')
+    ax_bias.axvline(0, color='black', linewidth=0.8)
+    ax_bias.set_xlabel('Mean residual (mm/yr)')
+    ax_bias.legend()
+    ax_rms.barh(positions - 0.2, frame_statistics['E.rms'], height=0.4, label='East')
+    ax_rms.barh(positions + 0.2, frame_statistics['N.rms'], height=0.4, label='North')
+    ax_rms.set_xlabel('RMS of the residuals (mm/yr)')
+    ax_bias.set_yticks(positions)
+    ax_bias.set_yticklabels(frame_statistics['Solution'])
+    ax_bias.invert_yaxis()
+    fig.suptitle(f'Residuals with respect to the combined velocity field ({frame})')
+    fig.tight_layout()
+    return fig
+
+def publication_report(folder_path, report_folder, figures=False):
+    """ Compute the residuals of every frame found in folder_path and write the
+    per-solution report to report_folder. Returns the report as a DataFrame."""
+    os.makedirs(report_folder, exist_ok=True)
+    manifest = RunManifest(report_folder, 'report')
+    frames = []
+    with OutputWriter(manifest) as writer:
+        for input_folder in frame_folders(folder_path):
+            manifest.add_inputs(discover_inputs(input_folder, '.vel'))
+            residuals = frame_residuals(input_folder)
+            frame = residuals['Frame'].iloc[0]
+            print(f"Frame {frame}: {len(residuals)} rows, {residuals['Group'].max() + 1} groups")
+            writer.write_table(residuals.drop(columns=['Frame', 'Solution']),
+                               os.path.join(report_folder, f'residuals_{frame}.csv'), sep=',', index=False)
+            frames.append(residuals)
+
+        residuals = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+            columns=['Frame', 'Solution', 'Num', 'E.res', 'N.res', 'E.sig', 'N.sig', 'Inlier'])
+        statistics = publication_statistics(residuals)
+        writer.write_table(statistics, os.path.join(report_folder, 'publication_report.csv'), sep=',', index=False)
+        if figures:
+            for frame in statistics['Frame'].unique():
+                writer.write_figure(plot_frame_report(statistics, frame),
+                                    os.path.join(report_folder, 'figures', f'publication_report_{frame}.pdf'), format='pdf')
+    manifest.save()
+    return statistics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Consistency of every input solution with the combined velocity field.')
+    parser.add_argument('folder_path', help='Folder with the .vel files of one frame, or with one subfolder per frame')
+    parser.add_argument('report_folder', help='Folder where the report and the residuals are written')
+    parser.add_argument('--figures', action='store_true', help='Plot the bias and RMS of the solutions of every frame')
+    args = parser.parse_args()
+
+    # Time the execution of the report
+    start_time = time.time()
+    statistics = publication_report(args.folder_path, args.report_folder, args.figures)
+    end_time = time.time()
+    with pd.option_context('display.width', 200, 'display.max_rows', 500):
+        print(statistics.to_string(index=False))
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -0,0 +1,785 @@
+""" Frozen copies of the pipeline stages as they were before the performance work:
+combine_velocities (combine_vel.py), filter_and_plot_data (lognorm_filter.py),
+parallel_filter_gps_velocities (coherence_filter.py) and harmonise_uncertainties
+(uncertainty_scaling_combined.py), with the helper functions they use.
+equivalence_check.py runs them as the reference implementations, and checks the
+fast kernels against make_groups, create_distance_dict and remove_outliers. The
+stages themselves are optimised in place, so comparing them with their own
+earlier outputs would not detect a regression: the code below must not be
+optimised or otherwise modified.
+
+The only differences with the original code are: inputs are listed in sorted
+order, as in every stage since run_manifest.py (the order decides which station
+of a group is chosen), the banners printed at import are removed,
+figures are closed once saved instead of shown, errors raised in the threads of
+parallel_filter_gps_velocities are re-raised, and the vertical median of a group
+whose vertical velocities are all zero is rounded with round() (the median is
+then a float NaN, and NaN.round(2) raised AttributeError)."""
+
+""" Import necessary modules """
+import os
+import glob
+import re
+import warnings
+import concurrent.futures
+from itertools import product
+from math import sin, cos, sqrt, atan2, radians
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+from scipy.stats import lognorm
+import matplotlib.pyplot as plt
+
+# Warnings ignored by the original modules
+warnings.simplefilter(action='ignore', category=FutureWarning)
+warnings.simplefilter("ignore", category=RuntimeWarning)
+
+""" combine_vel.py """
+
+""" Implement a version of the Union-Find (also known as Disjoint Set) data 
+structure. The purpose of these functions is to track and merge groups of
+nearby GNSS stations""" 
+
+def find(parent, i):
+    if parent[i] == i:
+        return i
+    return find(parent, parent[i])
+
+def union(parent, rank, x, y):
+    xroot = find(parent, x)
+    yroot = find(parent, y)
+    if rank[xroot] < rank[yroot]:
+        parent[xroot] = yroot
+    elif rank[xroot] > rank[yroot]:
+        parent[yroot] = xroot
+    else:
+        parent[yroot] = xroot
+        rank[xroot] += 1
+
+# Modified version of make_groups function to include unconnected stations
+
+def make_groups(indices):
+    """ make_groups is a function that uses the above Union-Find implementation 
+    to group GNSS stations based on their proximity. It takes a list of indices
+    as input and returns a list of groups of indices. Each group contains the 
+    indices of stations that are close to each other."""
+
+    parent = {}
+    rank = {}
+
+    for i, j in indices:
+        if i not in parent:
+            parent[i] = i
+            rank[i] = 0
+        if j not in parent:
+            parent[j] = j
+            rank[j] = 0
+        union(parent, rank, i, j)
+
+    groups = {}
+    for i in parent:
+        root = find(parent, i)
+        if root not in groups:
+            groups[root] = []
+        groups[root].append(i)
+
+    # Extract all unique indices from indices list
+    all_indices = set(i for i, _ in indices) | set(j for _, j in indices)
+    
+    # Add stations that are not close to any other station.
+    for idx in all_indices:
+        if idx not in parent:
+            groups[idx] = [idx]
+
+    return list(groups.values())
+
+def calculate_distance(lat1, lon1, lat2, lon2):
+    """ The calculate_distance function computes the Haversine distance between two sets 
+    of latitude and longitude values, returning the result in kilometers."""
+
+    # Calculate the distance between two coordinates in kilometers
+    R = 6371.0  # approximate radius of Earth in km
+    dlon = radians(lon2) - radians(lon1)
+    dlat = radians(lat2) - radians(lat1)
+    a = sin(dlat / 2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    distance = R * c
+    return distance
+
+def remove_outliers(data, east_col='E.vel', north_col='N.vel', up_col='U.vel'):
+    """ The remove_outliers function removes outliers from the dataset based on the 
+    magnitude and azimuthal direction of the velocity vectors. It takes a DataFrame 
+    as input and returns the data without outliers and the outliers. The function
+    implements the Interquartile Range (IQR) method to detect outliers."""
+
+    # Calculate the magnitude of the velocity vectors
+    magnitudes = np.sqrt(data[east_col] ** 2 + data[north_col] ** 2)
+
+    # Calculate the azimuthal direction (in radians) of the velocity vectors
+    azimuths = np.arctan2(data[north_col], data[east_col])
+
+    # Calculate the median magnitude and median azimuth
+    median_magnitude = np.median(magnitudes)
+    median_azimuth = np.median(azimuths)
+
+    # Calculate the magnitude and azimuthal differences from the median
+    magnitude_diffs = np.abs(magnitudes - median_magnitude)
+    azimuth_diffs = np.abs(np.arctan2(np.sin(azimuths - median_azimuth), np.cos(azimuths - median_azimuth)))
+
+    # Compute the Interquartile Range (IQR) for both magnitude and azimuthal differences
+    Q1_magnitude = np.percentile(magnitude_diffs, 25)
+    Q3_magnitude = np.percentile(magnitude_diffs, 75)
+    iqr_magnitude = Q3_magnitude - Q1_magnitude
+
+    Q1_azimuth = np.percentile(azimuth_diffs, 25)
+    Q3_azimuth = np.percentile(azimuth_diffs, 75)
+    iqr_azimuth = Q3_azimuth - Q1_azimuth
+
+    # Define the thresholds for outlier detection
+    lower_magnitude_threshold = Q1_magnitude - 1.5 * iqr_magnitude
+    upper_magnitude_threshold = Q3_magnitude + 1.5 * iqr_magnitude
+
+    lower_azimuth_threshold = Q1_azimuth - 1.5 * iqr_azimuth
+    upper_azimuth_threshold = Q3_azimuth + 1.5 * iqr_azimuth
+
+    # Find the indices of stations with magnitude or azimuthal differences exceeding the thresholds
+    outlier_indices = data.index[
+        (magnitude_diffs < lower_magnitude_threshold) |
+        (magnitude_diffs > upper_magnitude_threshold) |
+        (azimuth_diffs < lower_azimuth_threshold) |
+        (azimuth_diffs > upper_azimuth_threshold)
+    ]
+
+    # Check if all data points are outliers
+    if len(outlier_indices) == len(data):
+        # Compute horizontal and vertical median velocities separately. 
+        # Return the median East and North velocity components as there are no valid data points left
+        median_velocities = data[[east_col, north_col]].median()
+        # For the vertical component, consider only non-zero values in the median calculation
+        median_velocities[up_col] = data[data[up_col] != 0][up_col].median()
+        # If all values are zero, return 0.00 as the median (later, the code will detect zero values and assign NaN)
+        if data[data[up_col] != 0][up_col].empty:
+            print("Warning: All vertical velocities are zero. Assigning 0.00 as the median.")
+            median_velocities[up_col] = round(0.00,2)
+        return median_velocities, pd.DataFrame()
+
+    # Remove the outliers from the dataset to get the data without outliers
+    data_without_outliers = data.drop(outlier_indices)
+    outliers = data.loc[outlier_indices]
+
+    # Return the data without outliers and the outliers
+    return data_without_outliers, outliers
+
+def create_distance_dict(stations, threshold=1.11):
+    """ Instead of creating a separation matrix for station distances, a dictionary 
+    approach is used to efficiently map stations within a certain distance of each other.
+    This approach reduces the time complexity of the algorithm from O(n^2) to O(n)."""
+    distance_dict = {}
+    for i, j in product(range(len(stations)), repeat=2):
+        distance = calculate_distance(stations[i][1], stations[i][0], stations[j][1], stations[j][0])
+        if distance < threshold:
+            if i not in distance_dict:
+                distance_dict[i] = set()
+            distance_dict[i].add(j)
+    return distance_dict
+
+def combine_velocities(input_folder, combined_folder):
+    """ The combine_velocities function takes an input folder path containing previously 
+    filtered .vel files and an output folder path, where the combined velocity field in 
+    different reference frames will be saved. The combination is done by:
+    - Reading multiple .vel files and merging their data.
+    - Creating a distance dictionary that maps station pairs based on their proximity.
+    - Using the distance dictionary, it groups close stations together.
+    For each group of close stations, it:
+        - Removes outliers from the group based on magnitude and azimuthal direction differences.
+        - Computes the median of the velocities and uncertainties for each component.
+        - Updates the velocity and other fields for the group based on the first station in the group.
+        - Records statistics for the group (number of solutions per station)
+    - After processing all groups, it saves the combined velocity field as a .csv file"""
+
+    # Create the output folders if they don't exist
+    os.makedirs(combined_folder, exist_ok=True)
+
+    # Read all .vel files and merge them into a single velocity field
+    file_paths = sorted(f for f in os.listdir(input_folder) if f.endswith('.vel'))
+    dfs = []
+    for file_path in file_paths:
+        basename = os.path.splitext(os.path.basename(file_path))[0]
+        # If basename ends with igb14 set skiprows to 0, otherwise set skiprows to 4, because the igb14 files have no header
+        if basename.endswith('igb14'):
+            df = pd.read_csv(os.path.join(input_folder, file_path), sep=r'\s+', header=None, skiprows=0)
+        else:
+            df = pd.read_csv(os.path.join(input_folder, file_path), sep=r'\s+', header=None, skiprows=4)
+        df.columns = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+        df['Ref'] = basename
+        dfs.append(df)
+    combined_df = pd.concat(dfs, ignore_index=True)
+
+    # Get the coordinates of all stations in the combined velocity field as a numpy array of shape (n, 2) where n is the number of stations 
+    stations = combined_df[['Lon', 'Lat']].values
+    
+    # Use the distance dictionary instead of a separation matrix to reduce the time complexity of the algorithm
+    distance_dict = create_distance_dict(stations)
+    close_stations = [(i, j) for i, neighbours in distance_dict.items() for j in neighbours] # List of tuples of close station pairs
+
+    # Group close stations together based on the distance dictionary
+    close_stations_groups = make_groups(close_stations) # List of lists of close stations
+
+    # Check the length of the close_stations_groups list
+    print("Number of groups of close stations: {}".format(len(close_stations_groups)))
+
+    # Create a folder called statistics inside the combined folder path to store the statistics of the combined velocity fields
+    statistics_folder = os.path.join(combined_folder, "statistics")
+    os.makedirs(statistics_folder, exist_ok=True)
+
+    # Create a DataFrame to store the combined velocity fields. Only if basename ends with eura
+    if basename.endswith('eura'):
+        aggregated_df = pd.DataFrame()
+
+    # Create a DataFrame to store statistics of the combined velocity field. Only if basename ends with eura
+    if basename.endswith('eura'):
+        statistics_df = pd.DataFrame(columns=['Lon', 'Lat', 'Stat', 'Num'])
+    
+    for group in close_stations_groups:
+        # Check if there is more than one station in the group
+        if len(group) > 1:
+            # Extract the relevant data for this group of stations
+            group_df = combined_df.loc[group]
+            group_df.columns = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat','Ref']
+
+            # Save the group_df to the aggregated_df DataFrame to be exported later as a CSV file for debugging purposes. Only if basename ends with eura
+            if group_df['Ref'].iloc[0].endswith('eura'):
+                aggregated_df = pd.concat([aggregated_df, group_df], ignore_index=True)
+            
+            # Step 1: Remove outliers based on magnitude and azimuthal direction differences
+            # For simplicity, we only consider the 'E.vel' and 'N.vel' components
+            group_df[['E.vel', 'N.vel', 'U.vel']], outliers = remove_outliers(group_df[['E.vel', 'N.vel', 'U.vel']])
+
+            # Step 2: Compute the median of horzontal and vertical velocities separately
+            # For the vertical component, we only include non-zero values in the median calculation. 
+            median_velocities = group_df[['E.vel', 'N.vel']].median().round(2)
+            median_velocities['U.vel'] = round(group_df[group_df['U.vel'] != 0]['U.vel'].median(), 2)
+            # If all vertical velocities are zero (i.e., the input velocity fields did not estimate verticals), return NaN as the median.
+            if group_df[group_df['U.vel'] != 0]['U.vel'].empty:
+                print("Warning: All vertical velocities are zero. Assigning NaN as the median.")
+                median_velocities['U.vel'] = np.nan
+            
+            # Step 3: Compute median uncertainties for each velocity component
+            uncertainties = group_df[['E.sig', 'N.sig', 'U.sig']].median()
+            uncertainties = uncertainties.round(2).astype('float')
+            
+            # Pick the first station in the group
+            chosen_station_idx = 0
+            chosen_station = group_df.iloc[chosen_station_idx]
+
+            # Update the group_df with the combined values
+            group_df[['E.vel', 'N.vel', 'U.vel']] = median_velocities
+            group_df[['E.sig', 'N.sig', 'U.sig']] = uncertainties
+            group_df['Lon'] = chosen_station['Lon'].round(5)
+            group_df['Lat'] = chosen_station['Lat'].round(5)
+
+            # Keep only the chosen station in the 'Stat' column
+            group_df['Stat'] = chosen_station['Stat']
+            
+            # Assign 'E.adj', 'N.adj', 'U.adj', and 'Corr' values from the chosen station to the group DataFrame
+            group_df['E.adj'] = chosen_station['E.adj'].round(2)
+            group_df['N.adj'] = chosen_station['N.adj'].round(2)
+            group_df['U.adj'] = chosen_station['U.adj'].round(2)
+            group_df['Corr'] = chosen_station['Corr'].round(3)
+
+            # Save the number of stations in the group to the statistics_df DataFrame if basename ends with eura
+            if chosen_station['Ref'].endswith('eura'):
+                statistics_to_add = pd.DataFrame({
+                    'Lon': [chosen_station['Lon'].round(5)],
+                    'Lat': [chosen_station['Lat'].round(5)],
+                    'Stat': [chosen_station['Stat']],
+                    'Num': [len(group)]
+                })
+                statistics_df = pd.concat([statistics_df, statistics_to_add], ignore_index=True)
+
+            # Merge the processed group_df back into the combined_df
+            combined_df.loc[group] = group_df
+            
+            # Additional debugging: Check if any NaN values exist in the merged DataFrame
+            if combined_df.isnull().values.any():
+                print("Warning: NaN values found in the merged DataFrame.")
+                print(combined_df[combined_df.isnull().any(axis=1)])
+
+        else:
+            # If there is only one station in the group, just use it as is
+            chosen_station = combined_df.loc[group[0]]
+
+            # Keep only the chosen station in the 'Stat' column
+            combined_df.loc[group, 'Stat'] = chosen_station['Stat']
+
+            # Save the number of stations in the group [1] to the statistics_df DataFrame if basename ends with eura
+            if chosen_station['Ref'].endswith('eura'):
+                statistics_to_add = pd.DataFrame({
+                    'Lon': [chosen_station['Lon'].round(5)],
+                    'Lat': [chosen_station['Lat'].round(5)],
+                    'Stat': [chosen_station['Stat']],
+                    'Num': [1]
+                })
+                statistics_df = pd.concat([statistics_df, statistics_to_add], ignore_index=True)
+
+    # Drop duplicates (keeping the first occurrence) from the combined_df based on 'Lon' and 'Lat'
+    combined_df.drop_duplicates(subset=['Lon', 'Lat'], keep='first', inplace=True)
+
+    # Drop the 'Ref' column from the combined dataframe
+    combined_df.drop(columns=['Ref'], inplace=True)
+
+    # Save the combined_df to a CSV file
+    # If basename ends with igb14, set the output filename to combined_vel_igb14.csv, 
+    # otherwise set based on the last 4 characters of the input folder name
+    if basename.endswith('igb14'):
+        output_filename = "combined_vel_igb14.csv"
+    else:
+        output_filename = "combined_vel_" + os.path.basename(input_folder)[-4:] + ".csv"
+    
+    # Save the combined velocity field to a CSV file
+    combined_df.to_csv(os.path.join(combined_folder, output_filename), sep=' ', index=False)
+
+    if chosen_station['Ref'].endswith('eura'):
+        # Save groupped stations to a CSV file for debugging purposes
+        group_df_file_path = os.path.join(statistics_folder, "grouped_stations.csv")
+        aggregated_df.to_csv(group_df_file_path, sep=',', index=False)
+
+        # Save the statistics_df to a CSV file
+        statistics_df_file_path = os.path.join(statistics_folder, "site_statistics.csv")
+        statistics_df.to_csv(statistics_df_file_path, sep=',', index=False)
+
+""" lognorm_filter.py """
+
+def filter_and_plot_data(folder_path, log_output_folder, output_folder, figure_folder):
+    # Find all .vel files in the folder
+    file_names = sorted(glob.glob(os.path.join(folder_path, '*.vel')))
+
+    # Empty list to store data frames
+    dfs = []
+
+    # Load each .vel file as a data frame
+    for file_name in file_names:
+        with open(file_name, 'r') as f:
+            lines = f.readlines()
+
+        data = []
+        for line in lines:
+            line_data = re.split(r'\s+', line.strip())
+            data.append(line_data)
+
+        # Assign column names and remove first row (text) from each data frame
+        df = pd.DataFrame(data)
+        df.columns = df.iloc[0]
+        df = df.iloc[1:]
+
+        # Convert non-numeric values to NaN
+        df['E.sig'] = pd.to_numeric(df['E.sig'], errors='coerce')
+        df['N.sig'] = pd.to_numeric(df['N.sig'], errors='coerce')
+
+        dfs.append(df)
+
+    # Create a directory to store the CSV files listing excluded sites
+    os.makedirs(log_output_folder, exist_ok=True)
+
+    # Create a directory to store the CSV files listing filtered output
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Iterate over each data frame
+    for i, df in enumerate(dfs):
+        # Make sure to take only positive values from E.sig and N.sig columns
+        # So here I'm getting the indices of positive values in E.sig and N.sig columns
+        positive_e_sig = df['E.sig'] > 0
+        positive_n_sig = df['N.sig'] > 0
+
+        # Fit a lognormal distribution to the positive E.sig and N.sig columns
+        e_sig_params = lognorm.fit(df['E.sig'][positive_e_sig].dropna())
+        n_sig_params = lognorm.fit(df['N.sig'][positive_n_sig].dropna())
+
+        # Fit a lognormal distribution to E.sig and N.sig columns
+        #e_sig_params = lognorm.fit(df['E.sig'].dropna())
+        #n_sig_params = lognorm.fit(df['N.sig'].dropna())
+
+        # Calculate the 99th percentile of the fitted lognormal distributions
+        e_sig_99th = lognorm.ppf(0.99, *e_sig_params)
+        n_sig_99th = lognorm.ppf(0.99, *n_sig_params)
+
+        # Identify stations with uncertainties larger than the 99th percentile
+        e_sig_higher_than_99 = df[df['E.sig'] > e_sig_99th]
+        n_sig_higher_than_99 = df[df['N.sig'] > n_sig_99th]
+        combined_stations_higher_than_99 = pd.concat([e_sig_higher_than_99, n_sig_higher_than_99]).drop_duplicates()
+
+        # Filter out data points that exceed the 99th percentile in the fitted lognormal distribution
+        filtered_df = df[(df['E.sig'] < e_sig_99th) & (df['N.sig'] < n_sig_99th)]
+
+        # Print the number of removed stations for the current dataset
+        file_name = os.path.splitext(os.path.basename(file_names[i]))[0]
+        num_removed = len(combined_stations_higher_than_99)
+        num_total = len(df)
+        percentage_removed = (num_removed / num_total) * 100
+        print(f"----------------------------------------------------------------------------------")
+        print(f"Number of stations removed for {file_name}: {num_removed} / {num_total} ({percentage_removed:.2f}%)")
+
+        # Save the stations with uncertainties larger than the 99th percentile to a CSV file
+        log_output_file = os.path.join(log_output_folder, f'{file_name}.csv')
+        combined_stations_higher_than_99.to_csv(log_output_file, sep=' ', index=False)
+        print(f"Sites excluded: {log_output_file}")
+
+        # Save the filtered data to a CSV file
+        output_file = os.path.join(output_folder, f'{file_name}.csv')
+        filtered_df.to_csv(output_file, sep=' ', index=False)
+        print(f"Filtered velocities: {output_file}")
+
+        # Plot individual subfigures for each dataset
+        plot_subfigures(df, file_name, figure_folder, e_sig_99th, n_sig_99th)
+
+def plot_subfigures(df, file_name, figure_folder, e_sig_99th, n_sig_99th):
+    # Remove NaN values
+    e_sig_values = df['E.sig'].dropna()
+    n_sig_values = df['N.sig'].dropna()
+
+    # Calculate lognormal parameters for E.sig and N.sig columns
+    e_sig_params = lognorm.fit(e_sig_values)
+    n_sig_params = lognorm.fit(n_sig_values)
+
+    # Generate data points for best lognormal fit
+    x_e_sig = np.linspace(e_sig_values.min(), e_sig_values.max(), 1000)
+    y_e_sig = lognorm.pdf(x_e_sig, *e_sig_params)
+
+    x_n_sig = np.linspace(n_sig_values.min(), n_sig_values.max(), 1000)
+    y_n_sig = lognorm.pdf(x_n_sig, *n_sig_params)
+
+    # Calculate the median of the E.sig values
+    e_sig_median = np.mean(df['E.sig'].dropna())
+
+    # Calculate the median of the N.sig values
+    n_sig_median = np.mean(df['N.sig'].dropna())
+
+    # Create two subplots in one figure
+    fig, axs = plt.subplots(nrows=1, ncols=2, figsize=(10, 4))
+
+    # Plot histogram and lognormal fit in the first subplot (E.sig)
+    counts_e_sig, bins_e_sig, _ = axs[0].hist(e_sig_values, bins=20, density=False, alpha=0.7)
+    bin_width_e_sig = bins_e_sig[1] - bins_e_sig[0]
+    normalized_y_e_sig = y_e_sig * len(e_sig_values) * bin_width_e_sig
+    axs[0].plot(x_e_sig, normalized_y_e_sig, 'r-', label='Lognormal Fit')
+    axs[0].axvline(e_sig_99th, color='g', linestyle='--', label=f'99%: {e_sig_99th:.2f}')
+    axs[0].axvline(e_sig_median, color='orange', linestyle='--', label=f'Mean: {e_sig_median:.2f}')
+    axs[0].set_title(f'{file_name}: East Velocity Uncertainty')
+    axs[0].set_xlabel('East velocity uncertainty (mm/yr)')
+    axs[0].set_ylabel('Counts')
+    axs[0].legend()
+
+    # set axis limits
+    axs[0].set_xlim([-0.5, 6])
+
+    # Plot histogram and lognormal fit in the second subplot (N.sig)
+    counts_n_sig, bins_n_sig, _ = axs[1].hist(n_sig_values, bins=20, density=False, alpha=0.7)
+    bin_width_n_sig = bins_n_sig[1] - bins_n_sig[0]
+    normalized_y_n_sig = y_n_sig * len(n_sig_values) * bin_width_n_sig
+    axs[1].plot(x_n_sig, normalized_y_n_sig, 'r-', label='Lognormal Fit')
+    axs[1].axvline(n_sig_99th, color='g', linestyle='--', label=f'99%: {n_sig_99th:.2f}')
+    axs[1].axvline(n_sig_median, color='orange', linestyle='--', label=f'Mean: {n_sig_median:.2f}')
+    axs[1].set_title(f'{file_name}: North Velocity Uncertainty')
+    axs[1].set_xlabel('North velocity uncertainty (mm/yr)')
+    axs[1].set_ylabel('Counts')
+    axs[1].legend()
+
+    # set axis limits
+    axs[1].set_xlim([-0.5, 6])
+
+    plt.tight_layout()
+
+    # Create a directory to store the figure files
+    os.makedirs(figure_folder, exist_ok=True)
+
+    print(f"Saving figure for {file_name}...")
+
+    # Save the figure in high definition as PDF, JPG, and PNG files
+    figure_file_pdf = os.path.join(figure_folder, f'{file_name}_lognorm_filter.pdf')
+
+    plt.savefig(figure_file_pdf, dpi=300, format='pdf')
+    plt.close(fig)
+
+""" coherence_filter.py """
+
+def haversine_distance(lon1, lat1, lon2, lat2):
+    # Convert latitude and longitude from degrees to radians
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    # Haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arcsin(np.sqrt(a))
+    radius = 6371  # Earth's radius in kilometers
+    return radius * c
+
+def get_region_stringency(lon, lat, regions):
+    default_sigma = 2  # Default sigma level
+    for region in regions:
+        if (region['min_lon'] <= lon <= region['max_lon'] and
+                region['min_lat'] <= lat <= region['max_lat']):
+            return region['sigma']
+    return default_sigma
+
+def filter_gps_velocities(file_name, radius=20, geo_strict=False, regions=[], special_case_file=None):
+    # Read the CSV file as a data frame, skipping the header row
+    df = pd.read_csv(file_name, sep=' ', skiprows=1, header=None)
+    df.columns = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+    
+    # Empty set to store filtered stations
+    filtered_stations = set()
+
+    # Iterate over each GPS site
+    for i, row in df.iterrows():
+        site_lon, site_lat = row['Lon'], row['Lat']
+        
+        # Apply variable stringency if enabled, otherwise use default sigma level (2)
+        sigma_level = get_region_stringency(site_lon, site_lat, regions) if geo_strict else 2
+
+        # Calculate the Haversine distance between the GPS site and all stations
+        distances = haversine_distance(site_lon, site_lat, df['Lon'].values, df['Lat'].values)
+        # Filter stations that fall within the specified radius (strict adherence)
+        nearby_stations = df[distances <= radius]
+
+        # Proceed if there are more than 5 nearby stations
+        if len(nearby_stations) >= 5:
+            # Calculate mean and standard deviation of nearby stations' E.vel and N.vel
+            e_vel_mean = nearby_stations['E.vel'].mean()
+            e_vel_std = nearby_stations['E.vel'].std()
+            n_vel_mean = nearby_stations['N.vel'].mean()
+            n_vel_std = nearby_stations['N.vel'].std()
+
+            e_vel_threshold = sigma_level * e_vel_std
+            n_vel_threshold = sigma_level * n_vel_std
+            # Filter stations with velocities outside the threshold
+            filtered_stations.update(nearby_stations[
+                (nearby_stations['E.vel'] < e_vel_mean - e_vel_threshold) |
+                (nearby_stations['E.vel'] > e_vel_mean + e_vel_threshold) |
+                (nearby_stations['N.vel'] < n_vel_mean - n_vel_threshold) |
+                (nearby_stations['N.vel'] > n_vel_mean + n_vel_threshold)
+            ].index)
+
+    # Output results
+    output_folder = './results/sites_excluded_coherence'
+    os.makedirs(output_folder, exist_ok=True)
+    output_clean_coherence = './results/output_coherence_analysis'
+    os.makedirs(output_clean_coherence, exist_ok=True)
+
+    if special_case_file in file_name:
+        filtered_stations = set() # Do not remove any stations for special case files where we want to preserve all stations
+
+    # Save excluded stations
+    filtered_df = df.loc[list(filtered_stations)].drop_duplicates()
+    removed_lines_file = os.path.join(output_folder, f'{os.path.splitext(os.path.basename(file_name))[0]}.csv')
+    filtered_df.to_csv(removed_lines_file, sep=' ', index=False)
+
+    # Save included stations
+    included_lines_df = df.drop(list(filtered_stations)).drop_duplicates()
+    included_lines_file = os.path.join(output_clean_coherence, f'{os.path.splitext(os.path.basename(file_name))[0]}.csv')
+    included_lines_df.to_csv(included_lines_file, sep=' ', index=False)
+
+    # Printing results
+    num_removed = len(filtered_df)
+    num_total = len(df)
+    percentage_removed = (num_removed / num_total) * 100
+    text = f"\n----------------------------------------------------------------------------------\nNumber of stations removed for {os.path.basename(file_name)}: {num_removed} / {num_total} ({percentage_removed:.2f}%)\nSites excluded: {removed_lines_file}\nFiltered velocities: {included_lines_file}"
+    print(text)
+
+def parallel_filter_gps_velocities(folder_path, radius=20, geo_strict=False, regions=[], special_case_file=None):
+    # Find all CSV files in the folder
+    file_names = sorted(glob.glob(os.path.join(folder_path, '*.csv')))
+    # Create a ThreadPoolExecutor with the maximum number of worker threads
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        # Submit the filtering tasks for each file to the executor
+        results = [executor.submit(filter_gps_velocities, file_name, radius, geo_strict, regions, special_case_file) for file_name in file_names]
+        concurrent.futures.wait(results)
+        # Errors of the threads are re-raised instead of being ignored
+        for result in results:
+            result.result()
+
+""" uncertainty_scaling_combined.py """
+
+def plot_uncertainty_distributions(original_uncertainties, scaled_uncertainties, component, solution_name):
+    """
+    Plot the original and scaled uncertainty distributions, lognormal fit, 99th percentile, and mean lines.
+    """
+    # Ensure we only fit the lognormal on positive values
+    positive_uncertainties = original_uncertainties[original_uncertainties > 0]
+    positive_uncertainties_scaled = scaled_uncertainties[scaled_uncertainties > 0]
+
+    # Fit a lognormal distribution to the positive uncertainties
+    shape, loc, scale = lognorm.fit(positive_uncertainties, floc=0)
+    shape_scaled, loc_scaled, scale_scaled = lognorm.fit(positive_uncertainties_scaled, floc=0)
+    
+    # Create a range of x values for plotting the lognormal PDF
+    x_vals = np.linspace(min(positive_uncertainties), max(positive_uncertainties), 1000)
+    pdf_vals = lognorm.pdf(x_vals, shape, loc=loc, scale=scale)
+
+    x_vals_scaled = np.linspace(min(positive_uncertainties_scaled), max(positive_uncertainties_scaled), 1000)
+    pdf_vals_scaled = lognorm.pdf(x_vals_scaled, shape_scaled, loc=loc_scaled, scale=scale_scaled)
+    
+    # Compute the 99th percentile for the positive uncertainties
+    p99 = lognorm.ppf(0.99, shape, loc=loc, scale=scale)
+    p99_scaled = lognorm.ppf(0.99, shape_scaled, loc=loc_scaled, scale=scale_scaled)
+
+    # Calculate the means of the raw and scaled uncertainties
+    raw_mean = np.mean(original_uncertainties)
+    scaled_mean = np.mean(scaled_uncertainties)
+
+    # Plot histograms for raw and scaled uncertainties (count)
+    plt.figure(figsize=(10, 6))
+    # Dynamically change the label based on the component
+    if component == 'E.sig':
+        component_string = '(East)'
+        plt.hist(original_uncertainties, bins=30, alpha=0.5, label=f'Original uncertainties {component_string}', density=False)
+        plt.hist(scaled_uncertainties, bins=30, alpha=0.5, label=f'Scaled uncertainties {component_string}', density=False)
+    elif component == 'N.sig':
+        component_string = '(North)'
+        plt.hist(original_uncertainties, bins=30, alpha=0.5, label=f'Original uncertainties {component_string}', density=False)
+        plt.hist(scaled_uncertainties, bins=30, alpha=0.5, label=f'Scaled uncertainties {component_string}', density=False)
+
+    # Plot the fitted lognormal curve (scaled to match the counts)
+    count, bins, _ = plt.hist(positive_uncertainties, bins=30, alpha=0.0)  # Get the bin heights for raw data
+    scale_factor = max(count) / max(pdf_vals)  # Scale factor to align the PDF to the counts
+    plt.plot(x_vals, pdf_vals * scale_factor, label='Lognormal fit (original)', color='red', linewidth=2)
+
+    count_scaled, bins_scaled, _ = plt.hist(positive_uncertainties_scaled, bins=30, alpha=0.0)  # Get the bin heights for raw data
+    scale_factor_scaled = max(count_scaled) / max(pdf_vals_scaled)  # Scale factor to align the PDF to the counts
+    plt.plot(x_vals_scaled, pdf_vals_scaled * scale_factor_scaled, label='Lognormal fit (scaled)', color='green', linewidth=2)
+    
+    # Plot the 99th percentile vertical dashed line for the original uncertainties
+    plt.axvline(p99, color='gray', linestyle='dashed', linewidth=2, label=f'99th percentile (original): {p99:.2f}')
+    plt.axvline(p99_scaled, color='black', linestyle='dashed', linewidth=2, label=f'99th percentile (scaled): {p99_scaled:.2f}')
+    
+    # Plot vertical dashed lines for the mean of the raw and scaled uncertainties
+    plt.axvline(raw_mean, color='blue', linestyle='dashed', linewidth=2, label=f'Mean (original): {raw_mean:.2f}')
+    plt.axvline(scaled_mean, color='orange', linestyle='dashed', linewidth=2, label=f'Mean (scaled): {scaled_mean:.2f}')
+    
+    # Set x-axis limit to a maximum of 5.5 and leave some space for the ligure label on the top left (for the manuscript)
+    plt.xlim(-0.2, 5.5)
+    plt.ylim(0, 4200)
+    
+    # Dynamically change the xlabel based on the component
+    if component == 'E.sig':
+        plt.xlabel('East velocity uncertainty (mm/yr)')
+        filename = "uncertainty_scaling_east_component.pdf"
+    elif component == 'N.sig':
+        plt.xlabel('North velocity uncertainty (mm/yr)')
+        filename = "uncertainty_scaling_north_component.pdf"
+    plt.ylabel('Number of GNSS stations')
+    plt.legend()
+    # Save the figures to the results/figures folder
+    plt.savefig(f'./results/figures/{filename}', format='pdf', dpi=300)
+    plt.close()
+
+def read_velocity_solution(filename):
+    """
+    Reads a velocity solution file and returns a DataFrame.
+    """
+    columns = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+    return pd.read_csv(filename, names=columns, sep=' ', skiprows=1, header=None, on_bad_lines='skip')
+
+def remove_nans_and_fit_lognormal(uncertainties):
+    """
+    Removes NaNs and fits a lognormal distribution to positive values.
+    """
+    # Remove NaN values
+    uncertainties = uncertainties.replace([np.inf, -np.inf], np.nan)
+    uncertainties = uncertainties.dropna()  # Remove NaNs
+    
+    # Fit the lognormal to positive values
+    positive_uncertainties = uncertainties[uncertainties > 0]
+    return positive_uncertainties
+
+def log_normal_params(data):
+    """
+    Calculate the mean and std of log-transformed data for log-normal distribution, using only positive values.
+    """
+    # Remove NaNs and get positive uncertainties
+    positive_uncertainties = remove_nans_and_fit_lognormal(data)
+    
+    log_data = np.log(positive_uncertainties)
+    mean = np.mean(log_data)
+    std = np.std(log_data)
+    return mean, std
+
+def scale_uncertainty(original_uncertainty, original_mean, original_std, reference_mean, reference_std):
+    """
+    Scale an uncertainty from the original distribution to the reference distribution.
+    """
+    original_uncertainty = pd.Series([original_uncertainty])
+    positive_uncertainty = original_uncertainty[original_uncertainty > 0].values[0]  # Ensure positive values
+    
+    log_original_uncertainty = np.log(positive_uncertainty)
+    percentile = stats.norm.cdf((log_original_uncertainty - original_mean) / original_std)
+    scaled_uncertainty = np.exp(reference_mean + reference_std * stats.norm.ppf(percentile))
+    return scaled_uncertainty
+
+def remove_outliers_lognormal(df, component):
+    """
+    Removes velocities outside the 99% of the fitted lognormal distribution for a given component.
+    """
+    # Remove NaNs and get positive uncertainties
+    positive_uncertainties = remove_nans_and_fit_lognormal(df[component])
+
+    # Fit the lognormal distribution and compute the 99th percentile
+    component_params = lognorm.fit(positive_uncertainties)
+    component_99th = lognorm.ppf(0.99, *component_params)
+
+    # Filter out data points that exceed the 99th percentile
+    filtered_df = df[df[component] < component_99th]
+    return filtered_df, component_99th
+
+def harmonise_uncertainties(input_folder, reference_filename, output_folder):
+    # Create the output folder if it doesn't exist
+    os.makedirs(output_folder, exist_ok=True)
+
+    reference_df = read_velocity_solution(reference_filename)
+
+    # Compute reference (target) distribution parameters
+    ref_means, ref_stds = {}, {}
+    for component in ['E.sig', 'N.sig']:
+        ref_means[component], ref_stds[component] = log_normal_params(reference_df[component])
+
+    # Process each solution file in the input folder
+    for solution_file in sorted(os.listdir(input_folder)):
+        if solution_file.endswith('.csv'):
+            solution_df = read_velocity_solution(os.path.join(input_folder, solution_file))
+            solution_name = solution_file.split('.')[0]
+            print(f"Processing {solution_name}")
+
+            for component in ['E.sig', 'N.sig']:
+                # Store the raw input data from the CSV file before any preprocessing
+                raw_uncertainties = solution_df[component].copy()
+
+                # Remove NaNs and fit to positive values
+                processed_uncertainties = remove_nans_and_fit_lognormal(solution_df[component])
+
+                # Calculate the lognormal params from positive values
+                original_mean, original_std = log_normal_params(processed_uncertainties)
+                
+                # Scale uncertainties
+                scaled_uncertainties = processed_uncertainties.apply(
+                    scale_uncertainty,
+                    args=(original_mean, original_std, ref_means[component], ref_stds[component])
+                )
+
+                # Here I'll just plot the uncertainty distributions for the solution in Eurasia-fixed reference frame, for the manuscript's supplementary material
+                if "eura" in solution_name:                       
+                    # Plotting uncertainty distributions (original raw vs scaled) with lognormal fit, mean lines, and 99th percentile
+                    plot_uncertainty_distributions(raw_uncertainties, scaled_uncertainties, component, solution_name)
+                
+                # Store the scaled uncertainties in the solution DataFrame
+                solution_df[f'{component}.scaled'] = scaled_uncertainties.round(2)
+
+                # Remove outliers based on the scaled uncertainties
+                solution_df, _ = remove_outliers_lognormal(solution_df, f'{component}.scaled')
+
+            # Set U.vel and U.adj to 0.00 before saving the scaled CSV file, as combined vertical velocities are computed separately, as explained in the manuscript 
+            solution_df['U.vel'] = 0.00
+            solution_df['U.adj'] = 0.00
+            solution_df['U.sig'] = 0.00
+
+            # Save the scaled solution to the output folder
+            output_file_path = os.path.join(output_folder, f'{solution_name}_scaled.csv')
+            solution_df.to_csv(output_file_path, index=False, sep='\t')
@@ -0,0 +1,200 @@
+""" Deterministic input discovery, atomic writes and run manifests for the pipeline
+stages. The order in which files are listed by os.listdir and glob.glob depends on
+the file system, and in combine_vel.py this order decides which station of a
+group is chosen and which reference frame the output is named after, so inputs
+are always discovered in sorted order. Outputs are first written to a temporary
+file in the destination folder and then renamed to their final path (os.replace
+is atomic), so a crashed or interrupted run never leaves a truncated file behind,
+and parallel workers never expose half-written files to each other.
+
+Each stage records the SHA-256 checksum of its inputs and outputs in a manifest
+(manifest_<stage>.json, in the output folder). Manifests contain no timestamps, so
+two runs on the same inputs produce identical manifests, and a cache can compare
+checksums to decide whether an output is still valid:
+    python run_manifest.py verify ./path2/manifest_combine.json
+    python run_manifest.py checksum ./path2/file_or_folder"""
+
+""" Import necessary modules """
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import tempfile
+import threading
+import contextlib
+try:
+    import fcntl
+except ImportError:  # Windows: manifests are not shared between processes
+    fcntl = None
+
+# The umask can only be read by setting it, so it is read once at import (before
+# any thread is started) and restored immediately
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def discover_inputs(folder_path, extension):
+    """ Files of a folder with the given extension (e.g. '.vel'), sorted by name."""
+    return sorted(glob.glob(os.path.join(folder_path, f'*{extension}')), key=os.path.basename)
+
+def file_checksum(file_path, chunk_size=1 << 20):
+    """ SHA-256 checksum of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@contextlib.contextmanager
+def atomic_open(file_path, mode='w', **kwargs):
+    """ Open a temporary file next to `file_path` for writing, and move it to
+    `file_path` once the block finishes without errors. If the block fails, the
+    temporary file is removed and the previous version of the file (if any) is
+    left untouched. mkstemp creates owner-only files, so the file gets the mode of
+    the file it replaces, or the default mode of new files (0666 minus the umask)."""
+    folder = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(folder, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=folder, prefix=f'.{os.path.basename(file_path)}.', suffix='.tmp')
+    try:
+        try:
+            file_mode = os.stat(file_path).st_mode & 0o7777
+        except FileNotFoundError:
+            file_mode = 0o666 & ~UMASK
+        with os.fdopen(descriptor, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            if hasattr(os, 'fchmod'):
+                os.fchmod(f.fileno(), file_mode)
+            else:  # Windows
+                os.chmod(temporary_path, file_mode)
+            os.fsync(f.fileno())
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temporary_path)
+        raise
+
+def atomic_to_csv(df, file_path, manifest=None, **kwargs):
+    """ Write a DataFrame with DataFrame.to_csv through atomic_open, and record the
+    file in the manifest (if given)."""
+    with atomic_open(file_path, 'w', newline='') as f:
+        df.to_csv(f, **kwargs)
+    if manifest is not None:
+        manifest.record(file_path)
+
+class RunManifest:
+    """ Checksums of the inputs and outputs of a stage. Paths are stored relative to
+    the folder of the manifest, and entries are sorted when saved. Outputs can be
+    recorded from several threads. Entries of a previous manifest of the same
+    stage are kept, so incremental runs only update the files they rewrite."""
+
+    def __init__(self, folder, stage):
+        self.folder = folder
+        self.stage = stage
+        self.file = os.path.join(folder, f'manifest_{stage}.json')
+        # Hidden lock file of save(), so that it is not taken for an output of the stage
+        self.lock_file = os.path.join(folder, f'.manifest_{stage}.lock')
+        self.inputs = {}
+        self.outputs = {}
+        self._forgotten = []
+        self._lock = threading.Lock()
+        if os.path.exists(self.file):
+            with open(self.file, 'r') as f:
+                previous = json.load(f)
+            self.inputs = previous.get('inputs', {})
+            self.outputs = previous.get('outputs', {})
+
+    def _key(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), os.path.abspath(self.folder)).replace(os.sep, '/')
+
+    def _entry(self, file_path):
+        return {'sha256': file_checksum(file_path), 'bytes': os.path.getsize(file_path)}
+
+    def add_inputs(self, file_paths):
+        """ Record the checksums of the input files."""
+        entries = {self._key(file_path): self._entry(file_path) for file_path in file_paths}
+        with self._lock:
+            self.inputs.update(entries)
+
+    def record(self, file_path):
+        """ Record the checksum of an output file (after it has been written)."""
+        entry = self._entry(file_path)
+        with self._lock:
+            self.outputs[self._key(file_path)] = entry
+
+    def forget(self, folder_path):
+        """ Drop the outputs recorded under a folder (e.g. before the folder is
+        rewritten), including those of the manifest file when it is saved."""
+        prefix = self._key(folder_path) + '/'
+        with self._lock:
+            self._forgotten.append(prefix)
+            self.outputs = {key: entry for key, entry in self.outputs.items() if not key.startswith(prefix)}
+
+    def checksum_of(self, file_path):
+        """ Recorded checksum of an output file, or None if it is not in the manifest."""
+        entry = self.outputs.get(self._key(file_path))
+        return entry['sha256'] if entry else None
+
+    def save(self):
+        """ Write the manifest (atomically). Entries written to the manifest file by
+        other processes since it was read (e.g. jobs of job_queue.py writing to the
+        same folder) are merged under a file lock, so no update is lost."""
+        os.makedirs(self.folder or '.', exist_ok=True)
+        with open(self.lock_file, 'a') as lock_file, self._lock:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.exists(self.file):
+                with open(self.file, 'r') as f:
+                    previous = json.load(f)
+                self.inputs = {**previous.get('inputs', {}), **self.inputs}
+                previous_outputs = {key: entry for key, entry in previous.get('outputs', {}).items()
+                                    if not key.startswith(tuple(self._forgotten))}
+                self.outputs = {**previous_outputs, **self.outputs}
+            content = {'stage': self.stage,
+                       'inputs': dict(sorted(self.inputs.items())),
+                       'outputs': dict(sorted(self.outputs.items()))}
+            with atomic_open(self.file, 'w') as f:
+                json.dump(content, f, indent=1)
+                f.write('\n')
+
+    def verify(self):
+        """ Compare the recorded checksums with the files on disk. Returns a list of
+        (path, problem) for missing or modified files."""
+        problems = []
+        for section in ('inputs', 'outputs'):
+            for key, entry in getattr(self, section).items():
+                file_path = os.path.join(self.folder, key)
+                if not os.path.exists(file_path):
+                    problems.append((key, 'missing'))
+                elif file_checksum(file_path) != entry['sha256']:
+                    problems.append((key, 'modified'))
+        return problems
+
+if __name__ == "__main__":
+    # Check if the correct number of command-line arguments is provided
+    if len(sys.argv) != 3 or sys.argv[1] not in ('verify', 'checksum'):
+        print("Usage: python run_manifest.py verify ./path2/manifest_<stage>.json")
+        print("       python run_manifest.py checksum ./path2/file_or_folder")
+        sys.exit(1)
+
+    start_time = time.time()
+    if sys.argv[1] == 'verify':
+        manifest_file = sys.argv[2]
+        stage = os.path.splitext(os.path.basename(manifest_file))[0].replace('manifest_', '', 1)
+        manifest = RunManifest(os.path.dirname(manifest_file), stage)
+        problems = manifest.verify()
+        for key, problem in problems:
+            print(f"{problem}: {key}")
+        print(f"Files checked: {len(manifest.inputs) + len(manifest.outputs)}, problems: {len(problems)}")
+    else:
+        path = sys.argv[2]
+        file_paths = sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True)) if os.path.isdir(path) else [path]
+        for file_path in file_paths:
+            if os.path.isfile(file_path):
+                print(f"{file_checksum(file_path)}  {file_path}")
+        problems = []
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
+    sys.exit(1 if problems else 0)
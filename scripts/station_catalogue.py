@@ -0,0 +1,284 @@
+""" Catalogue of the stations found in the outputs of every run of the pipeline,
+stored in a local SQLite database. The outputs of a run are spread over many
+folders (filtered and excluded sites of every filter, combined fields, manual
+filter, scaled uncertainties), so the catalogue gathers them in a single table
+that can be queried by position, station code, source, stage and run, e.g. to
+find when and why a station was removed.
+
+Ingesting a results folder adds one run to the database (ingesting the same
+run name again replaces it):
+    python station_catalogue.py ingest ./catalogue.db ./results --run 2024-05-baseline
+
+Every row of the known output folders of the results folder (see STAGE_OUTPUTS)
+is stored with the run, stage (lognorm, coherence, combine, manual, scale),
+status (kept, excluded, combined, grouped), source (the input solution or the
+combined file), file, station code, position and velocities (with scaled
+uncertainties, the scaled values are stored as E.sig and N.sig). Longitudes
+are stored in [-180, 180). The same station appears in many files and runs, so
+rows refer to a table of distinct positions indexed by an R*Tree (SQLite rtree
+module, with the exact coordinates as auxiliary columns), and only the new
+positions of a run are added to the tree. The station code, source, position
+and (run, stage, status) columns have B-tree indexes. Rows are inserted in
+bulk, in one transaction per run.
+
+Queries (results printed as tables):
+    python station_catalogue.py station ./catalogue.db ANKR_GPS
+    python station_catalogue.py region ./catalogue.db 26 45 35 43 [--run R] [--stage S] [--status excluded]
+    python station_catalogue.py near ./catalogue.db 32.76 39.89 [--radius 5]
+    python station_catalogue.py runs ./catalogue.db"""
+
+""" Import necessary modules """
+import os
+import time
+import glob
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+from station_index import EARTH_RADIUS_KM, lonlat_to_xyz, chord_to_km
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    results_folder TEXT NOT NULL,
+    ingested TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stations (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    source TEXT NOT NULL,
+    file TEXT NOT NULL,
+    stat TEXT,
+    pos_id INTEGER NOT NULL,
+    e_vel REAL, n_vel REAL, e_sig REAL, n_sig REAL, u_vel REAL, u_sig REAL
+);
+CREATE INDEX IF NOT EXISTS stations_stat ON stations (stat);
+CREATE INDEX IF NOT EXISTS stations_source ON stations (source);
+CREATE INDEX IF NOT EXISTS stations_run ON stations (run_id, stage, status);
+CREATE INDEX IF NOT EXISTS stations_position ON stations (pos_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS positions USING rtree (pos_id, min_lon, max_lon, min_lat, max_lat, +lon, +lat);
+"""
+
+STATION_COLUMNS = ['stage', 'status', 'source', 'file', 'stat', 'pos_id', 'e_vel', 'n_vel', 'e_sig', 'n_sig', 'u_vel', 'u_sig']
+
+# Output files of each stage (glob patterns relative to the results folder), with
+# the stage and status of their rows
+STAGE_OUTPUTS = [
+    ('output_lognorm_99_filtered/*.csv', 'lognorm', 'kept'),
+    ('sites_excluded_lognorm_99/*.csv', 'lognorm', 'excluded'),
+    ('output_coherence_analysis/*.csv', 'coherence', 'kept'),
+    ('sites_excluded_coherence/*.csv', 'coherence', 'excluded'),
+    ('combined_velocities/combined_vel_*.csv', 'combine', 'combined'),
+    ('combined_velocities/statistics/grouped_stations.csv', 'combine', 'grouped'),
+    ('combined_velocities/manual_filter/*_clean.csv', 'manual', 'kept'),
+    ('combined_velocities/manual_filter/*_removed.log', 'manual', 'excluded'),
+    ('combined_velocities_scaled_uncertainties/*_scaled.csv', 'scale', 'kept'),
+]
+
+def connect(db_path):
+    """ Open (and create if needed) the catalogue database."""
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+def read_output_table(file_path):
+    """ Read an output table of the pipeline (comma, tab or space separated, with a
+    header line). Returns None for files without Lon, Lat and Stat columns."""
+    with open(file_path, 'r') as f:
+        header = f.readline()
+    sep = ',' if ',' in header else '\t' if '\t' in header else r'\s+'
+    df = pd.read_csv(file_path, sep=sep, dtype={'Stat': str, 'Ref': str})
+    if not {'Lon', 'Lat', 'Stat'}.issubset(df.columns):
+        return None
+    return df
+
+def catalogue_rows(df, stage, status, source, file_name):
+    """ Rows of an output table in the layout of the stations table."""
+    rows = pd.DataFrame({'stage': stage, 'status': status,
+                         # Tables of grouped stations keep the input solution of every row
+                         'source': df['Ref'] if 'Ref' in df else source, 'file': file_name, 'stat': df['Stat'],
+                         'lon': (df['Lon'].to_numpy(dtype=float) + 180.0) % 360.0 - 180.0,
+                         'lat': df['Lat'].to_numpy(dtype=float)})
+    for column, name in [('E.vel', 'e_vel'), ('N.vel', 'n_vel'), ('E.sig', 'e_sig'), ('N.sig', 'n_sig'),
+                         ('U.vel', 'u_vel'), ('U.sig', 'u_sig')]:
+        rows[name] = df[f'{column}.scaled' if f'{column}.scaled' in df else column] if column in df else np.nan
+    return rows
+
+def run_outputs(results_folder):
+    """ Rows of every known output file of a results folder."""
+    tables = []
+    for pattern, stage, status in STAGE_OUTPUTS:
+        for file_path in sorted(glob.glob(os.path.join(results_folder, pattern))):
+            df = read_output_table(file_path)
+            if df is None or df.empty:
+                continue
+            source = os.path.splitext(os.path.basename(file_path))[0]
+            file_name = os.path.relpath(file_path, results_folder).replace(os.sep, '/')
+            tables.append(catalogue_rows(df, stage, status, source, file_name))
+    if not tables:
+        return pd.DataFrame(columns=['lon', 'lat'] + STATION_COLUMNS).astype({'lon': float, 'lat': float})
+    return pd.concat(tables, ignore_index=True)
+
+def ingest_run(db_path, results_folder, run_name=None):
+    """ Add the outputs of a results folder to the catalogue as a run (replacing a
+    previous run with the same name). Returns the number of rows ingested."""
+    run_name = run_name or f"{os.path.basename(os.path.abspath(results_folder))}-{time.strftime('%Y%m%d-%H%M%S')}"
+    rows = run_outputs(results_folder)
+    connection = connect(db_path)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            previous = connection.execute('SELECT run_id FROM runs WHERE name = ?', (run_name,)).fetchone()
+            if previous is not None:
+                # Positions are kept, as they can be shared with other runs
+                connection.execute('DELETE FROM stations WHERE run_id = ?', previous)
+                connection.execute('DELETE FROM runs WHERE run_id = ?', previous)
+            run_id = connection.execute('INSERT INTO runs (name, results_folder, ingested) VALUES (?, ?, ?)',
+                                        (run_name, os.path.abspath(results_folder), time.strftime('%Y-%m-%d %H:%M:%S'))).lastrowid
+
+            # Distinct positions of the run, matched exactly with the positions already in the tree
+            known = pd.read_sql_query('SELECT pos_id, lon, lat FROM positions', connection)
+            distinct = rows[['lon', 'lat']].drop_duplicates().merge(known, on=['lon', 'lat'], how='left')
+            new = distinct['pos_id'].isna().to_numpy()
+            # New positions are inserted in spatial order, which keeps the tree updates local
+            order = np.lexsort((distinct['lon'].to_numpy()[new], np.floor(distinct['lat'].to_numpy()[new])))
+            first_position = int(known['pos_id'].max()) + 1 if len(known) else 1
+            new_ids = np.empty(new.sum(), dtype=np.int64)
+            new_ids[order] = np.arange(first_position, first_position + new.sum())
+            distinct.loc[new, 'pos_id'] = new_ids
+            lon, lat = distinct['lon'].to_numpy()[new][order].tolist(), distinct['lat'].to_numpy()[new][order].tolist()
+            connection.executemany('INSERT INTO positions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   zip(new_ids[order].tolist(), lon, lon, lat, lat, lon, lat))
+            rows = rows.merge(distinct.astype({'pos_id': np.int64}), on=['lon', 'lat'], how='left')
+
+            first_id = connection.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM stations').fetchone()[0]
+            # Columns are converted to Python objects once (NaN values are stored as NULL)
+            columns = [rows[column].astype(object).where(rows[column].notna(), None).tolist() for column in STATION_COLUMNS]
+            connection.executemany(f"INSERT INTO stations (id, run_id, {', '.join(STATION_COLUMNS)}) "
+                                   f"VALUES (?, ?, {', '.join('?' * len(STATION_COLUMNS))})",
+                                   zip(range(first_id, first_id + len(rows)), [run_id] * len(rows), *columns))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+    finally:
+        connection.close()
+    print(f"Run {run_name}: {len(rows)} rows from {rows['file'].nunique()} files, {new.sum()} new positions")
+    return len(rows)
+
+def select_stations(connection, where, parameters, spatial=False):
+    """ Rows of the stations table (with the run name and position) matching a WHERE
+    clause. With spatial=True, the clause uses the bounds of the R*Tree (alias p),
+    which is then searched first (CROSS JOIN fixes the order of the loops)."""
+    tables = 'positions p CROSS JOIN stations s' if spatial else 'stations s JOIN positions p'
+    query = ("SELECT runs.name AS run, s.stage, s.status, s.source, s.file, s.stat, p.lon, p.lat, s.e_vel, s.n_vel, "
+             f"s.e_sig, s.n_sig, s.u_vel, s.u_sig FROM {tables} ON s.pos_id = p.pos_id "
+             f"JOIN runs ON runs.run_id = s.run_id WHERE {where} ORDER BY s.run_id, s.id")
+    return pd.read_sql_query(query, connection, params=parameters)
+
+def provenance_filters(run=None, stage=None, status=None):
+    """ WHERE conditions and parameters for the optional run, stage and status filters."""
+    conditions, parameters = [], []
+    for condition, value in [('runs.name = ?', run), ('s.stage = ?', stage), ('s.status = ?', status)]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+    return conditions, parameters
+
+def query_region(db_path, west, east, south, north, run=None, stage=None, status=None):
+    """ Rows of the stations inside a longitude/latitude box (longitudes in
+    [-180, 180); west > east for boxes crossing the antimeridian)."""
+    conditions, parameters = provenance_filters(run, stage, status)
+    # The R*Tree stores 32-bit bounds, so the exact positions are also compared
+    where = ' AND '.join(['p.max_lon >= ? AND p.min_lon <= ? AND p.lon BETWEEN ? AND ?',
+                          'p.max_lat >= ? AND p.min_lat <= ? AND p.lat BETWEEN ? AND ?'] + conditions)
+    boxes = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+    connection = connect(db_path)
+    try:
+        return pd.concat([select_stations(connection, where, [box_west, box_east, box_west, box_east,
+                                                              south, north, south, north] + parameters, spatial=True)
+                          for box_west, box_east in boxes], ignore_index=True)
+    finally:
+        connection.close()
+
+def query_near(db_path, lon, lat, radius=5.0, run=None, stage=None, status=None):
+    """ Rows of the stations within `radius` km of a point, with their distance (km)."""
+    lon = (lon + 180.0) % 360.0 - 180.0
+    dlat = np.degrees(radius / EARTH_RADIUS_KM)
+    dlon = dlat / max(np.cos(np.radians(min(abs(lat) + dlat, 90.0))), 1e-6)
+    if dlon >= 180.0:
+        west, east = -180.0, 180.0
+    else:
+        west, east = (lon - dlon + 180.0) % 360.0 - 180.0, (lon + dlon + 180.0) % 360.0 - 180.0
+    rows = query_region(db_path, west, east, max(lat - dlat, -90.0), min(lat + dlat, 90.0), run, stage, status)
+    distance = chord_to_km(np.linalg.norm(lonlat_to_xyz(rows['lon'], rows['lat']) - lonlat_to_xyz([lon], [lat]), axis=1))
+    rows.insert(len(rows.columns), 'distance', np.round(distance, 3))
+    return rows[rows['distance'] <= radius].sort_values('distance', kind='stable').reset_index(drop=True)
+
+def station_history(db_path, stat, run=None, stage=None, status=None):
+    """ Rows of a station code in every run and stage."""
+    conditions, parameters = provenance_filters(run, stage, status)
+    connection = connect(db_path)
+    try:
+        return select_stations(connection, ' AND '.join(['s.stat = ?'] + conditions), [stat] + parameters)
+    finally:
+        connection.close()
+
+def list_runs(db_path):
+    """ Runs of the catalogue with their number of rows."""
+    connection = connect(db_path)
+    try:
+        return pd.read_sql_query("SELECT runs.name AS run, runs.results_folder, runs.ingested, "
+                                 "(SELECT COUNT(*) FROM stations s WHERE s.run_id = runs.run_id) AS rows "
+                                 "FROM runs ORDER BY runs.run_id", connection)
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Catalogue of the stations found in the outputs of every run.')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='Add the outputs of a results folder as a run')
+    ingest_parser.add_argument('db', help='SQLite database of the catalogue')
+    ingest_parser.add_argument('results_folder', help='Results folder of the run (e.g. ./results)')
+    ingest_parser.add_argument('--run', default=None, help='Name of the run (default: folder name and time)')
+    station_parser = subparsers.add_parser('station', help='Rows of a station code in every run')
+    station_parser.add_argument('db')
+    station_parser.add_argument('stat', help='Station code (e.g. ANKR_GPS)')
+    region_parser = subparsers.add_parser('region', help='Rows of the stations inside a box')
+    region_parser.add_argument('db')
+    region_parser.add_argument('bounds', type=float, nargs=4, metavar=('WEST', 'EAST', 'SOUTH', 'NORTH'))
+    near_parser = subparsers.add_parser('near', help='Rows of the stations close to a point')
+    near_parser.add_argument('db')
+    near_parser.add_argument('lon', type=float)
+    near_parser.add_argument('lat', type=float)
+    near_parser.add_argument('--radius', type=float, default=5.0, help='Radius (km)')
+    for query_parser in (station_parser, region_parser, near_parser):
+        query_parser.add_argument('--run', default=None, help='Only rows of this run')
+        query_parser.add_argument('--stage', default=None, help='Only rows of this stage (e.g. coherence)')
+        query_parser.add_argument('--status', default=None, help='Only rows with this status (e.g. excluded)')
+    runs_parser = subparsers.add_parser('runs', help='Runs of the catalogue')
+    runs_parser.add_argument('db')
+    args = parser.parse_args()
+
+    # Time the execution of the action
+    start_time = time.time()
+    if args.action == 'ingest':
+        ingest_run(args.db, args.results_folder, args.run)
+        result = None
+    elif args.action == 'station':
+        result = station_history(args.db, args.stat, args.run, args.stage, args.status)
+    elif args.action == 'region':
+        result = query_region(args.db, *args.bounds, args.run, args.stage, args.status)
+    elif args.action == 'near':
+        result = query_near(args.db, args.lon, args.lat, args.radius, args.run, args.stage, args.status)
+    else:
+        result = list_runs(args.db)
+    end_time = time.time()
+    if result is not None:
+        with pd.option_context('display.width', 200, 'display.max_rows', 200):
+            print(result.to_string(index=False))
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.3f} seconds")
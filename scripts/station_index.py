@@ -0,0 +1,202 @@
+""" Spatial indexing helpers shared by the combination-related scripts. Stations
+are projected onto the unit sphere so that a KD-tree built with scipy can answer
+great-circle radius queries through the equivalent chord length. The module also
+groups collocated stations (same rule as combine_vel.py: distance < 1.11 km,
+merged transitively) and provides a vectorised version of the IQR outlier test
+of the original remove_outliers (reference_stages.py), applied to all groups at once."""
+
+""" Import necessary modules """
+import os
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+EARTH_RADIUS_KM = 6371.0  # Same approximate radius used by the haversine functions
+
+VEL_COLUMNS = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+
+def lonlat_to_xyz(lon, lat):
+    """ Convert longitudes and latitudes (degrees) to Cartesian coordinates on the
+    unit sphere. Returns an array of shape (n, 3)."""
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+def km_to_chord(distance_km):
+    """ Convert a great-circle distance in kilometers to the chord length on the unit sphere."""
+    return 2.0 * np.sin(np.asarray(distance_km, dtype=float) / (2.0 * EARTH_RADIUS_KM))
+
+def chord_to_km(chord):
+    """ Convert a chord length on the unit sphere back to a great-circle distance in kilometers."""
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord, dtype=float) / 2.0, 0.0, 1.0))
+
+def build_station_tree(lon, lat):
+    """ Build a KD-tree over station coordinates. Radius queries against the tree
+    must be expressed as chord lengths (see km_to_chord)."""
+    return cKDTree(lonlat_to_xyz(lon, lat))
+
+def group_close_stations(lon, lat, threshold=1.11):
+    """ Group stations closer than `threshold` km to each other (transitively), as
+    done by create_distance_dict and make_groups (reference_stages.py), but using a
+    KD-tree and connected components instead of an all-pairs loop. Returns an
+    array of group labels, numbered in order of the first row of each group, so
+    that the first row of a group is also the station chosen by combine_vel.py."""
+    n = len(lon)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    tree = build_station_tree(lon, lat)
+    # combine_vel.py uses a strict inequality, so shrink the radius by one ulp
+    radius = np.nextafter(km_to_chord(threshold), 0)
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+
+    # Renumber the groups by the smallest row index they contain
+    first_row = np.full(labels.max() + 1, n, dtype=np.int64)
+    np.minimum.at(first_row, labels, np.arange(n))
+    order = np.argsort(first_row, kind='stable')
+    relabel = np.empty_like(order)
+    relabel[order] = np.arange(len(order))
+    return relabel[labels]
+
+def padded_group_indices(labels, max_cells=2_000_000):
+    """ Arrange the rows of each group in padded index matrices so that group-wise
+    statistics can be computed with NumPy along axis 1. Groups are bucketed by size
+    (powers of two) to keep the padding small, and each bucket is split into chunks
+    of at most `max_cells` matrix cells. Yields (group_ids, index_matrix) tuples
+    where padded cells are set to -1. The output is deterministic for given labels."""
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        return
+    order = np.argsort(labels, kind='stable')
+    sizes = np.bincount(labels)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    buckets = np.ceil(np.log2(np.maximum(sizes, 1))).astype(int)
+
+    for bucket in np.unique(buckets):
+        group_ids = np.flatnonzero(buckets == bucket)
+        width = int(sizes[group_ids].max())
+        chunk = max(1, max_cells // width)
+        for start in range(0, len(group_ids), chunk):
+            ids = group_ids[start:start + chunk]
+            columns = np.arange(width)
+            valid = columns[None, :] < sizes[ids][:, None]
+            positions = np.where(valid, starts[ids][:, None] + columns[None, :], 0)
+            index = np.where(valid, order[positions], -1)
+            yield ids, index
+
+def take_padded(values, index):
+    """ Gather `values` (1-D or 2-D, rows first) into the padded layout given by an
+    index matrix from padded_group_indices. Padded cells are filled with NaN."""
+    values = np.asarray(values, dtype=float)
+    taken = values[np.maximum(index, 0)]
+    mask = index < 0
+    if taken.ndim > mask.ndim:
+        mask = mask[..., None]
+    return np.where(mask, np.nan, taken)
+
+def padded_median(values, axis=1):
+    """ Median along `axis` ignoring NaN cells. Equivalent to np.nanmedian, but
+    based on a single sort (NaN values are sorted last), which is considerably
+    faster for the small padded group matrices used here. Slices without valid
+    values return NaN."""
+    sorted_values = np.sort(values, axis=axis)
+    counts = np.sum(~np.isnan(sorted_values), axis=axis, keepdims=True)
+    lower = np.take_along_axis(sorted_values, np.maximum((counts - 1) // 2, 0), axis=axis)
+    upper = np.take_along_axis(sorted_values, np.maximum(counts // 2, 0), axis=axis)
+    # Adding 0.0 turns -0.0 into 0.0, as np.median does (it averages the middle values from 0.0)
+    median = np.where(counts > 0, (lower + upper) / 2.0 + 0.0, np.nan)
+    return np.squeeze(median, axis=axis)
+
+def padded_percentile(values, q, axis=1):
+    """ Percentile `q` (0-100) along `axis` ignoring NaN cells, with the linear
+    interpolation of np.nanpercentile, but based on a single sort like
+    padded_median (np.nanpercentile handles NaN values one slice at a time).
+    Slices without valid values return NaN."""
+    sorted_values = np.sort(values, axis=axis)
+    counts = np.sum(~np.isnan(sorted_values), axis=axis, keepdims=True)
+    position = (q / 100.0) * np.maximum(counts - 1, 0)
+    lower_index = np.floor(position).astype(np.int64)
+    upper_index = np.minimum(lower_index + 1, np.maximum(counts - 1, 0))
+    lower = np.take_along_axis(sorted_values, lower_index, axis=axis)
+    upper = np.take_along_axis(sorted_values, upper_index, axis=axis)
+    t = position - lower_index
+    # Same interpolation formula as NumPy, which depends on the side of the midpoint
+    percentile = np.where(t >= 0.5, upper - (upper - lower) * (1 - t), lower + (upper - lower) * t)
+    return np.squeeze(np.where(counts > 0, percentile, np.nan), axis=axis)
+
+def grouped_iqr_inliers(e_vel, n_vel):
+    """ Vectorised counterpart of reference_stages.remove_outliers for padded group
+    matrices of shape (groups, width), where padded cells are NaN. Stations whose
+    magnitude or azimuth difference from the group median falls outside
+    [Q1 - 1.5 IQR, Q3 + 1.5 IQR] are flagged as outliers. As in remove_outliers, if
+    every station of a group is an outlier, all of them are kept. Returns a boolean
+    matrix that is True for inliers and False for outliers and padded cells."""
+    valid = ~np.isnan(e_vel)
+    with warnings.catch_warnings():
+        # Fully padded rows trigger 'All-NaN slice' warnings, which are harmless here
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        magnitudes = np.sqrt(e_vel ** 2 + n_vel ** 2)
+        azimuths = np.arctan2(n_vel, e_vel)
+        median_magnitude = padded_median(magnitudes)[:, None]
+        median_azimuth = padded_median(azimuths)[:, None]
+
+        magnitude_diffs = np.abs(magnitudes - median_magnitude)
+        azimuth_diffs = np.abs(np.arctan2(np.sin(azimuths - median_azimuth), np.cos(azimuths - median_azimuth)))
+
+        q1_mag, q3_mag = padded_percentile(magnitude_diffs, 25)[:, None], padded_percentile(magnitude_diffs, 75)[:, None]
+        q1_azi, q3_azi = padded_percentile(azimuth_diffs, 25)[:, None], padded_percentile(azimuth_diffs, 75)[:, None]
+        iqr_mag = q3_mag - q1_mag
+        iqr_azi = q3_azi - q1_azi
+
+        outliers = ((magnitude_diffs < q1_mag - 1.5 * iqr_mag) |
+                    (magnitude_diffs > q3_mag + 1.5 * iqr_mag) |
+                    (azimuth_diffs < q1_azi - 1.5 * iqr_azi) |
+                    (azimuth_diffs > q3_azi + 1.5 * iqr_azi))
+
+    inliers = valid & ~outliers
+    # Keep every station of a group if all of them were flagged as outliers
+    all_outliers = ~inliers.any(axis=1, keepdims=True)
+    return np.where(all_outliers, valid, inliers)
+
+def read_combination_inputs(input_folder):
+    """ Read all .vel files of a rotated/aligned input folder into one DataFrame, as
+    combine_vel.combine_velocities does (files ending in igb14 have no header, the
+    others have the 4-line CVFRAME header). Files are read in sorted order and a
+    'Ref' column records the source file of each row."""
+    file_names = sorted(f for f in os.listdir(input_folder) if f.endswith('.vel'))
+    dfs = []
+    for file_name in file_names:
+        basename = os.path.splitext(file_name)[0]
+        skiprows = 0 if basename.endswith('igb14') else 4
+        df = pd.read_csv(os.path.join(input_folder, file_name), sep=r'\s+', header=None, skiprows=skiprows)
+        df = df.iloc[:, :len(VEL_COLUMNS)]
+        df.columns = VEL_COLUMNS
+        df['Ref'] = basename
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame(columns=VEL_COLUMNS + ['Ref'])
+    return pd.concat(dfs, ignore_index=True)
+
+def read_combination_table(input_folder):
+    """ Same as read_combination_inputs, but returns a compact StationTable (see
+    station_table.py) instead of a DataFrame, with the file name as the source."""
+    from station_table import StationTable, read_vel_table
+    file_names = sorted(f for f in os.listdir(input_folder) if f.endswith('.vel'))
+    tables = []
+    for file_name in file_names:
+        basename = os.path.splitext(file_name)[0]
+        skiprows = 0 if basename.endswith('igb14') else 4
+        tables.append(read_vel_table(os.path.join(input_folder, file_name), skiprows=skiprows, header=False, ref=basename))
+    return StationTable.concat(tables)
+
+def frame_name(input_folder, file_names):
+    """ Return the reference frame label used in the combined output file names
+    (igb14, or the last 4 characters of the input folder name)."""
+    if any(os.path.splitext(f)[0].endswith('igb14') for f in file_names):
+        return 'igb14'
+    return os.path.basename(os.path.normpath(input_folder))[-4:]
@@ -0,0 +1,223 @@
+""" Cross-solution registry of GNSS sites. Every row of the input velocity fields
+is assigned to a site: rows closer than 1.11 km to each other (transitively) are
+the same site, as in combine_vel.py, and optionally rows sharing a station code
+within a larger distance are joined too (useful for solutions that publish
+rounded coordinates). Station codes are normalised (upper case, without the
+_GPS/_GNSS suffix) and each site gets a canonical code: its most frequent
+normalised code, or the code of its first row if several are equally frequent.
+When different sites end up with the same canonical code, the site with the
+most solutions keeps it and the others get a _2, _3, ... suffix, so codes are
+unique and independent of the order in which sites are visited.
+
+The registry keeps a hash index (normalised code -> sites) and a KD-tree over
+the site positions, so that all the solutions of a site can be looked up by
+code or by position, and stations of another velocity field can be matched to
+the registered sites without recomputing distances between all pairs."""
+
+""" Import necessary modules """
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from station_index import build_station_tree, lonlat_to_xyz, km_to_chord, group_close_stations, read_combination_inputs
+
+SUFFIX_PATTERN = r'_+(GPS|GNSS)$'
+
+def normalise_codes(codes):
+    """ Normalise station codes: strip spaces, convert to upper case and remove the
+    _GPS/_GNSS suffix (e.g. 'aber_GPS' and 'ABER__GPS' both become 'ABER')."""
+    codes = pd.Series(np.asarray(codes, dtype=object)).astype(str).str.strip().str.upper()
+    return codes.str.replace(SUFFIX_PATTERN, '', regex=True).to_numpy(dtype=object)
+
+def renumber_by_first_row(labels):
+    """ Renumber group labels in order of the first row of each group."""
+    n = len(labels)
+    first_row = np.full(labels.max() + 1, n, dtype=np.int64)
+    np.minimum.at(first_row, labels, np.arange(n))
+    order = np.argsort(first_row, kind='stable')
+    relabel = np.empty_like(order)
+    relabel[order] = np.arange(len(order))
+    return relabel[labels]
+
+class StationRegistry:
+    """ Registry of the sites of a set of velocity fields. `site_labels` holds the
+    site of every input row, numbered by first row (the station chosen by
+    combine_vel.py), and `site_codes` the canonical code of every site."""
+
+    def __init__(self, lon, lat, stat, ref=None, threshold=1.11, code_distance=None):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        self.stat = np.asarray(stat, dtype=object)
+        self.ref = np.asarray(ref if ref is not None else [''] * len(self.lon), dtype=object)
+        self.codes = normalise_codes(self.stat)
+        self.threshold = threshold
+        self.site_labels = self.make_sites(threshold, code_distance)
+        self.n_sites = int(self.site_labels.max()) + 1 if len(self.site_labels) else 0
+
+        # Rows of each site, stored contiguously
+        self._order = np.argsort(self.site_labels, kind='stable')
+        self._starts = np.concatenate(([0], np.cumsum(np.bincount(self.site_labels, minlength=self.n_sites))))
+        self.first_rows = self._order[self._starts[:-1]]
+
+        self.site_codes = self.resolve_site_codes()
+        self._code_index = self.build_code_index()
+        self._tree = build_station_tree(self.lon[self.first_rows], self.lat[self.first_rows]) if self.n_sites else None
+
+    @classmethod
+    def from_dataframe(cls, df, threshold=1.11, code_distance=None):
+        """ Build a registry from a DataFrame (or StationTable) with Lon, Lat, Stat
+        and, optionally, Ref columns."""
+        try:
+            ref = np.asarray(df['Ref'])
+        except KeyError:
+            ref = None
+        return cls(np.asarray(df['Lon']), np.asarray(df['Lat']), np.asarray(df['Stat']), ref, threshold, code_distance)
+
+    def make_sites(self, threshold, code_distance):
+        """ Group the rows into sites: proximity groups (< threshold km), joined with
+        rows of the same normalised code closer than code_distance km."""
+        if len(self.lon) == 0:
+            return np.zeros(0, dtype=np.int64)
+        labels = group_close_stations(self.lon, self.lat, threshold)
+        if not code_distance or code_distance <= threshold:
+            return labels
+        tree = build_station_tree(self.lon, self.lat)
+        pairs = tree.query_pairs(km_to_chord(code_distance), output_type='ndarray')
+        pairs = pairs[self.codes[pairs[:, 0]] == self.codes[pairs[:, 1]]]
+        n_groups = labels.max() + 1
+        graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (labels[pairs[:, 0]], labels[pairs[:, 1]])), shape=(n_groups, n_groups))
+        _, merged = connected_components(graph, directed=False)
+        return renumber_by_first_row(merged[labels])
+
+    def resolve_site_codes(self):
+        """ Canonical code of each site (see module docstring)."""
+        if self.n_sites == 0:
+            return np.zeros(0, dtype=object)
+        counts = pd.DataFrame({'site': self.site_labels, 'code': self.codes, 'row': np.arange(len(self.codes))})
+        counts = counts.groupby(['site', 'code'], sort=False).agg(count=('row', 'size'), first=('row', 'min')).reset_index()
+        counts = counts.sort_values(['site', 'count', 'first'], ascending=[True, False, True], kind='stable')
+        best = counts.drop_duplicates('site').set_index('site')['code']
+        site_codes = best.reindex(np.arange(self.n_sites)).to_numpy(dtype=object)
+
+        # Resolve conflicts: the site with most solutions keeps the code
+        sites = pd.DataFrame({'code': site_codes, 'num': self.num_solutions(), 'site': np.arange(self.n_sites)})
+        sites = sites.sort_values(['code', 'num', 'site'], ascending=[True, False, True], kind='stable')
+        rank = sites.groupby('code', sort=False).cumcount().to_numpy()
+        suffixes = np.array(['' if k == 0 else f'_{k + 1}' for k in rank], dtype=object)
+        site_codes[sites['site'].to_numpy()] = sites['code'].to_numpy(dtype=object) + suffixes
+        return site_codes
+
+    def build_code_index(self):
+        """ Dictionary {normalised or canonical code: array of site ids}."""
+        pairs = pd.DataFrame({'code': np.concatenate((self.codes, self.site_codes)),
+                              'site': np.concatenate((self.site_labels, np.arange(self.n_sites)))}).drop_duplicates()
+        return {code: np.sort(group['site'].to_numpy()) for code, group in pairs.groupby('code', sort=False)}
+
+    def num_solutions(self):
+        """ Number of input rows (solutions) of each site."""
+        return np.diff(self._starts)
+
+    def rows_of(self, site):
+        """ Input rows of a site, in input order."""
+        return self._order[self._starts[site]:self._starts[site + 1]]
+
+    def groups(self):
+        """ Input rows of every site as a list of lists, in site order. These are the
+        groups of reference_stages.make_groups, in the same order, but the rows of
+        each group are in input order, whereas make_groups lists them in the order
+        in which its union-find first met them."""
+        return [rows.tolist() for rows in np.split(self._order, self._starts[1:-1])]
+
+    def sites_for_code(self, code):
+        """ Sites registered under a station code (normalised before the lookup)."""
+        return self._code_index.get(normalise_codes([code])[0], np.zeros(0, dtype=np.int64))
+
+    def sites_near(self, lon, lat, radius=None):
+        """ Sites within `radius` km (default: the grouping threshold) of a point."""
+        radius = self.threshold if radius is None else radius
+        if self._tree is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.asarray(self._tree.query_ball_point(lonlat_to_xyz([lon], [lat])[0], km_to_chord(radius)), dtype=np.int64))
+
+    def solutions_for(self, code=None, lon=None, lat=None, radius=None):
+        """ All the solutions of the sites matching a station code and/or lying within
+        `radius` km of a position, as a DataFrame (one row per input row)."""
+        sites = None
+        if code is not None:
+            sites = self.sites_for_code(code)
+        if lon is not None and lat is not None:
+            near = self.sites_near(lon, lat, radius)
+            sites = near if sites is None else np.intersect1d(sites, near)
+        if sites is None:
+            raise ValueError("solutions_for needs a station code or a position")
+        rows = np.concatenate([self.rows_of(site) for site in sites]) if len(sites) else np.zeros(0, dtype=np.int64)
+        return pd.DataFrame({'Site': self.site_codes[self.site_labels[rows]], 'Lon': self.lon[rows], 'Lat': self.lat[rows],
+                             'Stat': self.stat[rows], 'Ref': self.ref[rows], 'Row': rows})
+
+    def match(self, lon, lat, stat=None, eq_dist=1.0):
+        """ Match stations of another velocity field to the registered sites. Among
+        the sites closer than `eq_dist` km, a site with the same normalised code is
+        preferred, otherwise the nearest one is taken. Returns the site of every
+        station (-1 if none is close enough)."""
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        sites = np.full(len(lon), -1, dtype=np.int64)
+        if self._tree is None or len(lon) == 0:
+            return sites
+        xyz = lonlat_to_xyz(lon, lat)
+        distance, nearest = self._tree.query(xyz, k=1, distance_upper_bound=km_to_chord(eq_dist))
+        matched = np.isfinite(distance)
+        sites[matched] = nearest[matched]
+        if stat is None:
+            return sites
+
+        # Prefer a site with the same code when several sites are close enough
+        codes = normalise_codes(stat)
+        for i in np.flatnonzero(matched):
+            candidates = self._code_index.get(codes[i])
+            if candidates is None or sites[i] in candidates:
+                continue
+            close = self._tree.query_ball_point(xyz[i], km_to_chord(eq_dist))
+            same_code = np.intersect1d(close, candidates)
+            if len(same_code):
+                gaps = np.linalg.norm(self._tree.data[same_code] - xyz[i], axis=1)
+                sites[i] = same_code[np.argmin(gaps)]
+        return sites
+
+    def site_table(self):
+        """ One row per site: position of the first row, canonical code, number of
+        solutions and the distinct station codes and solutions joined."""
+        rows = pd.DataFrame({'site': self.site_labels, 'Stat': self.stat, 'Ref': self.ref})
+        joined = rows.groupby('site', sort=True).agg(Codes=('Stat', lambda s: ';'.join(pd.unique(s))),
+                                                     Refs=('Ref', lambda s: ';'.join(pd.unique(s))))
+        return pd.DataFrame({
+            'Lon': np.round(self.lon[self.first_rows], 5),
+            'Lat': np.round(self.lat[self.first_rows], 5),
+            'Site': self.site_codes,
+            'Num': self.num_solutions(),
+            'Codes': joined['Codes'].to_numpy(),
+            'Refs': joined['Refs'].to_numpy(),
+        })
+
+if __name__ == "__main__":
+    # Check if the correct number of command-line arguments is provided
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python station_registry.py ./path2/input_folder ./path2/output_file.csv [code_distance_km]")
+        sys.exit(1)
+
+    input_folder = sys.argv[1]
+    output_file = sys.argv[2]
+    code_distance = float(sys.argv[3]) if len(sys.argv) == 4 else None
+
+    # Time the construction of the registry
+    start_time = time.time()
+    registry = StationRegistry.from_dataframe(read_combination_inputs(input_folder), code_distance=code_distance)
+    registry.site_table().to_csv(output_file, sep=',', index=False)
+    end_time = time.time()
+    print(f"Number of rows: {len(registry.site_labels)}")
+    print(f"Number of sites: {registry.n_sites}")
+    print(f"Site registry: {output_file}")
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
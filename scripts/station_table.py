@@ -0,0 +1,192 @@
+""" Compact in-memory representation of station velocity tables. A StationTable
+stores every column as a separate NumPy array (struct of arrays): coordinates
+as float64, velocities, adjustments, uncertainties and correlations as float32,
+and station names ('Stat') and source solutions ('Ref') as small integer codes
+into shared lists of unique strings. Rows of the same source are stored
+contiguously, so per-source subsets and row ranges are returned as views of the
+parent arrays instead of copies. Compared with pandas DataFrames holding object
+columns, this cuts the memory of a large compilation several-fold, and the
+tables convert back to DataFrames (with the usual column names) for writing."""
+
+""" Import necessary modules """
+import os
+import sys
+import glob
+import time
+import numpy as np
+import pandas as pd
+
+COORD_COLUMNS = ['Lon', 'Lat']
+VALUE_COLUMNS = ['E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig']
+VEL_COLUMNS = COORD_COLUMNS + VALUE_COLUMNS + ['Stat']
+COLUMN_DTYPES = {**{c: np.float64 for c in COORD_COLUMNS}, **{c: np.float32 for c in VALUE_COLUMNS}}
+
+def smallest_code_dtype(n):
+    """ Smallest signed integer type able to index `n` unique strings."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if n < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+# Decimal digits kept exactly by float32 (FLT_DIG)
+FLOAT32_DIGITS = 6
+
+def as_float64(values):
+    """ Convert float32 values to the float64 numbers they were parsed from. A plain
+    cast keeps the float32 rounding error (0.449 becomes 0.4490000009536743), which
+    changes the results of later rounding, so the cast is rounded back to the
+    FLOAT32_DIGITS significant digits of the parsed decimals (every decimal with at
+    most 6 significant digits, as in the velocity files, is recovered exactly)."""
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        return values.astype(np.float64)
+    result = values.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(result)))
+    digits = FLOAT32_DIGITS - 1 - np.where(np.isfinite(magnitude), magnitude, 0)
+    # Powers of ten are exact for 0 <= digits <= 22, so the division gives the nearest float64 to the decimal
+    exact = (digits >= 0) & (digits <= 22)
+    scale = 10.0 ** np.where(exact, digits, 0)
+    return np.where(exact, np.rint(result * scale) / scale, result)
+
+class StationTable:
+    """ Struct-of-arrays station table. `columns` maps the numeric column names to
+    arrays, `stat_codes`/`ref_codes` index into `stat_names`/`ref_names`.
+    Tables are treated as read-only: subsets share memory with their parent."""
+
+    def __init__(self, columns, stat_codes, stat_names, ref_codes, ref_names):
+        self.columns = columns
+        self.stat_codes = stat_codes
+        self.stat_names = stat_names
+        self.ref_codes = ref_codes
+        self.ref_names = ref_names
+
+    def __len__(self):
+        return len(self.stat_codes)
+
+    def __getitem__(self, name):
+        """ Return a numeric column, or the decoded 'Stat'/'Ref' strings."""
+        if name == 'Stat':
+            return self.stat_names[self.stat_codes]
+        if name == 'Ref':
+            return self.ref_names[self.ref_codes]
+        return self.columns[name]
+
+    def column64(self, name):
+        """ Numeric column as float64 (see as_float64)."""
+        return as_float64(self.columns[name])
+
+    @classmethod
+    def from_dataframe(cls, df, ref=None):
+        """ Build a table from a DataFrame with the usual velocity columns. The
+        source is taken from the 'Ref' column, or from `ref` for the whole table."""
+        columns = {name: np.ascontiguousarray(df[name].to_numpy(dtype=dtype)) for name, dtype in COLUMN_DTYPES.items() if name in df}
+        stat_codes, stat_names = pd.factorize(df['Stat'].astype(str), sort=False)
+        if 'Ref' in df:
+            ref_codes, ref_names = pd.factorize(df['Ref'].astype(str), sort=False)
+        else:
+            ref_codes, ref_names = np.zeros(len(df), dtype=np.int64), pd.Index([ref if ref is not None else ''])
+        return cls(columns,
+                   stat_codes.astype(smallest_code_dtype(len(stat_names))), np.asarray(stat_names, dtype=object),
+                   ref_codes.astype(smallest_code_dtype(len(ref_names))), np.asarray(ref_names, dtype=object))
+
+    @classmethod
+    def concat(cls, tables):
+        """ Concatenate tables, re-interning the station and source names."""
+        tables = [t for t in tables if len(t)]
+        if not tables:
+            return cls.empty()
+        columns = {name: np.concatenate([t.columns[name] for t in tables]) for name in tables[0].columns}
+        stat_names, stat_codes = np.unique(np.concatenate([t.stat_names for t in tables]).astype(str), return_inverse=True)
+        ref_names, ref_codes = np.unique(np.concatenate([t.ref_names for t in tables]).astype(str), return_inverse=True)
+        stat_offsets = np.cumsum([0] + [len(t.stat_names) for t in tables[:-1]])
+        ref_offsets = np.cumsum([0] + [len(t.ref_names) for t in tables[:-1]])
+        all_stat_codes = np.concatenate([stat_codes[t.stat_codes.astype(np.int64) + o] for t, o in zip(tables, stat_offsets)])
+        all_ref_codes = np.concatenate([ref_codes[t.ref_codes.astype(np.int64) + o] for t, o in zip(tables, ref_offsets)])
+        return cls(columns,
+                   all_stat_codes.astype(smallest_code_dtype(len(stat_names))), stat_names.astype(object),
+                   all_ref_codes.astype(smallest_code_dtype(len(ref_names))), ref_names.astype(object))
+
+    @classmethod
+    def empty(cls):
+        """ Table without rows."""
+        columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMN_DTYPES.items()}
+        return cls(columns, np.zeros(0, dtype=np.int8), np.zeros(0, dtype=object), np.zeros(0, dtype=np.int8), np.zeros(0, dtype=object))
+
+    def slice(self, start, stop):
+        """ Rows start:stop as a view sharing memory with this table."""
+        columns = {name: values[start:stop] for name, values in self.columns.items()}
+        return StationTable(columns, self.stat_codes[start:stop], self.stat_names, self.ref_codes[start:stop], self.ref_names)
+
+    def take(self, rows):
+        """ Rows selected by an index array or boolean mask (a copy, as in NumPy)."""
+        columns = {name: values[rows] for name, values in self.columns.items()}
+        return StationTable(columns, self.stat_codes[rows], self.stat_names, self.ref_codes[rows], self.ref_names)
+
+    def source_ranges(self):
+        """ Dictionary {source name: (start, stop)} for sources stored contiguously."""
+        codes = self.ref_codes
+        if len(codes) == 0:
+            return {}
+        boundaries = np.flatnonzero(np.diff(codes)) + 1
+        starts = np.concatenate(([0], boundaries))
+        stops = np.concatenate((boundaries, [len(codes)]))
+        return {self.ref_names[codes[start]]: (int(start), int(stop)) for start, stop in zip(starts, stops)}
+
+    def source(self, ref):
+        """ Rows of one source solution, as a view when the source is contiguous."""
+        matches = np.flatnonzero(self.ref_names == ref)
+        rows = np.flatnonzero(self.ref_codes == matches[0]) if len(matches) else np.zeros(0, dtype=np.int64)
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            return self.slice(rows[0], rows[-1] + 1)
+        return self.take(rows)
+
+    def to_dataframe(self, include_ref=False, float64=False):
+        """ Convert back to a DataFrame with the velocity file column order. With
+        float64=True the numeric columns are converted with as_float64 (the values
+        parsed from the files, for computations)."""
+        convert = as_float64 if float64 else (lambda values: values)
+        df = pd.DataFrame({name: convert(self.columns[name]) for name in VEL_COLUMNS[:-1] if name in self.columns})
+        df['Stat'] = self['Stat']
+        if include_ref:
+            df['Ref'] = self['Ref']
+        return df
+
+    def memory_usage(self):
+        """ Number of bytes held by the table arrays (string pools included)."""
+        total = sum(values.nbytes for values in self.columns.values())
+        total += self.stat_codes.nbytes + self.ref_codes.nbytes
+        total += sum(sys.getsizeof(name) for name in self.stat_names) + sum(sys.getsizeof(name) for name in self.ref_names)
+        return total
+
+def read_vel_table(file_name, skiprows=0, header=True, ref=None):
+    """ Read a velocity file straight into a StationTable with typed columns.
+    `header` tells whether the first non-skipped line holds the column names."""
+    df = pd.read_csv(file_name, sep=r'\s+', skiprows=skiprows + (1 if header else 0), header=None,
+                     usecols=range(len(VEL_COLUMNS)), names=VEL_COLUMNS, dtype=COLUMN_DTYPES)
+    if ref is None:
+        ref = os.path.splitext(os.path.basename(file_name))[0]
+    return StationTable.from_dataframe(df, ref=ref)
+
+def read_vel_folder(folder_path, pattern='*.vel', skiprows=0, header=True):
+    """ Read every file of a folder matching `pattern` (in sorted order) into one
+    StationTable, with the file name (without extension) as the source."""
+    file_names = sorted(glob.glob(os.path.join(folder_path, pattern)))
+    return StationTable.concat([read_vel_table(f, skiprows=skiprows, header=header) for f in file_names])
+
+if __name__ == "__main__":
+    # Check if the correct number of command-line arguments is provided
+    if len(sys.argv) != 2:
+        print("Usage: python station_table.py ./path2/input_folder")
+        sys.exit(1)
+
+    # Compare the memory held by a DataFrame and a StationTable for the same folder
+    folder_path = sys.argv[1]
+    start_time = time.time()
+    table = read_vel_folder(folder_path)
+    end_time = time.time()
+    df = table.to_dataframe(include_ref=True)
+    print(f"Number of stations: {len(table)} from {len(table.ref_names)} files")
+    print(f"DataFrame memory: {df.memory_usage(deep=True).sum() / 1e6:.2f} MB")
+    print(f"StationTable memory: {table.memory_usage() / 1e6:.2f} MB")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
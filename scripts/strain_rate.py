@@ -0,0 +1,242 @@
+""" This code computes strain rates from a combined velocity field
+(combined_vel_<frame>.csv) with two methods:
+- Delaunay triangulation: the velocity gradient of every triangle is the exact
+  linear fit to the velocities of its three stations. Triangles with edges
+  longer than a maximum length or with very small angles are discarded.
+- Regular grid: the velocity gradient at every node is estimated by the local
+  weighted least squares fit of velocity_interpolation.py (k nearest stations,
+  Gaussian distance weights divided by the station variances). Nodes with fewer
+  than three stations within the maximum distance are left empty.
+From the gradients, the horizontal strain rate tensor (exx, eyy, exy), the
+rotation rate, the dilatation rate, the maximum shear strain rate and the
+second invariant are computed, together with their uncertainties (propagated
+linearly from the station uncertainties). All values are in nanostrain/yr
+(rotation in nanoradians/yr). Triangles and grid nodes are processed in
+vectorised batches, and the batches (tiles) are distributed across processes."""
+
+""" Import necessary modules """
+import os
+import time
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from station_index import EARTH_RADIUS_KM
+from velocity_interpolation import VelocityInterpolator, write_grid
+
+NANOSTRAIN = 1e3  # 1 mm/yr/km = 1e-6 /yr = 1000 nanostrain/yr
+STRAIN_FIELDS = ['exx', 'eyy', 'exy', 'rot', 'dilatation', 'max_shear', 'second_invariant']
+
+def strain_from_gradients(gradients, covariance):
+    """ Strain rate quantities and their uncertainties from velocity gradients
+    g = (dVe/dx, dVe/dy, dVn/dx, dVn/dy) in mm/yr/km, with shape (m, 4), and their
+    covariance matrices (m, 4, 4). Returns a dictionary of arrays in nanostrain/yr,
+    with the uncertainties under '<name>.sig'."""
+    g = gradients * NANOSTRAIN
+    cov = covariance * NANOSTRAIN ** 2
+    exx, eyy = g[:, 0], g[:, 3]
+    exy = 0.5 * (g[:, 1] + g[:, 2])
+    half_diff = 0.5 * (exx - eyy)
+    max_shear = np.sqrt(half_diff ** 2 + exy ** 2)
+    second_invariant = np.sqrt(exx ** 2 + eyy ** 2 + 2 * exy ** 2)
+
+    # Jacobians of each quantity with respect to the gradients, shape (m, 4)
+    zeros, ones = np.zeros_like(exx), np.ones_like(exx)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        safe_shear = np.where(max_shear > 0, max_shear, np.inf)
+        safe_invariant = np.where(second_invariant > 0, second_invariant, np.inf)
+        jacobians = {
+            'exx': np.stack((ones, zeros, zeros, zeros), axis=1),
+            'eyy': np.stack((zeros, zeros, zeros, ones), axis=1),
+            'exy': np.stack((zeros, 0.5 * ones, 0.5 * ones, zeros), axis=1),
+            'rot': np.stack((zeros, -0.5 * ones, 0.5 * ones, zeros), axis=1),
+            'dilatation': np.stack((ones, zeros, zeros, ones), axis=1),
+            'max_shear': np.stack((0.5 * half_diff, 0.5 * exy, 0.5 * exy, -0.5 * half_diff), axis=1) / safe_shear[:, None],
+            'second_invariant': np.stack((exx, exy, exy, eyy), axis=1) / safe_invariant[:, None],
+        }
+    values = {'exx': exx, 'eyy': eyy, 'exy': exy, 'rot': 0.5 * (g[:, 2] - g[:, 1]), 'dilatation': exx + eyy,
+              'max_shear': max_shear, 'second_invariant': second_invariant}
+    results = {}
+    for name in STRAIN_FIELDS:
+        results[name] = values[name]
+        variance = np.einsum('mi,mij,mj->m', jacobians[name], cov, jacobians[name])
+        results[f'{name}.sig'] = np.sqrt(np.maximum(variance, 0))
+    return results
+
+def tangent_offsets(lon, lat, lon0, lat0):
+    """ East and north offsets (km) of points from reference points, on the plane
+    tangent to the reference points."""
+    dlon = (lon - lon0 + 180) % 360 - 180
+    x = np.radians(dlon) * EARTH_RADIUS_KM * np.cos(np.radians(lat0))
+    y = np.radians(lat - lat0) * EARTH_RADIUS_KM
+    return x, y
+
+def triangle_gradients(lon, lat, velocities, sigmas):
+    """ Velocity gradients of triangles given the coordinates, velocities (E, N) and
+    uncertainties of their vertices, all with shape (m, 3[, 2]). Returns the
+    gradients (m, 4), their covariances (m, 4, 4) and the triangle centroids."""
+    lon0 = lon[:, 0][:, None] + ((lon - lon[:, 0][:, None] + 180) % 360 - 180).mean(axis=1, keepdims=True)
+    lat0 = lat.mean(axis=1, keepdims=True)
+    x, y = tangent_offsets(lon, lat, lon0, lat0)
+    design = np.stack((np.ones_like(x), x, y), axis=2)
+    inverse = np.linalg.inv(design)  # (m, 3 coefficients, 3 vertices)
+
+    gradients = np.zeros((len(lon), 4))
+    covariance = np.zeros((len(lon), 4, 4))
+    for c in range(2):
+        rows = inverse[:, 1:, :]  # d/dx and d/dy rows
+        gradients[:, 2 * c:2 * c + 2] = np.einsum('mik,mk->mi', rows, velocities[..., c])
+        scaled = rows * sigmas[..., c][:, None, :]
+        covariance[:, 2 * c:2 * c + 2, 2 * c:2 * c + 2] = np.einsum('mik,mjk->mij', scaled, scaled)
+    return gradients, covariance, lon0[:, 0], lat0[:, 0]
+
+def select_triangles(lon, lat, simplices, max_edge=150.0, min_angle=10.0):
+    """ Keep triangles whose edges are shorter than `max_edge` km and whose angles
+    are all larger than `min_angle` degrees."""
+    vertex_lon, vertex_lat = lon[simplices], lat[simplices]
+    x, y = tangent_offsets(vertex_lon, vertex_lat, vertex_lon.mean(axis=1, keepdims=True), vertex_lat.mean(axis=1, keepdims=True))
+    points = np.stack((x, y), axis=2)
+    edges = np.roll(points, -1, axis=1) - points
+    lengths = np.linalg.norm(edges, axis=2)
+    # Angle at each vertex, between the two edges leaving it
+    previous = -np.roll(edges, 1, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosines = np.sum(edges * previous, axis=2) / (lengths * np.roll(lengths, 1, axis=1))
+    angles = np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+    return (lengths.max(axis=1) <= max_edge) & (np.nan_to_num(angles, nan=0).min(axis=1) >= min_angle)
+
+_interpolator = None
+
+def init_worker(interpolator):
+    """ Keep the interpolator in a global of each worker process."""
+    global _interpolator
+    _interpolator = interpolator
+
+def grid_tile(points):
+    """ Strain rates at a tile of grid nodes (run in a worker process)."""
+    lon, lat = points
+    coefficients, covariance, num, _ = _interpolator.local_fit(lon, lat)
+    # Gradients ordered as (dVe/dx, dVe/dy, dVn/dx, dVn/dy); E and N are fitted independently
+    gradients = coefficients[:, :, 1:].reshape(len(lon), 4)
+    full_covariance = np.zeros((len(lon), 4, 4))
+    full_covariance[:, :2, :2] = covariance[:, 0, 1:, 1:]
+    full_covariance[:, 2:, 2:] = covariance[:, 1, 1:, 1:]
+    results = strain_from_gradients(gradients, full_covariance)
+    # Gradients are not resolved with fewer than three stations
+    for name in results:
+        results[name][num < 3] = np.nan
+    results['Num'] = num.astype(float)
+    return results
+
+def triangle_tile(task):
+    """ Strain rates of a tile of triangles (run in a worker process)."""
+    lon, lat, velocities, sigmas = task
+    gradients, covariance, centroid_lon, centroid_lat = triangle_gradients(lon, lat, velocities, sigmas)
+    results = strain_from_gradients(gradients, covariance)
+    results['Lon'] = centroid_lon
+    results['Lat'] = centroid_lat
+    return results
+
+def map_tiles(function, tasks, workers=None, initializer=None, initargs=()):
+    """ Apply a function to tiles in a process pool and concatenate the dictionaries
+    of arrays it returns (in task order)."""
+    if workers == 1 or len(tasks) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        outputs = [function(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            outputs = list(executor.map(function, tasks))
+    if not outputs:
+        return {}
+    return {name: np.concatenate([output[name] for output in outputs]) for name in outputs[0]}
+
+def read_combined_velocities(combined_file):
+    """ Read a combined velocity field, replacing zero uncertainties by the median."""
+    df = pd.read_csv(combined_file, sep=r'\s+')
+    for column in ('E.sig', 'N.sig'):
+        positive = df[column] > 0
+        df.loc[~positive, column] = df.loc[positive, column].median()
+    return df
+
+def grid_strain_rates(combined_file, region, spacing, k=12, scale=50.0, max_distance=150.0, tile_size=20000, workers=None):
+    """ Strain rates on a regular grid. Returns the grid axes and a dictionary of
+    arrays of shape (n_lat, n_lon)."""
+    df = read_combined_velocities(combined_file)
+    interpolator = VelocityInterpolator(df['Lon'], df['Lat'], df['E.vel'], df['N.vel'], df['E.sig'], df['N.sig'],
+                                        k=k, scale=scale, max_distance=max_distance)
+    west, east, south, north = region
+    lons = np.arange(west, east + spacing / 2, spacing)
+    lats = np.arange(south, north + spacing / 2, spacing)
+    grid_lon, grid_lat = (a.ravel() for a in np.meshgrid(lons, lats))
+    tasks = [(grid_lon[i:i + tile_size], grid_lat[i:i + tile_size]) for i in range(0, len(grid_lon), tile_size)]
+    results = map_tiles(grid_tile, tasks, workers, init_worker, (interpolator,))
+    return lons, lats, {name: values.reshape(len(lats), len(lons)) for name, values in results.items()}
+
+def triangle_strain_rates(combined_file, max_edge=150.0, min_angle=10.0, tile_size=50000, workers=None):
+    """ Strain rates on the Delaunay triangulation of the stations. Returns a
+    DataFrame with the centroid and the vertex names of every triangle kept."""
+    from scipy.spatial import Delaunay
+    df = read_combined_velocities(combined_file)
+    # Collocated stations would give degenerate triangles
+    df = df.drop_duplicates(subset=['Lon', 'Lat']).reset_index(drop=True)
+    lon, lat = df['Lon'].to_numpy(dtype=float), df['Lat'].to_numpy(dtype=float)
+    # Triangulate in a continuous longitude range around the median longitude
+    centre = np.median(lon)
+    unwrapped = centre + (lon - centre + 180) % 360 - 180
+    simplices = Delaunay(np.column_stack((unwrapped * np.cos(np.radians(lat)), lat))).simplices
+    simplices = simplices[select_triangles(lon, lat, simplices, max_edge, min_angle)]
+
+    velocities = df[['E.vel', 'N.vel']].to_numpy(dtype=float)
+    sigmas = df[['E.sig', 'N.sig']].to_numpy(dtype=float)
+    tasks = [(lon[s], lat[s], velocities[s], sigmas[s])
+             for s in (simplices[i:i + tile_size] for i in range(0, len(simplices), tile_size))]
+    results = map_tiles(triangle_tile, tasks, workers)
+    if not results:
+        return pd.DataFrame(columns=['Lon', 'Lat'] + [f'{n}{s}' for n in STRAIN_FIELDS for s in ('', '.sig')] + ['Stations'])
+    table = pd.DataFrame({'Lon': np.round(results['Lon'], 5), 'Lat': np.round(results['Lat'], 5)})
+    for name in STRAIN_FIELDS:
+        table[name] = np.round(results[name], 2)
+        table[f'{name}.sig'] = np.round(results[f'{name}.sig'], 2)
+    stations = df['Stat'].to_numpy(dtype=str)[simplices]
+    table['Stations'] = [';'.join(names) for names in stations]
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute strain rates from a combined velocity field.')
+    parser.add_argument('combined_file', help='Combined velocity field (combined_vel_<frame>.csv)')
+    parser.add_argument('output_folder', help='Folder for the strain rate files')
+    parser.add_argument('--method', choices=['triangles', 'grid', 'both'], default='both')
+    parser.add_argument('--region', type=float, nargs=4, metavar=('WEST', 'EAST', 'SOUTH', 'NORTH'), help='Grid region')
+    parser.add_argument('--spacing', type=float, default=0.25, help='Grid spacing (degrees)')
+    parser.add_argument('--k', type=int, default=12, help='Number of neighbouring stations of each grid node')
+    parser.add_argument('--scale', type=float, default=50.0, help='Standard deviation (km) of the Gaussian weights')
+    parser.add_argument('--max_distance', type=float, default=150.0, help='Maximum distance (km) of the stations used')
+    parser.add_argument('--max_edge', type=float, default=150.0, help='Maximum triangle edge length (km)')
+    parser.add_argument('--min_angle', type=float, default=10.0, help='Minimum triangle angle (degrees)')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(args.combined_file))[0].replace('combined_vel_', 'strain_rates_')
+    start_time = time.time()
+    if args.method in ('triangles', 'both'):
+        triangles = triangle_strain_rates(args.combined_file, args.max_edge, args.min_angle, workers=args.workers)
+        triangle_file = os.path.join(args.output_folder, f'{base_name}_triangles.csv')
+        triangles.to_csv(triangle_file, sep=' ', index=False)
+        print(f"Number of triangles: {len(triangles)}")
+        print(f"Strain rates on triangles: {triangle_file}")
+    if args.method in ('grid', 'both'):
+        if args.region is None:
+            df = pd.read_csv(args.combined_file, sep=r'\s+')
+            args.region = [np.floor(df['Lon'].min()), np.ceil(df['Lon'].max()), np.floor(df['Lat'].min()), np.ceil(df['Lat'].max())]
+        lons, lats, fields = grid_strain_rates(args.combined_file, args.region, args.spacing, args.k, args.scale,
+                                               args.max_distance, workers=args.workers)
+        grid_file = os.path.join(args.output_folder, f'{base_name}_grid.npz')
+        write_grid(grid_file, lons, lats, fields, {'source': os.path.basename(args.combined_file), 'units': 'nanostrain/yr',
+                                                   'k': args.k, 'scale_km': args.scale, 'max_distance_km': args.max_distance})
+        print(f"Grid of {len(lats)} x {len(lons)} nodes")
+        print(f"Strain rates on the grid: {grid_file}")
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -0,0 +1,320 @@
+""" This code exports the combined velocity fields (combined_vel_<frame>.csv) and,
+optionally, the filtered velocity fields of each input file (output of
+coherence_filter.py) as a pyramid of GeoJSON tiles for interactive viewing in a
+web browser. Tiles follow the usual z/x/y Web Mercator scheme (256 px tiles):
+    <output_folder>/tiles/<layer>/<z>/<x>/<y>.json
+Drawing tens of thousands of arrows at small scales is slow and unreadable, so
+each zoom level is decimated: every tile is divided into cells of `cell_size`
+pixels and only one station per cell is kept (the station with the smallest
+uncertainty, ties broken by station order). The feature of the kept station
+counts the stations it represents ('n'). At the largest zoom level (max_zoom)
+all the stations are kept. The number of features of a tile is therefore
+bounded by (256 / cell_size)^2 for any size of the field.
+
+Tiles are written in parallel by a pool of processes (tiles are split in chunks
+of similar size). The tiles of a layer are removed before it is exported again
+and every tile is written atomically (see run_manifest.atomic_open). The output folder also contains metadata.json (layers, zoom
+levels and bounds) and index.html, a small viewer drawing the arrows on a canvas
+with zoom and pan. Browsers do not load local files from a page, so serve the
+folder with a local web server:
+    python tile_export.py ./results/combined_velocities ./results/tiles --filtered_folder ./results/output_coherence_analysis
+    python -m http.server --directory ./results/tiles 8000   (then open http://localhost:8000)"""
+
+""" Import necessary modules """
+import os
+import json
+import time
+import shutil
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from run_manifest import discover_inputs, atomic_open, RunManifest
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.0511287798  # Limit of the Web Mercator projection
+VEL_COLUMNS = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+
+def layer_sources(combined_folder, filtered_folder=None):
+    """ Files to export, as (layer name, file) tuples: combined_<frame> for every
+    combined velocity field, and the name of every file of the filtered folder."""
+    file_paths = [file_path for file_path in discover_inputs(combined_folder, '.csv')
+                  if os.path.basename(file_path).startswith('combined_vel_')]
+    if filtered_folder:
+        file_paths += discover_inputs(filtered_folder, '.csv')
+    return [(os.path.splitext(os.path.basename(file_path))[0].replace('combined_vel_', 'combined_'), file_path)
+            for file_path in file_paths]
+
+def read_layer(file_path):
+    """ Read a velocity field (space-separated, with a header line)."""
+    df = pd.read_csv(file_path, sep=' ', skiprows=1, header=None)
+    df = df.iloc[:, :len(VEL_COLUMNS)]
+    df.columns = VEL_COLUMNS
+    return df
+
+def read_layers(combined_folder, filtered_folder=None):
+    """ Velocity fields to export, as a dictionary of layer name to DataFrame."""
+    return {layer: read_layer(file_path) for layer, file_path in layer_sources(combined_folder, filtered_folder)}
+
+def mercator_pixels(lon, lat, zoom):
+    """ Global Web Mercator pixel coordinates of longitudes and latitudes at a zoom level."""
+    scale = TILE_SIZE * 2 ** zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon, dtype=float) + 180.0) % 360.0 / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * scale
+    return np.minimum(x, scale - 1e-6), np.clip(y, 0, scale - 1e-6)
+
+def decimate(lon, lat, priority, zoom, cell_size=None):
+    """ Keep one station per cell of cell_size pixels at a zoom level (every station
+    if cell_size is None). Returns the tile (x, y) of the kept stations, their rows
+    and the number of stations of their cells."""
+    x, y = mercator_pixels(lon, lat, zoom)
+    if cell_size is None:
+        rows, counts = np.arange(len(lon)), np.ones(len(lon), dtype=np.int64)
+    else:
+        cells_per_row = TILE_SIZE * 2 ** zoom // cell_size
+        cell = (y // cell_size).astype(np.int64) * cells_per_row + (x // cell_size).astype(np.int64)
+        order = np.lexsort((np.arange(len(cell)), priority, cell))
+        sorted_cells = cell[order]
+        first = np.concatenate(([True], sorted_cells[1:] != sorted_cells[:-1])) if len(cell) else np.zeros(0, dtype=bool)
+        counts = np.diff(np.append(np.flatnonzero(first), len(cell)))
+        rows = order[first]
+    return (x[rows] // TILE_SIZE).astype(np.int64), (y[rows] // TILE_SIZE).astype(np.int64), rows, counts
+
+def write_tiles(task):
+    """ Worker entry point: write the tiles of a chunk. `columns` holds the stations
+    of the chunk, ordered by tile, and `tiles` the (x, y, start, end) of every tile
+    in them. Returns the number of tiles written."""
+    tiles_folder, layer, zoom, columns, tiles = task
+    # Features are drawn with longitudes in [-180, 180), as the tiles are computed
+    lon = np.round((columns['Lon'].astype(float) + 180.0) % 360.0 - 180.0, 5).tolist()
+    lat = np.round(columns['Lat'], 5).tolist()
+    properties = list(zip(columns['Stat'].tolist(), columns['E.vel'].tolist(), columns['N.vel'].tolist(),
+                          columns['E.sig'].tolist(), columns['N.sig'].tolist(), columns['n'].tolist()))
+    for tile_x, tile_y, start, end in tiles:
+        features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon[i], lat[i]]},
+                     'properties': dict(zip(('stat', 've', 'vn', 'se', 'sn', 'n'), properties[i]))}
+                    for i in range(start, end)]
+        tile_folder = os.path.join(tiles_folder, layer, str(zoom), str(tile_x))
+        # json.dumps uses the C encoder, json.dump does not
+        with atomic_open(os.path.join(tile_folder, f'{tile_y}.json'), 'w') as f:
+            f.write(json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':')))
+    return len(tiles)
+
+def layer_tasks(tiles_folder, layer, df, min_zoom, max_zoom, cell_size, chunk_features=20000):
+    """ Decimate a layer at every zoom level and split its tiles into chunks of
+    about chunk_features features (one task per chunk, holding only the stations
+    of its tiles)."""
+    lon, lat = df['Lon'].to_numpy(dtype=float), df['Lat'].to_numpy(dtype=float)
+    # Stations with the smallest horizontal uncertainty are kept first
+    priority = np.hypot(df['E.sig'].to_numpy(dtype=float), df['N.sig'].to_numpy(dtype=float))
+    priority = np.nan_to_num(priority, nan=np.inf)
+    columns = {name: df[name].to_numpy() for name in ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.sig', 'N.sig', 'Stat']}
+    tasks = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        # Every station is kept at the largest zoom level
+        tile_x, tile_y, rows, counts = decimate(lon, lat, priority, zoom, cell_size if zoom < max_zoom else None)
+        order = np.lexsort((rows, tile_y, tile_x))
+        tile_x, tile_y, rows, counts = tile_x[order], tile_y[order], rows[order], counts[order]
+        starts = np.flatnonzero(np.concatenate(([True], (tile_x[1:] != tile_x[:-1]) | (tile_y[1:] != tile_y[:-1]))))
+        ends = np.append(starts[1:], len(rows))
+        # Consecutive tiles are grouped until a chunk holds chunk_features stations
+        chunk_ids = np.searchsorted(np.arange(chunk_features, len(rows) + chunk_features, chunk_features), ends, side='left')
+        for chunk_id in np.unique(chunk_ids):
+            chunk_starts, chunk_ends = starts[chunk_ids == chunk_id], ends[chunk_ids == chunk_id]
+            first, last = chunk_starts[0], chunk_ends[-1]
+            chunk_columns = {name: values[rows[first:last]] for name, values in columns.items()}
+            chunk_columns['n'] = counts[first:last]
+            tiles = [(int(tile_x[start]), int(tile_y[start]), int(start - first), int(end - first))
+                     for start, end in zip(chunk_starts, chunk_ends)]
+            tasks.append((tiles_folder, layer, zoom, chunk_columns, tiles))
+    return tasks
+
+def layer_bounds(df):
+    """ [west, south, east, north] of a layer, with longitudes in [-180, 180) (some
+    inputs use longitudes in [0, 360))."""
+    lon = (df['Lon'].to_numpy(dtype=float) + 180.0) % 360.0 - 180.0
+    lat = df['Lat'].to_numpy(dtype=float)
+    return [round(float(lon.min()), 5), round(float(lat.min()), 5), round(float(lon.max()), 5), round(float(lat.max()), 5)]
+
+def layer_metadata(layer, df):
+    """ Name, number of stations and bounds of a layer, as listed in metadata.json."""
+    return {'name': layer, 'stations': len(df), 'bounds': layer_bounds(df)}
+
+def clear_layer(tiles_folder, layer):
+    """ Remove the tiles of a previous export of a layer, so that tiles without
+    stations in the new export are not served with their old content."""
+    shutil.rmtree(os.path.join(tiles_folder, layer), ignore_errors=True)
+
+def export_layer(layer, file_path, output_folder, min_zoom=2, max_zoom=8, cell_size=16):
+    """ Write the tiles of a single layer in this process (used by the jobs of
+    job_queue.py). Returns the metadata of the layer and the number of tiles."""
+    df = read_layer(file_path)
+    clear_layer(os.path.join(output_folder, 'tiles'), layer)
+    tasks = layer_tasks(os.path.join(output_folder, 'tiles'), layer, df, min_zoom, max_zoom, cell_size)
+    n_tiles = sum(write_tiles(task) for task in tasks)
+    return layer_metadata(layer, df), n_tiles
+
+def write_viewer(output_folder, layers, min_zoom, max_zoom, cell_size, manifest=None):
+    """ Write metadata.json (from the metadata of the layers, in the given order)
+    and the viewer."""
+    metadata = {'min_zoom': min_zoom, 'max_zoom': max_zoom, 'tile_size': TILE_SIZE, 'cell_size': cell_size,
+                'layers': [layer for layer in layers if layer['stations']]}
+    for file_name, content in [('metadata.json', json.dumps(metadata, indent=1)), ('index.html', VIEWER_HTML)]:
+        with atomic_open(os.path.join(output_folder, file_name), 'w') as f:
+            f.write(content)
+        if manifest is not None:
+            manifest.record(os.path.join(output_folder, file_name))
+    return metadata
+
+def export_tiles(combined_folder, output_folder, filtered_folder=None, min_zoom=2, max_zoom=8, cell_size=16, workers=None):
+    """ Export the velocity fields as a tile pyramid with a local viewer. Returns the
+    metadata of the export."""
+    tiles_folder = os.path.join(output_folder, 'tiles')
+    os.makedirs(tiles_folder, exist_ok=True)
+    sources = layer_sources(combined_folder, filtered_folder)
+    manifest = RunManifest(output_folder, 'tiles')
+    manifest.add_inputs([file_path for _, file_path in sources])
+
+    layers = {layer: read_layer(file_path) for layer, file_path in sources}
+    tasks = []
+    for layer, df in layers.items():
+        clear_layer(tiles_folder, layer)
+        tasks += layer_tasks(tiles_folder, layer, df, min_zoom, max_zoom, cell_size)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        n_tiles = sum(executor.map(write_tiles, tasks))
+
+    metadata = write_viewer(output_folder, [layer_metadata(layer, df) for layer, df in layers.items()],
+                            min_zoom, max_zoom, cell_size, manifest)
+    manifest.save()
+    print(f"Layers: {len(layers)}, tiles: {n_tiles}, zoom levels: {min_zoom}-{max_zoom}")
+    return metadata
+
+VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>FICORO GNSS velocities</title>
+<style>
+  body { margin: 0; font: 13px sans-serif; overflow: hidden; }
+  #map { display: block; width: 100vw; height: 100vh; cursor: grab; background: #f4f4f4; }
+  #panel { position: absolute; top: 8px; left: 8px; background: rgba(255,255,255,0.9); padding: 6px 8px; border: 1px solid #bbb; }
+</style>
+</head>
+<body>
+<canvas id="map"></canvas>
+<div id="panel">
+  <select id="layer"></select>
+  Arrow scale <input id="scale" type="range" min="0.5" max="10" step="0.5" value="2">
+  <span id="info"></span>
+</div>
+<script>
+// Web Mercator tiles of TILE px, loaded from tiles/<layer>/<z>/<x>/<y>.json
+const canvas = document.getElementById('map'), ctx = canvas.getContext('2d');
+const cache = new Map();
+let meta, layer, zoom, centerX, centerY, tileZoom;
+
+function project(lon, lat, z) {
+  const s = meta.tile_size * Math.pow(2, z), r = Math.PI / 180;
+  lat = Math.max(Math.min(lat, 85.0511), -85.0511);
+  return [(lon + 180) / 360 * s, (1 - Math.log(Math.tan(lat * r) + 1 / Math.cos(lat * r)) / Math.PI) / 2 * s];
+}
+
+function getTile(z, x, y) {
+  const key = `${layer}/${z}/${x}/${y}`;
+  if (!cache.has(key)) {
+    cache.set(key, null);
+    fetch(`tiles/${key}.json`).then(r => r.ok ? r.json() : {features: []})
+      .then(tile => { cache.set(key, tile.features); draw(); })
+      .catch(() => cache.set(key, []));
+  }
+  return cache.get(key);
+}
+
+function draw() {
+  canvas.width = window.innerWidth; canvas.height = window.innerHeight;
+  tileZoom = Math.max(meta.min_zoom, Math.min(meta.max_zoom, Math.round(zoom)));
+  const factor = Math.pow(2, zoom - tileZoom), T = meta.tile_size;
+  const left = centerX * Math.pow(2, tileZoom) - canvas.width / 2 / factor;
+  const top = centerY * Math.pow(2, tileZoom) - canvas.height / 2 / factor;
+  const scale = parseFloat(document.getElementById('scale').value);
+  ctx.strokeStyle = '#1f4e9c'; ctx.lineWidth = 1;
+  let features = 0;
+  const n = Math.pow(2, tileZoom);
+  for (let x = Math.floor(left / T); x <= Math.floor((left + canvas.width / factor) / T); x++) {
+    for (let y = Math.max(0, Math.floor(top / T)); y <= Math.min(n - 1, Math.floor((top + canvas.height / factor) / T)); y++) {
+      const tile = getTile(tileZoom, ((x % n) + n) % n, y);
+      if (!tile) continue;
+      for (const f of tile) {
+        const [px, py] = project(f.geometry.coordinates[0], f.geometry.coordinates[1], tileZoom);
+        const sx = (px + (x - (((x % n) + n) % n)) * T - left) * factor, sy = (py - top) * factor;
+        const ex = sx + f.properties.ve * scale, ey = sy - f.properties.vn * scale;
+        const a = Math.atan2(ey - sy, ex - sx);
+        ctx.beginPath(); ctx.moveTo(sx, sy); ctx.lineTo(ex, ey);
+        ctx.lineTo(ex - 4 * Math.cos(a - 0.4), ey - 4 * Math.sin(a - 0.4));
+        ctx.moveTo(ex, ey); ctx.lineTo(ex - 4 * Math.cos(a + 0.4), ey - 4 * Math.sin(a + 0.4));
+        ctx.stroke();
+        features++;
+      }
+    }
+  }
+  document.getElementById('info').textContent = `zoom ${zoom.toFixed(1)}, ${features} stations drawn`;
+}
+
+function fit() {
+  const b = meta.layers.find(l => l.name === layer).bounds;
+  const [x0, y0] = project(b[0], b[3], 0), [x1, y1] = project(b[2], b[1], 0);
+  centerX = (x0 + x1) / 2; centerY = (y0 + y1) / 2;
+  zoom = Math.max(meta.min_zoom, Math.log2(Math.min(window.innerWidth / (x1 - x0 + 1e-9), window.innerHeight / (y1 - y0 + 1e-9))));
+}
+
+let drag = null;
+canvas.onmousedown = e => { drag = [e.clientX, e.clientY]; };
+window.onmouseup = () => { drag = null; };
+window.onmousemove = e => {
+  if (!drag) return;
+  const f = Math.pow(2, zoom);
+  centerX -= (e.clientX - drag[0]) / f; centerY -= (e.clientY - drag[1]) / f;
+  drag = [e.clientX, e.clientY]; draw();
+};
+canvas.onwheel = e => {
+  e.preventDefault();
+  const f = Math.pow(2, zoom), mx = centerX + (e.clientX - canvas.width / 2) / f, my = centerY + (e.clientY - canvas.height / 2) / f;
+  zoom = Math.max(meta.min_zoom - 1, Math.min(meta.max_zoom + 3, zoom - Math.sign(e.deltaY) * 0.25));
+  const g = Math.pow(2, zoom);
+  centerX = mx - (e.clientX - canvas.width / 2) / g; centerY = my - (e.clientY - canvas.height / 2) / g;
+  draw();
+};
+window.onresize = draw;
+document.getElementById('scale').oninput = draw;
+document.getElementById('layer').onchange = e => { layer = e.target.value; fit(); draw(); };
+
+fetch('metadata.json').then(r => r.json()).then(m => {
+  meta = m;
+  const select = document.getElementById('layer');
+  for (const l of meta.layers) select.add(new Option(`${l.name} (${l.stations})`, l.name));
+  layer = meta.layers[0].name; fit(); draw();
+});
+</script>
+</body>
+</html>
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the combined velocity fields as a GeoJSON tile pyramid with a local viewer.')
+    parser.add_argument('combined_folder', help='Folder with the combined_vel_<frame>.csv files')
+    parser.add_argument('output_folder', help='Folder where the tiles, metadata.json and index.html are written')
+    parser.add_argument('--filtered_folder', default=None, help='Also export the filtered velocity fields of this folder (e.g. output_coherence_analysis)')
+    parser.add_argument('--min_zoom', type=int, default=2, help='Smallest zoom level')
+    parser.add_argument('--max_zoom', type=int, default=8, help='Largest zoom level (all stations are kept)')
+    parser.add_argument('--cell_size', type=int, default=16, help='Size (pixels) of the decimation cells')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args()
+
+    # Time the export of the tiles
+    start_time = time.time()
+    export_tiles(args.combined_folder, args.output_folder, args.filtered_folder, args.min_zoom, args.max_zoom,
+                 args.cell_size, args.workers)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -6,6 +6,7 @@ from scipy.stats import lognorm
 import os
 import pandas as pd
 import matplotlib.pyplot as plt
+from run_manifest import discover_inputs, atomic_to_csv, RunManifest
 
 def plot_uncertainty_distributions(original_uncertainties, scaled_uncertainties, component, solution_name):
     """
@@ -149,10 +150,16 @@ def harmonise_uncertainties(input_folder, reference_filename, output_folder):
     for component in ['E.sig', 'N.sig']:
         ref_means[component], ref_stds[component] = log_normal_params(reference_df[component])
 
-    # Process each solution file in the input folder
-    for solution_file in os.listdir(input_folder):
+    # Record the checksums of the inputs and outputs in the output folder
+    solution_files = discover_inputs(input_folder, '.csv')
+    manifest = RunManifest(output_folder, 'scale')
+    manifest.add_inputs([reference_filename] + solution_files)
+
+    # Process each solution file in the input folder (sorted, so that runs are reproducible)
+    for solution_path in solution_files:
+        solution_file = os.path.basename(solution_path)
         if solution_file.endswith('.csv'):
-            solution_df = read_velocity_solution(os.path.join(input_folder, solution_file))
+            solution_df = read_velocity_solution(solution_path)
             solution_name = solution_file.split('.')[0]
             print(f"Processing {solution_name}")
 
@@ -190,4 +197,7 @@ def harmonise_uncertainties(input_folder, reference_filename, output_folder):
 
             # Save the scaled solution to the output folder
             output_file_path = os.path.join(output_folder, f'{solution_name}_scaled.csv')
-            solution_df.to_csv(output_file_path, index=False, sep='\t')
+            atomic_to_csv(solution_df, output_file_path, manifest, index=False, sep='\t')
+
+    manifest.save()
+
@@ -0,0 +1,266 @@
+""" This code interpolates a combined velocity field (combined_vel_<frame>.csv) at
+arbitrary points. For every query point, the k nearest stations are found with
+a KD-tree and a local linear model (velocity plus east and north gradients) is
+fitted by weighted least squares, with Gaussian distance weights divided by the
+station variances. Stations farther than a maximum distance are ignored, and
+points without neighbours get NaN. The uncertainties of the interpolated
+velocities are propagated from the station uncertainties. Queries are answered
+in vectorised batches, so a whole grid is interpolated at once.
+
+The interpolator can write a regular grid (.npz, and NetCDF when xarray is
+installed), answer queries read from the standard input ("lon lat" per line),
+or serve queries over HTTP, loading the field and the KD-tree only once:
+
+    GET  /query?lon=10.5,11&lat=45,45.5
+    POST /query   {"lon": [10.5, 11], "lat": [45, 45.5]}"""
+
+""" Import necessary modules """
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from station_index import EARTH_RADIUS_KM, build_station_tree, lonlat_to_xyz, chord_to_km, km_to_chord
+
+OUTPUT_FIELDS = ['E.vel', 'N.vel', 'E.sig', 'N.sig', 'Num', 'Dist']
+
+class VelocityInterpolator:
+    """ Local weighted least squares interpolator of the horizontal velocities.
+    `k` is the number of neighbours, `scale` the standard deviation (km) of the
+    Gaussian distance weights and `max_distance` (km) the largest distance at
+    which a station is used."""
+
+    def __init__(self, lon, lat, e_vel, n_vel, e_sig, n_sig, k=12, scale=50.0, max_distance=150.0):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        self.velocities = np.column_stack((e_vel, n_vel)).astype(float)
+        # Zero uncertainties would give infinite weights
+        sigmas = np.column_stack((e_sig, n_sig)).astype(float)
+        floor = np.nanmedian(sigmas[sigmas > 0]) if np.any(sigmas > 0) else 1.0
+        self.sigmas = np.where(sigmas > 0, sigmas, floor)
+        self.k = min(k, len(self.lon))
+        self.scale = scale
+        self.max_distance = max_distance
+        self.tree = build_station_tree(self.lon, self.lat)
+
+    @classmethod
+    def from_file(cls, combined_file, **kwargs):
+        """ Build the interpolator from a combined velocity field file."""
+        df = pd.read_csv(combined_file, sep=r'\s+')
+        return cls(df['Lon'], df['Lat'], df['E.vel'], df['N.vel'], df['E.sig'], df['N.sig'], **kwargs)
+
+    def query(self, lon, lat, batch_size=20000):
+        """ Interpolate the velocities at the query points. Returns a dictionary of
+        arrays: E.vel, N.vel, E.sig, N.sig, the number of stations used (Num) and
+        the distance to the nearest station in km (Dist)."""
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        results = {name: np.full(len(lon), np.nan) for name in OUTPUT_FIELDS}
+        for start in range(0, len(lon), batch_size):
+            stop = min(start + batch_size, len(lon))
+            batch = self.query_batch(lon[start:stop], lat[start:stop])
+            for name in OUTPUT_FIELDS:
+                results[name][start:stop] = batch[name]
+        return results
+
+    def query_batch(self, lon, lat):
+        """ Interpolate one batch of query points (see query)."""
+        coefficients, covariance, num, nearest = self.local_fit(lon, lat)
+        results = {'Num': num.astype(float), 'Dist': nearest}
+        for c, component in enumerate(('E', 'N')):
+            results[f'{component}.vel'] = coefficients[:, c, 0]
+            results[f'{component}.sig'] = np.sqrt(covariance[:, c, 0, 0])
+        return results
+
+    def local_fit(self, lon, lat):
+        """ Fit the local linear models at a batch of points. Returns the coefficients
+        (velocity in mm/yr, east and north gradients in mm/yr/km) with shape (m, 2, 3)
+        for the E and N components, their covariance matrices (m, 2, 3, 3), the number
+        of stations used and the distance (km) to the nearest station. Points without
+        stations closer than max_distance get NaN."""
+        chord, neighbours = self.tree.query(lonlat_to_xyz(lon, lat), k=self.k,
+                                            distance_upper_bound=km_to_chord(self.max_distance))
+        chord = chord.reshape(len(lon), -1)
+        neighbours = neighbours.reshape(len(lon), -1)
+        valid = np.isfinite(chord)
+        neighbours = np.where(valid, neighbours, 0)
+        distance = np.where(valid, chord_to_km(np.where(valid, chord, 0)), np.inf)
+
+        # Offsets (km) of the neighbours on the plane tangent to each query point
+        dlon = (self.lon[neighbours] - lon[:, None] + 180) % 360 - 180
+        x = np.radians(dlon) * EARTH_RADIUS_KM * np.cos(np.radians(lat))[:, None]
+        y = np.radians(self.lat[neighbours] - lat[:, None]) * EARTH_RADIUS_KM
+        design = np.stack((np.ones_like(x), x, y), axis=2)
+        gaussian = np.where(valid, np.exp(-0.5 * (distance / self.scale) ** 2), 0.0)
+        empty = ~valid.any(axis=1)
+
+        coefficients = np.empty((len(lon), 2, 3))
+        covariance = np.empty((len(lon), 2, 3, 3))
+        for c in range(2):
+            weights = gaussian / self.sigmas[neighbours, c] ** 2
+            weighted_design = design * weights[..., None]
+            normal = np.einsum('mki,mkj->mij', weighted_design, design)
+            # A small ridge on the gradients keeps the normal matrices invertible when the
+            # neighbours are few or aligned; the estimate then tends to a weighted mean
+            ridge = 1e-2 * normal[:, 0, 0] * self.scale ** 2
+            normal[:, 1, 1] += ridge
+            normal[:, 2, 2] += ridge
+            # Points without neighbours get NaN below; avoid singular systems meanwhile
+            normal[empty] = np.eye(3)
+            # Estimator: coefficients = gain @ velocities of the neighbours
+            gain = np.linalg.solve(normal, np.transpose(weighted_design, (0, 2, 1)))
+            coefficients[:, c] = np.einsum('mik,mk->mi', gain, self.velocities[neighbours, c])
+            scaled_gain = gain * self.sigmas[neighbours, c][:, None, :]
+            covariance[:, c] = np.einsum('mik,mjk->mij', scaled_gain, scaled_gain)
+        coefficients[empty] = np.nan
+        covariance[empty] = np.nan
+        return coefficients, covariance, valid.sum(axis=1), np.where(valid[:, 0], distance[:, 0], np.nan)
+
+    def grid(self, region, spacing):
+        """ Interpolate a regular grid covering region = (west, east, south, north)
+        with the given spacing (degrees). Returns the grid axes and the fields as
+        arrays of shape (n_lat, n_lon)."""
+        west, east, south, north = region
+        lons = np.arange(west, east + spacing / 2, spacing)
+        lats = np.arange(south, north + spacing / 2, spacing)
+        grid_lon, grid_lat = np.meshgrid(lons, lats)
+        values = self.query(grid_lon.ravel(), grid_lat.ravel())
+        return lons, lats, {name: values[name].reshape(grid_lon.shape) for name in OUTPUT_FIELDS}
+
+def write_grid(output_file, lons, lats, fields, attributes=None):
+    """ Write a gridded velocity field to .npz or, if the file name ends with .nc,
+    to NetCDF (requires xarray)."""
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    attributes = attributes or {}
+    if output_file.endswith('.nc'):
+        try:
+            import xarray as xr
+        except ImportError:
+            raise ImportError("Writing NetCDF grids requires xarray; use a .npz output file instead")
+        dataset = xr.Dataset({name.replace('.', '_'): (('lat', 'lon'), values) for name, values in fields.items()},
+                             coords={'lon': lons, 'lat': lats}, attrs=attributes)
+        dataset.to_netcdf(output_file)
+    else:
+        np.savez_compressed(output_file, lon=lons, lat=lats, attributes=json.dumps(attributes),
+                            **{name.replace('.', '_'): values for name, values in fields.items()})
+
+def format_results(lon, lat, results):
+    """ Interpolated values as a list of dictionaries (NaN written as None)."""
+    rows = []
+    for i in range(len(lon)):
+        row = {'Lon': float(lon[i]), 'Lat': float(lat[i])}
+        for name in OUTPUT_FIELDS:
+            value = results[name][i]
+            row[name] = None if np.isnan(value) else round(float(value), 3)
+        rows.append(row)
+    return rows
+
+def serve_stdin(interpolator, batch_size=1000):
+    """ Read "lon lat" lines from the standard input and print "lon lat E.vel N.vel
+    E.sig N.sig Num Dist" lines, interpolating the points in batches."""
+    def flush(points):
+        lon, lat = np.array(points).T
+        results = interpolator.query(lon, lat)
+        for i in range(len(lon)):
+            print(f"{lon[i]:.5f} {lat[i]:.5f} " + " ".join(f"{results[name][i]:.2f}" for name in OUTPUT_FIELDS), flush=True)
+
+    print("Lon Lat " + " ".join(OUTPUT_FIELDS), flush=True)
+    points = []
+    for line in sys.stdin:
+        fields = line.replace(',', ' ').split()
+        if len(fields) < 2:
+            # An empty line answers the points read so far
+            if points:
+                flush(points)
+                points = []
+            continue
+        points.append((float(fields[0]), float(fields[1])))
+        if len(points) >= batch_size:
+            flush(points)
+            points = []
+    if points:
+        flush(points)
+
+def serve_http(interpolator, host='127.0.0.1', port=8000):
+    """ Serve interpolation queries over HTTP (see module docstring)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def respond(self, lon, lat):
+            try:
+                lon = np.asarray(lon, dtype=float)
+                lat = np.asarray(lat, dtype=float)
+                if lon.shape != lat.shape:
+                    raise ValueError("lon and lat must have the same length")
+                body = json.dumps(format_results(lon, lat, interpolator.query(lon, lat))).encode()
+                self.send_response(200)
+            except (ValueError, TypeError) as error:
+                body = json.dumps({'error': str(error)}).encode()
+                self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/query':
+                self.send_error(404)
+                return
+            params = parse_qs(url.query)
+            split = lambda name: [v for value in params.get(name, []) for v in value.split(',') if v]
+            self.respond(split('lon'), split('lat'))
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/query':
+                self.send_error(404)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except json.JSONDecodeError as error:
+                request = {'lon': 'invalid', 'lat': str(error)}
+            self.respond(request.get('lon', []), request.get('lat', []))
+
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f"Serving velocity queries on http://{host}:{port}/query (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Interpolate a combined velocity field on a grid or at query points.')
+    parser.add_argument('combined_file', help='Combined velocity field (combined_vel_<frame>.csv)')
+    parser.add_argument('--k', type=int, default=12, help='Number of neighbouring stations')
+    parser.add_argument('--scale', type=float, default=50.0, help='Standard deviation (km) of the Gaussian weights')
+    parser.add_argument('--max_distance', type=float, default=150.0, help='Maximum distance (km) of the stations used')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    grid_parser = subparsers.add_parser('grid', help='Interpolate a regular grid')
+    grid_parser.add_argument('output_file', help='Output grid (.npz, or .nc with xarray)')
+    grid_parser.add_argument('--region', type=float, nargs=4, metavar=('WEST', 'EAST', 'SOUTH', 'NORTH'), required=True)
+    grid_parser.add_argument('--spacing', type=float, default=0.25, help='Grid spacing (degrees)')
+    subparsers.add_parser('stdin', help='Answer "lon lat" queries read from the standard input')
+    http_parser = subparsers.add_parser('serve', help='Answer queries over HTTP')
+    http_parser.add_argument('--host', default='127.0.0.1')
+    http_parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    interpolator = VelocityInterpolator.from_file(args.combined_file, k=args.k, scale=args.scale, max_distance=args.max_distance)
+    if args.mode == 'stdin':
+        serve_stdin(interpolator)
+    elif args.mode == 'serve':
+        serve_http(interpolator, args.host, args.port)
+    else:
+        lons, lats, fields = interpolator.grid(args.region, args.spacing)
+        write_grid(args.output_file, lons, lats, fields, {'source': os.path.basename(args.combined_file), 'k': args.k,
+                                                          'scale_km': args.scale, 'max_distance_km': args.max_distance})
+        print(f"Grid of {len(lats)} x {len(lons)} points: {args.output_file}")
+        end_time = time.time()
+        print(f"----------------------------------------------------------------------------------")
+        print(f"Time taken: {end_time - start_time:.2f} seconds")
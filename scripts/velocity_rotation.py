@@ -0,0 +1,262 @@
+""" This code aligns and rotates GNSS velocity fields without GAMIT/GLOBK. The
+alignment estimates a 6-parameter Helmert transformation (3 translation rates
+and 3 rotation rates) between an input velocity field and a reference velocity
+field by weighted least squares, using the stations common to both fields
+(stations closer than 1 km, as with 'eq_dist 1000' in the VELROT link file),
+with iterative rejection of outliers. The rotation transforms velocities to a
+plate-fixed reference frame by removing the motion predicted by an Euler pole,
+as done by CVFRAME: the rates are rotated while the adjusted rates (E.adj and
+N.adj) keep the values of the input frame. Positions are converted to Earth-
+centred coordinates on the GRS80 ellipsoid, which reproduces the CVFRAME output.
+
+Euler poles are read from a text file with one pole per line:
+    name  wx  wy  wz   (Cartesian rotation rates in deg/Myr)
+Lines starting with '#' or '*' are ignored."""
+
+""" Import necessary modules """
+import os
+import glob
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+VEL_COLUMNS = ['Lon', 'Lat', 'E.vel', 'N.vel', 'E.adj', 'N.adj', 'E.sig', 'N.sig', 'Corr', 'U.vel', 'U.adj', 'U.sig', 'Stat']
+
+GRS80_A = 6378137.0  # Semi-major axis (m)
+GRS80_F = 1 / 298.257222101  # Flattening
+DEG_PER_MYR = np.pi / 180.0 / 1e6  # Conversion from deg/Myr to rad/yr
+
+# Format of the CVFRAME velocity files
+CVFRAME_HEADER = ("*  Long.       Lat.        E & N Rate     E & N Adj.    E & N +-  RHO       H Rate  H adj.   +- SITE\n"
+                  "*  (deg)      (deg)         (mm/yr)      (mm/yr)      (mm/yr)               (mm/yr)\n")
+LINE_FORMAT = "{:11.5f}{:11.5f}{:9.2f}{:8.2f}{:8.2f}{:8.2f}{:8.2f}{:8.2f}{:7.3f}{:10.2f}{:8.2f}{:8.2f} {} \n"
+
+def geodetic_to_ecef(lon, lat):
+    """ Earth-centred coordinates (mm) of points on the GRS80 ellipsoid (height 0)."""
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    e2 = GRS80_F * (2 - GRS80_F)
+    n = GRS80_A / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    return 1e3 * np.column_stack((n * np.cos(lat) * np.cos(lon), n * np.cos(lat) * np.sin(lon), n * (1 - e2) * np.sin(lat)))
+
+def east_north_basis(lon, lat):
+    """ Unit vectors of the local East and North directions, each of shape (n, 3)."""
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    east = np.column_stack((-np.sin(lon), np.cos(lon), np.zeros_like(lon)))
+    north = np.column_stack((-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)))
+    return east, north
+
+def plate_velocity(lon, lat, pole):
+    """ East and North velocities (mm/yr) predicted by an Euler pole given as
+    Cartesian rotation rates (deg/Myr)."""
+    velocity = np.cross(np.asarray(pole, dtype=float) * DEG_PER_MYR, geodetic_to_ecef(lon, lat))
+    east, north = east_north_basis(lon, lat)
+    return np.sum(velocity * east, axis=1), np.sum(velocity * north, axis=1)
+
+def read_pole_file(pole_file):
+    """ Read Euler poles (name wx wy wz, in deg/Myr) into a dictionary."""
+    poles = {}
+    with open(pole_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith(('#', '*')):
+                continue
+            poles[fields[0]] = np.array([float(v) for v in fields[1:4]])
+    return poles
+
+def read_velocity_file(file_name):
+    """ Read a velocity file in any of the formats used in the pipeline: CVFRAME
+    files (header lines starting with '*'), files with a 'Lon Lat ...' header
+    line, or files without header."""
+    with open(file_name, 'r') as f:
+        skiprows = 0
+        for line in f:
+            if line.lstrip().startswith(('*', 'Lon')):
+                skiprows += 1
+            else:
+                break
+    df = pd.read_csv(file_name, sep=r'\s+', header=None, skiprows=skiprows, usecols=range(len(VEL_COLUMNS)))
+    df.columns = VEL_COLUMNS
+    return df
+
+def write_velocity_file(df, file_name, header_lines=()):
+    """ Write a velocity field in the CVFRAME column format, preceded by the given
+    header lines (without header lines, the format of the aligned _igb14.vel files)."""
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    with open(file_name, 'w') as f:
+        for line in header_lines:
+            f.write(line if line.endswith('\n') else line + '\n')
+        for row in df[VEL_COLUMNS].itertuples(index=False):
+            f.write(LINE_FORMAT.format(*row))
+
+def rotate_velocity_field(df, pole):
+    """ Remove the motion predicted by the Euler pole from the E and N rates. The
+    adjusted rates and all the other columns are kept, as done by CVFRAME."""
+    rotated = df.copy()
+    east, north = plate_velocity(df['Lon'], df['Lat'], pole)
+    rotated['E.vel'] = df['E.vel'] - east
+    rotated['N.vel'] = df['N.vel'] - north
+    return rotated
+
+def match_common_sites(df, reference_df, eq_dist=1.0):
+    """ Pair every station of `df` with a reference station closer than `eq_dist` km,
+    preferring a station with the same (normalised) code and otherwise taking the
+    nearest one. Every reference row is a candidate, so collocated reference
+    stations are matched individually. Returns the row indices of the matched pairs."""
+    from station_index import build_station_tree, lonlat_to_xyz, km_to_chord
+    from station_registry import normalise_codes
+    if len(reference_df) == 0 or len(df) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    tree = build_station_tree(reference_df['Lon'].values, reference_df['Lat'].values)
+    xyz = lonlat_to_xyz(df['Lon'].values, df['Lat'].values)
+    distance, nearest = tree.query(xyz, k=1, distance_upper_bound=km_to_chord(eq_dist))
+    matched = np.flatnonzero(np.isfinite(distance))
+    nearest = nearest[matched]
+
+    # Prefer a reference station with the same code when several are close enough
+    codes = normalise_codes(df['Stat'].values)
+    reference_codes = normalise_codes(reference_df['Stat'].values)
+    for p in np.flatnonzero(reference_codes[nearest] != codes[matched]):
+        i = matched[p]
+        close = np.asarray(tree.query_ball_point(xyz[i], km_to_chord(eq_dist)), dtype=np.int64)
+        same_code = close[reference_codes[close] == codes[i]]
+        if len(same_code):
+            gaps = np.linalg.norm(tree.data[same_code] - xyz[i], axis=1)
+            nearest[p] = same_code[np.argmin(gaps)]
+    return matched, nearest
+
+def helmert_design(lon, lat):
+    """ Design matrices of the E and N velocity components with respect to the 6
+    Helmert parameters: translation rates (mm/yr, Earth-centred X, Y, Z) and
+    rotation rates (deg/Myr about X, Y, Z)."""
+    east, north = east_north_basis(lon, lat)
+    r = geodetic_to_ecef(lon, lat) * DEG_PER_MYR
+    # d(omega x r)/d(omega) = -[r]x, so the rotation columns are (r x e) for a unit vector e
+    design_e = np.hstack((east, np.cross(r, east)))
+    design_n = np.hstack((north, np.cross(r, north)))
+    return design_e, design_n
+
+def estimate_helmert(df, reference_df, eq_dist=1.0, n_sigma=3.0, max_iterations=10):
+    """ Estimate the Helmert parameters mapping `df` onto `reference_df` from their
+    common sites. Residuals larger than `n_sigma` times their uncertainty are
+    rejected iteratively. Returns the parameters, their covariance, the indices of
+    the common sites and the mask of the sites kept in the final solution."""
+    rows, ref_rows = match_common_sites(df, reference_df, eq_dist)
+    if len(rows) < 3:
+        raise ValueError(f"Only {len(rows)} common sites found, at least 3 are needed")
+    sites = df.iloc[rows]
+    reference = reference_df.iloc[ref_rows]
+    design_e, design_n = helmert_design(sites['Lon'].values, sites['Lat'].values)
+    design = np.vstack((design_e, design_n))
+    observed = np.concatenate((reference['E.vel'].values - sites['E.vel'].values, reference['N.vel'].values - sites['N.vel'].values))
+    sigma = np.sqrt(np.concatenate((sites['E.sig'].values ** 2 + reference['E.sig'].values ** 2,
+                                    sites['N.sig'].values ** 2 + reference['N.sig'].values ** 2)))
+    sigma = np.where(sigma > 0, sigma, np.nanmedian(sigma[sigma > 0]) if np.any(sigma > 0) else 1.0)
+
+    keep = np.ones(len(rows), dtype=bool)
+    for _ in range(max_iterations):
+        use = np.concatenate((keep, keep))
+        weighted = design[use] / sigma[use, None]
+        normal = weighted.T @ weighted
+        params = np.linalg.solve(normal, weighted.T @ (observed[use] / sigma[use]))
+        normalised = np.abs(observed - design @ params) / sigma
+        new_keep = (normalised[:len(rows)] <= n_sigma) & (normalised[len(rows):] <= n_sigma)
+        if np.array_equal(new_keep, keep) or new_keep.sum() < 3:
+            break
+        keep = new_keep
+    return params, np.linalg.inv(normal), rows, keep
+
+def align_velocity_field(df, params):
+    """ Apply Helmert parameters to the E and N rates of a velocity field. As in the
+    aligned _igb14.vel files, the adjusted rates are set to the aligned rates."""
+    design_e, design_n = helmert_design(df['Lon'].values, df['Lat'].values)
+    aligned = df.copy()
+    aligned['E.vel'] = df['E.vel'] + design_e @ params
+    aligned['N.vel'] = df['N.vel'] + design_n @ params
+    aligned['E.adj'] = aligned['E.vel']
+    aligned['N.adj'] = aligned['N.vel']
+    return aligned
+
+def align_file(file_name, reference_df, output_folder, frame='igb14', eq_dist=1.0):
+    """ Align one velocity file to the reference velocity field and write it as
+    <name>_<frame>.vel (without header) to the output folder. Returns the output
+    file, or None if the file could not be aligned."""
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+    df = read_velocity_file(file_name)
+    print(f"----------------------------------------------------------------------------------")
+    try:
+        params, covariance, rows, keep = estimate_helmert(df, reference_df, eq_dist)
+    except ValueError as error:
+        print(f"Skipping {base_name}: {error}")
+        return None
+    output_file = os.path.join(output_folder, f'{base_name}_{frame}.vel')
+    write_velocity_file(align_velocity_field(df, params), output_file)
+    sigmas = np.sqrt(np.diag(covariance))
+    print(f"Aligned {base_name} using {keep.sum()} / {len(rows)} common sites")
+    print("Translation rates (mm/yr): " + " ".join(f"{p:.3f}+-{s:.3f}" for p, s in zip(params[:3], sigmas[:3])))
+    print("Rotation rates (deg/Myr): " + " ".join(f"{p:.5f}+-{s:.5f}" for p, s in zip(params[3:], sigmas[3:])))
+    print(f"Aligned velocities: {output_file}")
+    return output_file
+
+def align_folder(folder_path, reference_file, output_folder, frame='igb14', eq_dist=1.0):
+    """ Align every velocity file (.csv or .vel) of a folder to the reference velocity
+    field and write <name>_<frame>.vel files (without header) to the output folder."""
+    reference_df = read_velocity_file(reference_file)
+    file_names = sorted(glob.glob(os.path.join(folder_path, '*.csv')) + glob.glob(os.path.join(folder_path, '*.vel')))
+    for file_name in file_names:
+        align_file(file_name, reference_df, output_folder, frame, eq_dist)
+
+def rotate_file(file_name, poles, output_folder, frames):
+    """ Rotate one velocity file to each plate-fixed frame given, writing
+    <output_folder>/<frame>/<name>_<frame>.vel files. Returns the output files."""
+    df = read_velocity_file(file_name)
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+    solution_name = base_name[:-len('_igb14')] if base_name.endswith('_igb14') else base_name
+    output_files = []
+    for frame in frames:
+        pole = poles[frame]
+        header = [f"* Rotated velocity file {os.path.basename(file_name)} to {frame}",
+                  "* Rotation Pole {:12.6f}{:12.6f}{:12.6f} deg/Myr".format(*pole)]
+        output_file = os.path.join(output_folder, frame, f'{solution_name}_{frame}.vel')
+        write_velocity_file(rotate_velocity_field(df, pole), output_file, header + CVFRAME_HEADER.splitlines())
+        output_files.append(output_file)
+    print(f"Rotated {base_name} to: {', '.join(frames)}")
+    return output_files
+
+def rotate_folder(folder_path, pole_file, output_folder, frames=None):
+    """ Rotate every velocity file of a folder to each plate-fixed frame of the pole
+    file, writing <output_folder>/<frame>/<name>_<frame>.vel files with a CVFRAME
+    header (the input expected by combine_vel.py). Input names ending in _igb14
+    are shortened to the solution name."""
+    poles = read_pole_file(pole_file)
+    frames = frames or list(poles)
+    file_names = sorted(glob.glob(os.path.join(folder_path, '*.vel')))
+    for file_name in file_names:
+        rotate_file(file_name, poles, output_folder, frames)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Align and rotate GNSS velocity fields.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    align_parser = subparsers.add_parser('align', help='Align velocity fields to a reference velocity field')
+    align_parser.add_argument('folder_path', help='Folder with the velocity files to align')
+    align_parser.add_argument('reference_file', help='Reference velocity field')
+    align_parser.add_argument('output_folder', help='Folder for the aligned velocity files')
+    align_parser.add_argument('--frame', default='igb14', help='Name of the reference frame (output suffix)')
+    align_parser.add_argument('--eq_dist', type=float, default=1.0, help='Maximum distance (km) between common sites')
+    rotate_parser = subparsers.add_parser('rotate', help='Rotate velocity fields to plate-fixed reference frames')
+    rotate_parser.add_argument('folder_path', help='Folder with the aligned velocity files')
+    rotate_parser.add_argument('pole_file', help='Euler pole file (name wx wy wz, deg/Myr)')
+    rotate_parser.add_argument('output_folder', help='Folder for the rotated velocity files')
+    rotate_parser.add_argument('--frames', nargs='*', help='Frames (pole names) to rotate to; default all')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.command == 'align':
+        align_folder(args.folder_path, args.reference_file, args.output_folder, args.frame, args.eq_dist)
+    else:
+        rotate_folder(args.folder_path, args.pole_file, args.output_folder, args.frames)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")
@@ -0,0 +1,187 @@
+""" This code combines vertical velocities from GNSS solutions and levelling data
+sets into a single vertical velocity field. Instead of grouping stations again,
+it reuses the neighbour groups of the horizontal combination: GNSS rows keep
+their horizontal group, and levelling benchmarks join the group of the nearest
+GNSS station closer than 1.11 km (or form new groups among themselves). For each
+group, outliers are removed with the IQR method applied to the deviations of
+U.vel from the group median, and the median U.vel and U.sig of the remaining
+solutions are computed, all groups at once on padded matrices. Finally, stations
+with U.sig beyond the 99th percentile of the fitted lognormal distribution are
+removed, as in uncertainty_filter_verticals.py. Zero vertical velocities are
+treated as not estimated, following combine_vel.py."""
+
+""" Import necessary modules """
+import os
+import sys
+import glob
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.stats import lognorm
+from station_index import (build_station_tree, lonlat_to_xyz, km_to_chord, group_close_stations,
+                           padded_group_indices, take_padded, padded_median, read_combination_inputs)
+from run_manifest import atomic_to_csv, RunManifest
+
+VERTICAL_COLUMNS = ['Lon', 'Lat', 'U.vel', 'U.sig', 'Stat']
+
+def levelling_files(levelling_folder):
+    """ Levelling vertical velocity files (.raw or .vel) of a folder, sorted."""
+    return sorted(glob.glob(os.path.join(levelling_folder, '*.raw')) + glob.glob(os.path.join(levelling_folder, '*.vel')))
+
+def read_levelling_verticals(levelling_folder):
+    """ Read the levelling vertical velocity files (.raw or .vel, five columns:
+    Lon Lat U.vel U.sig Stat, without header) of a folder into one DataFrame with
+    a 'Ref' column holding the file name."""
+    dfs = []
+    for file_name in levelling_files(levelling_folder):
+        df = pd.read_csv(file_name, sep=r'\s+', header=None, usecols=range(len(VERTICAL_COLUMNS)), names=VERTICAL_COLUMNS)
+        df['Ref'] = os.path.splitext(os.path.basename(file_name))[0]
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame(columns=VERTICAL_COLUMNS + ['Ref'])
+    return pd.concat(dfs, ignore_index=True)
+
+def groups_to_labels(groups, n):
+    """ Convert a list of groups of row indices (as returned by reference_stages.make_groups)
+    into an array of group labels, numbered in the order of the list."""
+    labels = np.full(n, -1, dtype=np.int64)
+    for k, group in enumerate(groups):
+        labels[group] = k
+    # Rows missing from the groups (should not happen) get their own group
+    missing = np.flatnonzero(labels < 0)
+    labels[missing] = len(groups) + np.arange(len(missing))
+    return labels
+
+def attach_to_groups(labels, lon, lat, new_lon, new_lat, threshold=1.11):
+    """ Assign new stations (e.g. levelling benchmarks) to the group of the nearest
+    existing station closer than `threshold` km. Stations without such a neighbour
+    are grouped among themselves and get labels after the existing ones."""
+    new_labels = np.full(len(new_lon), -1, dtype=np.int64)
+    if len(new_lon) == 0:
+        return new_labels
+    if len(lon):
+        tree = build_station_tree(lon, lat)
+        distance, nearest = tree.query(lonlat_to_xyz(new_lon, new_lat), k=1,
+                                       distance_upper_bound=np.nextafter(km_to_chord(threshold), 0))
+        matched = np.isfinite(distance)
+        new_labels[matched] = labels[nearest[matched]]
+    unmatched = np.flatnonzero(new_labels < 0)
+    if len(unmatched):
+        offset = labels.max() + 1 if len(labels) else 0
+        new_labels[unmatched] = offset + group_close_stations(new_lon[unmatched], new_lat[unmatched], threshold)
+    return new_labels
+
+def grouped_iqr_inliers_1d(values):
+    """ IQR outlier test on a padded matrix (groups, width) of a single component:
+    deviations from the group median outside [Q1 - 1.5 IQR, Q3 + 1.5 IQR] are
+    outliers. If every value of a group is an outlier, all of them are kept."""
+    valid = ~np.isnan(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        diffs = np.abs(values - padded_median(values)[:, None])
+        q1, q3 = np.nanpercentile(diffs, [25, 75], axis=1, keepdims=True)
+        iqr = q3 - q1
+        outliers = (diffs < q1 - 1.5 * iqr) | (diffs > q3 + 1.5 * iqr)
+    inliers = valid & ~outliers
+    all_outliers = ~inliers.any(axis=1, keepdims=True)
+    return np.where(all_outliers, valid, inliers)
+
+def combine_vertical_groups(verticals, labels):
+    """ Combine the vertical velocities of each group: IQR outlier removal on U.vel,
+    then median U.vel and U.sig of the inliers. The coordinates and station name
+    are taken from the first row of each group. Returns a DataFrame with one row
+    per group containing at least one vertical velocity."""
+    u_vel = verticals['U.vel'].to_numpy(dtype=float)
+    u_sig = verticals['U.sig'].to_numpy(dtype=float)
+    groups, u_vel_med, u_sig_med = [], [], []
+    for ids, index in padded_group_indices(labels):
+        padded_vel = take_padded(u_vel, index)
+        padded_sig = take_padded(u_sig, index)
+        inliers = grouped_iqr_inliers_1d(padded_vel)
+        groups.append(ids)
+        u_vel_med.append(padded_median(np.where(inliers, padded_vel, np.nan)))
+        u_sig_med.append(padded_median(np.where(inliers, padded_sig, np.nan)))
+    if not groups:
+        return pd.DataFrame(columns=VERTICAL_COLUMNS + ['Num'])
+
+    groups = np.concatenate(groups)
+    order = np.argsort(groups)
+    first_rows = np.unique(labels, return_index=True)[1]
+    chosen = verticals.iloc[first_rows[groups[order]]]
+    return pd.DataFrame({
+        'Lon': chosen['Lon'].round(5).values,
+        'Lat': chosen['Lat'].round(5).values,
+        'U.vel': np.round(np.concatenate(u_vel_med)[order], 2),
+        'U.sig': np.round(np.concatenate(u_sig_med)[order], 2),
+        'Stat': chosen['Stat'].values,
+        'Num': np.bincount(labels)[groups[order]],
+    })
+
+def lognormal_filter_verticals(combined):
+    """ Remove stations with U.sig beyond the 99th percentile of the lognormal
+    distribution fitted to the positive uncertainties (see uncertainty_filter_verticals.py)."""
+    positive_uncertainties = combined['U.sig'][combined['U.sig'] > 0]
+    shape, loc, scale = lognorm.fit(positive_uncertainties, floc=0)
+    p99 = lognorm.ppf(0.99, shape, loc=loc, scale=scale)
+    return combined[combined['U.sig'] <= p99], p99
+
+def combine_vertical_field(combined_df, labels, output_folder, levelling_folder=None):
+    """ The combine_vertical_field function takes the merged input rows of the
+    horizontal combination and their group labels, adds the levelling data sets,
+    combines the verticals group by group and writes the combined and the
+    lognormal-filtered vertical velocity fields (Lon Lat U.vel U.sig Stat, no header)."""
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = RunManifest(output_folder, 'vertical')
+
+    # GNSS verticals keep their horizontal group; zero vertical velocities were not estimated
+    has_vertical = combined_df['U.vel'].to_numpy(dtype=float) != 0
+    gnss = combined_df.loc[has_vertical, VERTICAL_COLUMNS + ['Ref']].reset_index(drop=True)
+    gnss_labels = np.asarray(labels)[has_vertical]
+
+    if levelling_folder:
+        manifest.add_inputs(levelling_files(levelling_folder))
+        levelling = read_levelling_verticals(levelling_folder)
+    else:
+        levelling = pd.DataFrame(columns=VERTICAL_COLUMNS + ['Ref'])
+    levelling_labels = attach_to_groups(np.asarray(labels), combined_df['Lon'].to_numpy(dtype=float),
+                                        combined_df['Lat'].to_numpy(dtype=float),
+                                        levelling['Lon'].to_numpy(dtype=float), levelling['Lat'].to_numpy(dtype=float))
+    verticals = pd.concat([gnss, levelling], ignore_index=True)
+    vertical_labels = np.concatenate([gnss_labels, levelling_labels])
+    print(f"Number of vertical velocities: {len(gnss)} (GNSS) + {len(levelling)} (levelling)")
+
+    # Renumber the groups that contain verticals, keeping their order
+    _, vertical_labels = np.unique(vertical_labels, return_inverse=True)
+    combined = combine_vertical_groups(verticals, vertical_labels.ravel())
+    filtered, p99 = lognormal_filter_verticals(combined)
+
+    combined_file = os.path.join(output_folder, 'combined_vertical_velocity_field.vel')
+    filtered_file = os.path.join(output_folder, 'filtered_vertical_velocity_field.vel')
+    atomic_to_csv(combined[VERTICAL_COLUMNS], combined_file, manifest, sep=' ', index=False, header=False)
+    atomic_to_csv(filtered[VERTICAL_COLUMNS], filtered_file, manifest, sep=' ', index=False, header=False)
+    manifest.save()
+    print(f"Number of combined vertical velocities: {len(combined)}")
+    print(f"Number of stations removed (U.sig > {p99:.2f} mm/yr): {len(combined) - len(filtered)}")
+    print(f"Combined vertical velocities: {combined_file}")
+    print(f"Filtered vertical velocities: {filtered_file}")
+    return filtered
+
+if __name__ == "__main__":
+    # Check if the correct number of command-line arguments is provided
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python vertical_combination.py ./path2/input_folder ./path2/output_folder [./path2/levelling_folder]")
+        sys.exit(1)
+
+    input_folder = sys.argv[1]
+    output_folder = sys.argv[2]
+    levelling_folder = sys.argv[3] if len(sys.argv) == 4 else None
+
+    # Time the execution of the vertical combination
+    start_time = time.time()
+    combined_df = read_combination_inputs(input_folder)
+    labels = group_close_stations(combined_df['Lon'].values, combined_df['Lat'].values)
+    combine_vertical_field(combined_df, labels, output_folder, levelling_folder)
+    end_time = time.time()
+    print(f"----------------------------------------------------------------------------------")
+    print(f"Time taken: {end_time - start_time:.2f} seconds")